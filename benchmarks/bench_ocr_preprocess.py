@@ -0,0 +1,83 @@
+# Measures OCR throughput and accuracy for different preprocessing settings.
+#
+# Accuracy is the character-level similarity (difflib ratio) to a reference text:
+# the page's embedded text layer when it has a usable one, otherwise the OCR
+# output of the highest-fidelity setting (300 DPI, color, no downscaling).
+#
+#   python -m benchmarks.bench_ocr_preprocess                    # bundled sample reports
+#   python -m benchmarks.bench_ocr_preprocess report1.pdf scan.pdf
+
+import argparse
+import difflib
+import glob
+import re
+import time
+from utils.ocr import (ocr_settings, rasterize_pages, preprocess_image, ocr_reader, warm_up_ocr,
+                       _read_text_layer, _text_layer_is_usable)
+
+SETTINGS_GRID = [
+    ("reference 300dpi color", ocr_settings(dpi=300, grayscale=False, max_dim=0, binarize=False, deskew=False)),
+    ("200dpi color (old default)", ocr_settings(dpi=200, grayscale=False, max_dim=0, binarize=False, deskew=False)),
+    ("200dpi gray", ocr_settings(dpi=200, grayscale=True, max_dim=0, binarize=False, deskew=False)),
+    ("200dpi gray max2400", ocr_settings(dpi=200, grayscale=True, max_dim=2400, binarize=False, deskew=False)),
+    ("200dpi gray max1600", ocr_settings(dpi=200, grayscale=True, max_dim=1600, binarize=False, deskew=False)),
+    ("150dpi gray", ocr_settings(dpi=150, grayscale=True, max_dim=0, binarize=False, deskew=False)),
+    ("200dpi gray binarize", ocr_settings(dpi=200, grayscale=True, max_dim=2400, binarize=True, deskew=False)),
+    ("200dpi gray deskew", ocr_settings(dpi=200, grayscale=True, max_dim=2400, binarize=False, deskew=True)),
+]
+
+
+def _normalize(text):
+    return re.sub(r"\s+", " ", text).strip().lower()
+
+
+def _similarity(text, reference):
+    return difflib.SequenceMatcher(None, _normalize(text), _normalize(reference), autojunk=False).ratio()
+
+
+def ocr_document(pdf_path, settings, reader):
+    """Returns ([page texts], seconds, megapixels processed)."""
+    texts, pixels = [], 0
+    start = time.perf_counter()
+    for image in rasterize_pages(pdf_path, None, None, settings):
+        array = preprocess_image(image, settings)
+        pixels += array.shape[0] * array.shape[1]
+        texts.append(" ".join(reader.readtext(array, detail=0)))
+    return texts, time.perf_counter() - start, pixels / 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("pdfs", nargs="*")
+    args = parser.parse_args()
+    pdfs = args.pdfs or sorted(glob.glob("uploaded_reports/*/*.pdf"))
+
+    warm_up_ocr()
+    results = {name: {"pages": 0, "seconds": 0.0, "mpix": 0.0, "scores": []} for name, _ in SETTINGS_GRID}
+    with ocr_reader() as reader:
+        for pdf_path in pdfs:
+            layer = _read_text_layer(pdf_path) or []
+            references = None
+            for name, settings in SETTINGS_GRID:
+                texts, seconds, mpix = ocr_document(pdf_path, settings, reader)
+                if references is None:
+                    references = [layer[i]["text"] if i < len(layer) and _text_layer_is_usable(layer[i]) else text
+                                  for i, text in enumerate(texts)]
+                r = results[name]
+                r["pages"] += len(texts)
+                r["seconds"] += seconds
+                r["mpix"] += mpix
+                r["scores"] += [_similarity(t, ref) for t, ref in zip(texts, references)]
+            print(f"done: {pdf_path}")
+
+    print(f"\n{'setting':<28} {'pages/s':>8} {'Mpix/page':>10} {'accuracy':>9}")
+    for name, _ in SETTINGS_GRID:
+        r = results[name]
+        if not r["pages"]:
+            continue
+        accuracy = sum(r["scores"]) / len(r["scores"])
+        print(f"{name:<28} {r['pages'] / r['seconds']:>8.2f} {r['mpix'] / r['pages']:>10.2f} {accuracy:>9.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+# End-to-end throughput of ingestion and advisory generation against the local
+# fake LLM backend (utils/llm_fake.py), so the numbers show our own overhead —
+# OCR, parsing, DB, retrieval, prompt assembly, stream handling — separately
+# from model latency. No network access is needed for the model.
+#
+# Ingestion runs OCR + summary + extraction on each file and writes the report
+# inside a transaction that is rolled back. Advisories use an existing user's
+# profile and reports.
+#
+#   python -m benchmarks.bench_pipeline                              # bundled sample reports
+#   python -m benchmarks.bench_pipeline scan.pdf --user-id 1 --latency 0.8 --tokens-per-second 40
+
+import argparse
+import glob
+import os
+import statistics
+import time
+
+
+def _summarize(name, timings):
+    p95 = sorted(timings)[min(len(timings) - 1, int(len(timings) * 0.95))]
+    print(f"{name:<22} {statistics.median(timings):>10.3f} {p95:>10.3f}")
+
+
+def bench_ingest(paths, user_id):
+    from config.db_connection import get_connection
+    from utils.ocr import extract_text_from_report, generate_summary, extract_report_data, summarize_and_extract, \
+        _write_report, INGEST_LLM_MODE
+
+    stages = {"ocr": [], "llm": [], "db_write": [], "total": []}
+    for path in paths:
+        start = time.perf_counter()
+        text = extract_text_from_report(path)
+        ocr_done = time.perf_counter()
+        if INGEST_LLM_MODE == "single":
+            summary, report_data = summarize_and_extract(text)
+        else:
+            summary, report_data = generate_summary(text), extract_report_data(text)
+        llm_done = time.perf_counter()
+        conn = get_connection()
+        cursor = conn.cursor()
+        try:
+            _write_report(cursor, user_id, report_data, summary)
+        finally:
+            conn.rollback()
+            cursor.close()
+            conn.close()
+        end = time.perf_counter()
+        stages["ocr"].append(ocr_done - start)
+        stages["llm"].append(llm_done - ocr_done)
+        stages["db_write"].append(end - llm_done)
+        stages["total"].append(end - start)
+    return stages
+
+
+def bench_advisories(user_id, rounds):
+    from utils.advisories import get_user_health_profile, get_latest_summaries, ADVISORY_PROMPTS
+    from utils.llm import stream
+
+    stages = {"db_fetch": [], "prompt": [], "first_token": [], "stream": []}
+    for _ in range(rounds):
+        for build_prompt in ADVISORY_PROMPTS.values():
+            start = time.perf_counter()
+            health_profile, summaries = get_user_health_profile(user_id), get_latest_summaries(user_id)
+            fetched = time.perf_counter()
+            prompt = build_prompt(health_profile, summaries)
+            built = time.perf_counter()
+            first = None
+            for _chunk in stream(prompt):
+                first = first or time.perf_counter()
+            end = time.perf_counter()
+            stages["db_fetch"].append(fetched - start)
+            stages["prompt"].append(built - fetched)
+            stages["first_token"].append((first or end) - built)
+            stages["stream"].append(end - built)
+    return stages
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("files", nargs="*")
+    parser.add_argument("--user-id", type=int, help="existing users.id for the rolled-back writes and the advisory benchmark")
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--latency", type=float, default=0.5, help="fake model seconds to first token")
+    parser.add_argument("--tokens-per-second", type=float, default=50)
+    parser.add_argument("--output-tokens", type=int, default=300)
+    parser.add_argument("--page-cache", action="store_true", help="keep the OCR page cache enabled")
+    args = parser.parse_args()
+
+    # Read by the utils modules at import time
+    os.environ["LLM_BACKEND"] = "fake"
+    os.environ["LLM_CACHE"] = "false"
+    os.environ["FAKE_LLM_LATENCY"] = str(args.latency)
+    os.environ["FAKE_LLM_TOKENS_PER_SECOND"] = str(args.tokens_per_second)
+    os.environ["FAKE_LLM_OUTPUT_TOKENS"] = str(args.output_tokens)
+    if not args.page_cache:
+        os.environ["OCR_PAGE_CACHE"] = "false"
+
+    files = args.files or sorted(glob.glob("uploaded_reports/*/*.pdf"))
+    print(f"fake model: {args.latency}s to first token, {args.tokens_per_second} tokens/s, "
+          f"{args.output_tokens} output tokens\n")
+    print(f"{'stage':<22} {'median s':>10} {'p95 s':>10}")
+
+    start = time.perf_counter()
+    stages = bench_ingest(files, args.user_id or 1)
+    elapsed = time.perf_counter() - start
+    for name, timings in stages.items():
+        _summarize(f"ingest {name}", timings)
+    print(f"ingest throughput: {len(files) / elapsed:.2f} reports/s over {len(files)} report(s)\n")
+
+    if args.user_id:
+        for name, timings in bench_advisories(args.user_id, args.rounds).items():
+            _summarize(f"advisory {name}", timings)
+
+    from utils.llm import llm_stats
+    print("\nmodel calls:", llm_stats())
+
+
+if __name__ == "__main__":
+    main()
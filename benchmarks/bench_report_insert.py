@@ -0,0 +1,58 @@
+# Compares the report write paths in utils/ocr.store_report against SQL Server.
+# Every insert runs inside a transaction that is rolled back, so the database is left unchanged.
+#
+#   python -m benchmarks.bench_report_insert --reports 20 --params 40
+
+import argparse
+import statistics
+import time
+from config.db_connection import get_connection
+from utils.ocr import _write_report
+
+
+def synthetic_report(n_params):
+    return {
+        "report_type": "CBC",
+        "report_date": "2025-01-01",
+        "parameters": [
+            {"parameter_name": f"Analyte {i}", "parameter_value": 10.0 + i, "unit": "mg/dL",
+             "low_range": 5.0, "high_range": 50.0}
+            for i in range(n_params)
+        ],
+    }
+
+
+def bench(mode, user_id, n_reports, n_params):
+    report = synthetic_report(n_params)
+    conn = get_connection()
+    cursor = conn.cursor()
+    timings = []
+    try:
+        for _ in range(n_reports):
+            start = time.perf_counter()
+            _write_report(cursor, user_id, report, "benchmark summary", mode=mode)
+            timings.append((time.perf_counter() - start) * 1000)
+    finally:
+        conn.rollback()
+        cursor.close()
+        conn.close()
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--user-id", type=int, default=1, help="existing users.id to attach the rows to")
+    parser.add_argument("--reports", type=int, default=20)
+    parser.add_argument("--params", type=int, default=40)
+    args = parser.parse_args()
+
+    print(f"{args.reports} reports x {args.params} parameters")
+    print(f"{'mode':<12} {'median ms':>10} {'p95 ms':>10}")
+    for mode in ("loop", "executemany", "openjson"):
+        timings = sorted(bench(mode, args.user_id, args.reports, args.params))
+        p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+        print(f"{mode:<12} {statistics.median(timings):>10.1f} {p95:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+# Search latency and memory of the multi-tenant knowledge-base store
+# (utils/tenant_kb.py) at growing user counts. Synthetic users get random
+# unit vectors, so no embedding model is loaded; each size is built in a
+# temporary directory that is deleted afterwards.
+#
+# Reported per size: build time, files on disk (against the two files per
+# user of faiss_indexes/user_<id>/), cold load of all shards, the store's
+# vector memory and process RSS growth, and single / batched search latency.
+#
+#   python -m benchmarks.bench_tenant_kb                                # 1k, 10k, 100k users
+#   python -m benchmarks.bench_tenant_kb --users 1000 10000 --chunks-per-user 12 --queries 2000
+
+import argparse
+import os
+import shutil
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import psutil
+
+
+def _rss_mb():
+    return psutil.Process().memory_info().rss / 1024 / 1024
+
+
+def _unit_vectors(rng, n, dim):
+    vectors = rng.standard_normal((n, dim)).astype("float32")
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def build(tenant_kb, n_users, chunks_per_user, dim, rng):
+    for user_id in range(1, n_users + 1):
+        chunks = {f"chunk-{i}": (f"Synthetic chunk {i} of user {user_id}", {"user_id": user_id, "type": "reports"})
+                  for i in range(chunks_per_user)}
+        tenant_kb.add_chunks(user_id, chunks, vectors=_unit_vectors(rng, chunks_per_user, dim), persist=False)
+    tenant_kb.save_shards()
+
+
+def bench_size(tenant_kb, n_users, args):
+    rng = np.random.default_rng(n_users)
+    tenant_kb.TENANT_INDEX_DIR = Path(tempfile.mkdtemp(prefix="tenant_kb_bench_"))
+    tenant_kb._shards.clear()
+    try:
+        start = time.perf_counter()
+        build(tenant_kb, n_users, args.chunks_per_user, args.dim, rng)
+        build_seconds = time.perf_counter() - start
+        files = len(os.listdir(tenant_kb.TENANT_INDEX_DIR))
+        disk_mb = sum(f.stat().st_size for f in tenant_kb.TENANT_INDEX_DIR.iterdir()) / 1024 / 1024
+
+        # Cold start: drop the loaded shards and read them all back
+        tenant_kb._shards.clear()
+        rss_before = _rss_mb()
+        start = time.perf_counter()
+        for shard in range(tenant_kb.TENANT_SHARDS):
+            with tenant_kb._shard_locks[shard]:
+                tenant_kb._get_shard(shard)
+        cold_seconds = time.perf_counter() - start
+        rss_growth = _rss_mb() - rss_before
+        resident_mb = tenant_kb.tenant_store_stats()["resident_bytes"] / 1024 / 1024
+
+        users = rng.integers(1, n_users + 1, size=args.queries)
+        queries = _unit_vectors(rng, args.queries, args.dim)
+        latencies = []
+        for user_id, query in zip(users, queries):
+            start = time.perf_counter()
+            results = tenant_kb.search_by_vector(int(user_id), query, k=4)
+            latencies.append((time.perf_counter() - start) * 1000)
+            assert all(doc.metadata["user_id"] == user_id for doc, _ in results)
+        start = time.perf_counter()
+        for user_id, query in zip(users, queries):
+            tenant_kb.search_by_vector(int(user_id), query, k=4)
+        qps = args.queries / (time.perf_counter() - start)
+    finally:
+        shutil.rmtree(tenant_kb.TENANT_INDEX_DIR, ignore_errors=True)
+        tenant_kb._shards.clear()
+
+    p95 = sorted(latencies)[int(len(latencies) * 0.95)]
+    print(f"{n_users:>8} {n_users * args.chunks_per_user:>10} {build_seconds:>8.1f} {files:>7} {n_users * 2:>10} "
+          f"{disk_mb:>9.1f} {cold_seconds:>8.3f} {resident_mb:>10.1f} {rss_growth:>8.1f} "
+          f"{statistics.median(latencies):>8.3f} {p95:>8.3f} {qps:>8.0f}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--chunks-per-user", type=int, default=8)
+    parser.add_argument("--dim", type=int, default=384, help="all-MiniLM-L6-v2 embeddings are 384-dimensional")
+    parser.add_argument("--queries", type=int, default=1000)
+    args = parser.parse_args()
+
+    from utils import tenant_kb
+    print(f"{tenant_kb.TENANT_SHARDS} shards, {args.chunks_per_user} chunks/user, dim {args.dim}, "
+          f"{args.queries} searches per size\n")
+    print(f"{'users':>8} {'vectors':>10} {'build s':>8} {'files':>7} {'per-user':>10} {'disk MB':>9} "
+          f"{'cold s':>8} {'vec MB':>10} {'RSS MB':>8} {'p50 ms':>8} {'p95 ms':>8} {'qps':>8}")
+    for n_users in args.users:
+        bench_size(tenant_kb, n_users, args)
+
+
+if __name__ == "__main__":
+    main()
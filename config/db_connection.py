@@ -1,9 +1,14 @@
 import pyodbc
 import os
+import sqlite3
+from pathlib import Path
 from dotenv import load_dotenv
 
 load_dotenv()
 
+# App-local state (caches, job queue) lives in small SQLite files next to the app
+LOCAL_DB_DIR = Path(os.getenv("LOCAL_DB_DIR", "local_db"))
+
 def get_connection():
     conn_str=(
          f"DRIVER={{{os.getenv('DB_DRIVER')}}};"
@@ -11,4 +16,10 @@ def get_connection():
          f"DATABASE={os.getenv('DB_NAME')};"
          f"Trusted_Connection={os.getenv('DB_TRUSTED_CONNECTION')};"
     )
-    return pyodbc.connect(conn_str)
\ No newline at end of file
+    return pyodbc.connect(conn_str)
+
+def get_local_connection(name):
+    LOCAL_DB_DIR.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(LOCAL_DB_DIR / f"{name}.sqlite3", timeout=30, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    return conn
@@ -1,19 +1,14 @@
-from config.db_connection import get_connection
 import streamlit as st
-from langchain_huggingface import HuggingFaceEndpoint,ChatHuggingFace 
+from datetime import datetime
 from dotenv import load_dotenv
 from langchain_core.prompts import PromptTemplate
-from langchain_community.vectorstores import FAISS
-from langchain_huggingface import HuggingFaceEmbeddings
 from deep_translator import GoogleTranslator
-from utils.lan import to_user_language,back_to_english,t 
+from utils.lan import to_user_language,to_user_language_stream,back_to_english,t 
+from utils.advisories import get_user_health_profile, get_latest_summaries, advisory_version, get_advisory, stream_advisory
+from utils.jobs import start_workers
+from utils.llm import LLMUnavailableError
 
 load_dotenv()
-conn=get_connection()
-cursor=conn.cursor()
-llm=HuggingFaceEndpoint(repo_id="mistralai/Mistral-7B-Instruct-v0.3",
-                        task="text-generation")
-model=ChatHuggingFace(llm=llm)
 
 
 
@@ -124,12 +119,6 @@ languages = {
 }
 
 
-#Load local FAISS index
-embeddings = HuggingFaceEmbeddings(model_name="sentence-transformers/all-MiniLM-L6-v2")
-vectorstore = FAISS.load_local("faiss_index", embeddings=embeddings,allow_dangerous_deserialization=True)
-retriever = vectorstore.as_retriever(search_kwargs={"k": 3})  # top 3 chunks
-
-
 # def t(text: str) -> str:
 #     """Translate static UI text into user’s chosen language."""
 #     lang = st.session_state.get('lang', 'en')
@@ -162,12 +151,6 @@ retriever = vectorstore.as_retriever(search_kwargs={"k": 3})  # top 3 chunks
 
 
 
-def get_relevant_guidelines(user_prompt):
-    # Retrieve top chunks based on user prompt
-    docs = retriever.get_relevant_documents(user_prompt)
-    guideline_texts = "\n\n".join([doc.page_content for doc in docs])
-    return guideline_texts
-
 def logout_button():
     st.sidebar.markdown("---")
     if st.sidebar.button("🚪 Logout"):
@@ -175,85 +158,6 @@ def logout_button():
             del st.session_state[key]
         st.experimental_rerun()
 
-def get_latest_summaries(user_id):
-    query = """
-    SELECT r1.report_type, r1.report_data
-    FROM reports r1
-    INNER JOIN (
-        SELECT report_type, MAX(report_date) AS max_date
-        FROM reports
-        WHERE user_id = ?
-        GROUP BY report_type
-    ) r2
-    ON r1.report_type = r2.report_type AND r1.report_date = r2.max_date
-    WHERE r1.user_id = ?
-    """
-    cursor.execute(query, (user_id, user_id))
-    rows = cursor.fetchall()
-    return {row[0]: row[1] for row in rows}
-
-def get_user_health_profile(user_id):
-    query = """
-    SELECT weight, height, blood_group, blood_pressure, heart_rate, chronic_diseases,
-           family_history, allergies, medications, diet, water_intake, sleep, smoking, alcohol
-    FROM user_health_profile
-    WHERE user_id = ?
-    """
-    cursor.execute(query, (user_id,))
-    row = cursor.fetchone()
-    if not row:
-        return None
-    keys = ['weight', 'height', 'blood_group', 'blood_pressure', 'heart_rate',
-            'chronic_diseases', 'family_history', 'allergies', 'medications',
-            'diet', 'water_intake', 'sleep', 'smoking', 'alcohol']
-    return dict(zip(keys, row))
-
-def generate_diet_prompt(health_profile, summaries):
-    summary_str = "\n\n".join([f"{k} Report Summary:\n{v}" for k, v in summaries.items()])
-    health_str = "\n".join([f"{k.replace('_', ' ').capitalize()}: {v}" for k, v in health_profile.items()])
-    
-    # 🔥 New: Retrieve guidelines
-    query_for_rag = f"{health_str}\n\n{summary_str}"
-    guidelines = get_relevant_guidelines(query_for_rag)
-
-    prompt = f"""You are a medical diet assistant.
-
-Use the following clinical diet guidelines to give recommendations:
-
-=== CLINICAL GUIDELINES ===
-{guidelines}
-
-=== USER MEDICAL REPORT SUMMARIES ===
-{summary_str}
-
-=== USER HEALTH PROFILE ===
-{health_str}
-
-Now, generate a **detailed daily diet plan** for:
-- Breakfast
-- Lunch
-- Snacks
-- Dinner
-
-For each meal, list recommended foods and explain briefly why they are good. 
-Also mention **foods to avoid** and **foods to prefer** with reasoning.
-
-Finally, at the very end, provide a **concise summary table** of the meal plan without explanations. 
-The table should only include the recommended foods for each meal, structured like this:
-
-| Meal      | Recommended Foods |
-|-----------|------------------|
-| Breakfast | ...              |
-| Lunch     | ...              |
-| Snacks    | ...              |
-| Dinner    | ...              |
-
-Make sure the recommendations are medically sound and personalized based on the above inputs.
-"""
-
-    return prompt
-
-
 # -------------------------
 # Streamlit UI
 # -------------------------
@@ -272,23 +176,33 @@ def main():
     st.warning(to_user_language("User not logged in. Please login to view your diet suggestions."))
     return
 
- if st.button(to_user_language("Generate Diet Plan")):
-    health_profile = get_user_health_profile(user_id)
-    if not health_profile:
-        st.error(to_user_language("User health profile not found."))
-    else:
-        summaries = get_latest_summaries(user_id)
-        if not summaries:
-            st.warning(to_user_language("No report summaries found for this user."))
-        else:
-            prompt = generate_diet_prompt(health_profile, summaries)
-            with st.spinner(to_user_language("Generating diet suggestion...")):
-                response = model.invoke(prompt)
-            
-            st.subheader(to_user_language("Recommended Diet Plan 🍽️"))
-            st.markdown(to_user_language(response.content))
+ health_profile = get_user_health_profile(user_id)
+ if not health_profile:
+    st.error(to_user_language("User health profile not found."))
+    return
+ summaries = get_latest_summaries(user_id)
+ if not summaries:
+    st.warning(to_user_language("No report summaries found for this user."))
+    return
 
+ # Precomputed in the background whenever the profile or reports change
+ stored = get_advisory(user_id, "diet", advisory_version(health_profile, summaries))
+ if stored:
+    st.subheader(to_user_language("Recommended Diet Plan 🍽️"))
+    st.markdown(to_user_language(stored["content"]))
+    st.caption(to_user_language(f"Prepared {datetime.fromtimestamp(stored['created_at']):%Y-%m-%d %H:%M} from your latest profile and reports"))
+ elif st.button(to_user_language("Generate Diet Plan")):
+    chunks, cached_at = stream_advisory(user_id, "diet", health_profile, summaries)
+    st.subheader(to_user_language("Recommended Diet Plan 🍽️"))
+    try:
+        st.write_stream(to_user_language_stream(chunks))
+    except LLMUnavailableError as e:
+        st.warning(to_user_language(str(e)))
+        return
+    if cached_at:
+        st.caption(to_user_language(f"⚡ Served from cache (generated {datetime.fromtimestamp(cached_at):%Y-%m-%d %H:%M})"))
 
 
 if __name__ == "__main__":
+    start_workers()
     main()
\ No newline at end of file
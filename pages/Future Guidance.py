@@ -1,9 +1,11 @@
-from config.db_connection import get_connection
 import streamlit as st
-from langchain_huggingface import HuggingFaceEndpoint,ChatHuggingFace
+from datetime import datetime
 from dotenv import load_dotenv
 from langchain_core.prompts import PromptTemplate
-from utils.lan import to_user_language,back_to_english,t
+from utils.lan import to_user_language,to_user_language_stream,back_to_english,t
+from utils.advisories import get_user_health_profile, get_latest_summaries, advisory_version, get_advisory, stream_advisory
+from utils.jobs import start_workers
+from utils.llm import LLMUnavailableError
 
 
 languages = {
@@ -114,80 +116,8 @@ languages = {
 
 
 load_dotenv()
-conn=get_connection()
-cursor=conn.cursor()
-llm=HuggingFaceEndpoint(repo_id="mistralai/Mistral-7B-Instruct-v0.3",
-                        task="text-generation")
-model=ChatHuggingFace(llm=llm)
 
 
-def get_latest_summaries(user_id):
-    query = """
-    SELECT r1.report_type, r1.report_data
-    FROM reports r1
-    INNER JOIN (
-        SELECT report_type, MAX(report_date) AS max_date
-        FROM reports
-        WHERE user_id = ?
-        GROUP BY report_type
-    ) r2
-    ON r1.report_type = r2.report_type AND r1.report_date = r2.max_date
-    WHERE r1.user_id = ?
-    """
-    cursor.execute(query, (user_id, user_id))
-    rows = cursor.fetchall()
-    return {row[0]: row[1] for row in rows}
-
-def get_user_health_profile(user_id):
-    query = """
-    SELECT weight, height, blood_group, blood_pressure, heart_rate, chronic_diseases,
-           family_history, allergies, medications, diet, water_intake, sleep, smoking, alcohol
-    FROM user_health_profile
-    WHERE user_id = ?
-    """
-    cursor.execute(query, (user_id,))
-    row = cursor.fetchone()
-    if not row:
-        return None
-    keys = ['weight', 'height', 'blood_group', 'blood_pressure', 'heart_rate',
-            'chronic_diseases', 'family_history', 'allergies', 'medications',
-            'diet', 'water_intake', 'sleep', 'smoking', 'alcohol']
-    return dict(zip(keys, row))
-
-def generate_guidance_prompt(health_profile, summaries):
-    summary_str = "\n\n".join([f"{k} Report Summary:\n{v}" for k, v in summaries.items()])
-    health_str = "\n".join([f"{k.replace('_', ' ').capitalize()}: {v}" for k, v in health_profile.items()])
-
-    prompt = f"""
-You are an expert medical advisor and preventive healthcare assistant.
-
-A user has shared their detailed medical report summaries and personal health profile. Your task is to perform the following:
-
-1. **Risk Prediction**:
-   - Analyze the user's medical reports and health profile to identify potential **future diseases or complications** they might be at risk for.
-   - Give reasoning based on data like age,gender,blood pressure, heart rate, chronic diseases, and report summaries.
-
-2. **Preventive Measures & Lifestyle Recommendations**:
-   - For each risk, suggest **preventive actions**, **foods to avoid**, **dietary changes**, **hydration**, and **stress management techniques**.
-   - Mention daily/weekly **exercise routines** suitable for the person’s current condition (consider age, existing diseases, weight, etc.).
-   - Specify how much sleep they should ideally get and if any habits like smoking/alcohol should be reduced or stopped.
-
-3. **Consequences if not followed**:
-   - Based on the current data, what can happen in the future if the suggested plan is not followed (brief summary).
-
-Use the sections below to extract the necessary information.
-
-=== USER MEDICAL REPORT SUMMARIES ===
-{summary_str}
-
-=== USER HEALTH PROFILE ===
-{health_str}
-
-Generate a complete, actionable and structured health advisory with clear headings. Be medically grounded yet easy to understand for the user.
-"""
-
-    return prompt
-
 # -------------------------
 # Streamlit UI
 # -------------------------
@@ -207,22 +137,33 @@ def main():
     st.warning(to_user_language("User not logged in. Please login to view your diet suggestions."))
     return
 
- if st.button(to_user_language("Generate Future Guidance")):
-    health_profile = get_user_health_profile(user_id)
-    if not health_profile:
-        st.error(to_user_language("User health profile not found."))
-    else:
-        summaries = get_latest_summaries(user_id)
-        if not summaries:
-            st.warning(to_user_language("No report summaries found for this user."))
-        else:
-            prompt = generate_guidance_prompt(health_profile, summaries)
-            with st.spinner(to_user_language("Generating Future Guidance...")):
-                response = model.invoke(prompt)
-            st.subheader(to_user_language("Personalized Future Guidance"))
-            st.markdown(to_user_language(response.content))
+ health_profile = get_user_health_profile(user_id)
+ if not health_profile:
+    st.error(to_user_language("User health profile not found."))
+    return
+ summaries = get_latest_summaries(user_id)
+ if not summaries:
+    st.warning(to_user_language("No report summaries found for this user."))
+    return
 
+ # Precomputed in the background whenever the profile or reports change
+ stored = get_advisory(user_id, "guidance", advisory_version(health_profile, summaries))
+ if stored:
+    st.subheader(to_user_language("Personalized Future Guidance"))
+    st.markdown(to_user_language(stored["content"]))
+    st.caption(to_user_language(f"Prepared {datetime.fromtimestamp(stored['created_at']):%Y-%m-%d %H:%M} from your latest profile and reports"))
+ elif st.button(to_user_language("Generate Future Guidance")):
+    chunks, cached_at = stream_advisory(user_id, "guidance", health_profile, summaries)
+    st.subheader(to_user_language("Personalized Future Guidance"))
+    try:
+        st.write_stream(to_user_language_stream(chunks))
+    except LLMUnavailableError as e:
+        st.warning(to_user_language(str(e)))
+        return
+    if cached_at:
+        st.caption(to_user_language(f"⚡ Served from cache (generated {datetime.fromtimestamp(cached_at):%Y-%m-%d %H:%M})"))
 
 
 if __name__ == "__main__":
+    start_workers()
     main()
\ No newline at end of file
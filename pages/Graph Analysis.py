@@ -2,18 +2,7 @@ import streamlit as st
 import pandas as pd
 import plotly.express as px
 from config.db_connection import get_connection  # adjust this if your import path differs
-
-
-REPORT_TYPE_MAPPING = {
-    "LIVER FUNCTION TEST": "LFT",
-    "LIVER FUNCTION TEST (LFT)": "LFT",
-    "LFT": "LFT",
-    "COMPLETE BLOOD COUNT": "CBC",
-    "CBC": "CBC",
-    "KIDNEY FUNCTION TEST": "KFT",
-    "KFT": "KFT",
-    # Add more as needed
-}
+from utils.lab_parser import REPORT_TYPE_MAPPING
 
 
 def get_user_reports(user_id):
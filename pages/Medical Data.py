@@ -1,46 +1,39 @@
 import streamlit as st
 from config.db_connection import get_connection
-from utils.ocr import extract_and_store
-import tempfile
-import os
+from utils.jobs import enqueue_ingestion, enqueue_advisories, get_job, job_progress, start_workers, DONE_STATES, JOB_POLL_SECONDS
+from utils.llm_cache import invalidate_user
+from utils.ingest_cache import save_upload, upload_display_name
+import time
 from pathlib import Path
 import glob
-from langchain_huggingface import HuggingFaceEndpoint,ChatHuggingFace
-from dotenv import load_dotenv
-from langchain_core.prompts import PromptTemplate
-from langchain_community.vectorstores import faiss
 
 
 def save_pdf(uploaded_file, user_id):
-    # Create a directory per user if not exists
-    save_dir = f"uploaded_reports/{user_id}"
-    os.makedirs(save_dir, exist_ok=True)
-
-    # Save file
-    file_path = os.path.join(save_dir, uploaded_file.name)
-    with open(file_path, "wb") as f:
-        f.write(uploaded_file.getbuffer())
-    
-    return file_path
+    # Saved once under a name derived from its content; reruns return the same path
+    return save_upload(user_id, uploaded_file.name, uploaded_file.getbuffer())
 
-def generate_summary(report_data):
-    llm=HuggingFaceEndpoint(repo_id="mistralai/Mistral-7B-Instruct-v0.3",
-                        task="text-generation")
-    model=ChatHuggingFace(llm=llm)
-    summary_prompt = PromptTemplate.from_template("""
-    You are a medical assistant AI.
 
-    The following is the raw medical report texts from a user. Summarize the overall findings, trends, or any red flags.
-    Provide a clean and professional medical summary.
+def show_ingest_status():
+    """Shows the progress of the last queued report."""
+    job_id = st.session_state.get("ingest_job_id")
+    job = get_job(job_id) if job_id else None
+    if job is None:
+        return
+    fraction, label = job_progress(job)
+    st.progress(fraction, text=label)
+    if job["state"] == "failed":
+        st.error("❌ Could not process the report. Use 🔁 Force reprocess to try again.")
+    elif job["state"] == "stored" and (job["result"] or {}).get("status") == "existing":
+        st.info("ℹ️ This report was already processed.")
 
-    Reports:
-    {report_data}
 
-    --- Medical Summary ---
-    """)
-    summary_chain = summary_prompt | model
-    summary_response = summary_chain.invoke({"report_data": report_data})
-    summary_text = summary_response.content.strip()
+def poll_ingest_status():
+    # Rerun shortly while a report is being processed, so progress updates on its own
+    job_id = st.session_state.get("ingest_job_id")
+    job = get_job(job_id) if job_id else None
+    if job and job["state"] not in DONE_STATES:
+        time.sleep(JOB_POLL_SECONDS)
+        st.rerun()
 
 
 def get_medical_data(user_id):
@@ -62,7 +55,7 @@ def show_uploaded_pdfs(user_id):
             st.info("No reports uploaded yet.")
         else:
             for pdf_path in pdf_files:
-                file_name = os.path.basename(pdf_path)
+                file_name = upload_display_name(pdf_path)
                 with open(pdf_path, "rb") as f:
                     st.download_button(label=f"📄 {file_name}",
                                        data=f,
@@ -100,6 +93,8 @@ def update_medical_data(user_id, weight, height, blood_group, blood_pressure, he
     
     conn.commit()
     conn.close()
+    invalidate_user(user_id)
+    enqueue_advisories(user_id)
 
 def medical_data_page():
     st.set_page_config(page_title="Medical Data", page_icon="🏥", layout="wide")
@@ -135,17 +130,18 @@ def medical_data_page():
         uploaded_file = st.file_uploader("Choose a PDF file", type=["pdf"])
 
         if uploaded_file is not None:
-            save_pdf(uploaded_file,user_id)
+            file_path = save_pdf(uploaded_file,user_id)
             st.success(f"✅ Uploaded: {uploaded_file.name}")
-            with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp_file:
-                tmp_file.write(uploaded_file.read())
-                temp_path = tmp_file.name
-            extract_and_store(user_id, path=temp_path)
+            # Queued by file hash, so reruns with the same file reuse the same job
+            force = st.button("🔁 Force reprocess")
+            st.session_state.ingest_job_id = enqueue_ingestion(user_id, file_path, force=force)
+        show_ingest_status()
         
         if st.button("Edit Information"):
             st.session_state.edit_mode = True
 
         show_uploaded_pdfs(user_id)
+        poll_ingest_status()
         return
 
    
@@ -174,4 +170,5 @@ def medical_data_page():
     
 
 # Entry point for the Streamlit page
+start_workers()
 medical_data_page()
@@ -1,4 +1,3 @@
-from langchain_huggingface import ChatHuggingFace,HuggingFaceEndpoint
 from langchain_core.prompts import PromptTemplate
 from dotenv import load_dotenv
 import streamlit as st
@@ -7,13 +6,11 @@ from config.db_connection import get_connection
 from langchain_community.document_loaders import PyPDFLoader  
 from langchain_core.output_parsers import StrOutputParser
 from utils.ocr import extract_text_from_report,generate_summary
+from utils.llm import stream
 
 load_dotenv()
 conn=get_connection()
 cursor=conn.cursor()
-llm=HuggingFaceEndpoint(repo_id="mistralai/Mistral-7B-Instruct-v0.3",
-                        task="text-generation")
-model=ChatHuggingFace(llm=llm)
 
 
 def summarizer(path):
@@ -25,7 +22,7 @@ Be precise, medically relevant, and avoid guessing beyond the data provided.
 Output must be clear, structured, and divided into the following sections:  
 
 Medical Report:
-{{medical_report_text}}
+{medical_report_text}
 
 Instructions:  
 1. **Summary of Key Findings**  
@@ -51,9 +48,8 @@ Instructions:
 Make sure explanations are concise, medically sound, and well-structured.  
 """,input_variables=["medical_report_text"])
     
-    prompt=prompt_template.format(input={"medical_report_text":text})
-    results=model.invoke(prompt)
-    return results.content
+    prompt=prompt_template.format(medical_report_text=text)
+    return stream(prompt)
 
 def main():
     st.set_page_config(page_title="Report Analyzer", page_icon="📊", layout="wide")
@@ -65,12 +61,12 @@ def main():
             temp_file.write(uploaded_file.read())
             temp_path = temp_file.name
         
-        with st.spinner("🧠 Analyzing the report and generating summary..."):
-            try:
+        try:
+            with st.spinner("🧠 Reading the report..."):
                 summary = summarizer(temp_path)  # ✅ Call summarizer with temp_path
-                st.markdown("### 📝 Summary & Suggestions:")
-                st.write(summary)
-            except Exception as e:
-                st.error(f"❌ Error during summarization: {str(e)}")
+            st.markdown("### 📝 Summary & Suggestions:")
+            st.write_stream(summary)
+        except Exception as e:
+            st.error(f"❌ Error during summarization: {str(e)}")
 
 main()
\ No newline at end of file
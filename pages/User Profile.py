@@ -1,23 +1,39 @@
 import streamlit as st
 import pyodbc
-import os
 from datetime import datetime
 from utils.db_profile import get_user_health_profile, save_user_health_profile
-from utils.ocr import extract_and_store
+from utils.ocr import sniff_file_type
+from utils.ingest_cache import save_upload, upload_display_name
+from utils.jobs import enqueue_ingestion, get_job, job_progress, start_workers, DONE_STATES, JOB_POLL_SECONDS
 import tempfile
+import time
 from config.db_connection import get_connection
 
 def save_pdf(uploaded_file, user_id):
-    # Create a directory per user if not exists
-    save_dir = f"uploaded_reports/{user_id}"
-    os.makedirs(save_dir, exist_ok=True)
-
-    # Save file
-    file_path = os.path.join(save_dir, uploaded_file.name)
-    with open(file_path, "wb") as f:
-        f.write(uploaded_file.getbuffer())
-    
-    return file_path
+    # Saved once under a name derived from its content; reruns return the same path
+    return save_upload(user_id, uploaded_file.name, uploaded_file.getbuffer())
+
+
+def show_ingest_status():
+    """Shows the progress of the last queued reports."""
+    for job_id in st.session_state.get("ingest_job_ids", []):
+        job = get_job(job_id)
+        if job is None:
+            continue
+        fraction, label = job_progress(job)
+        st.progress(fraction, text=label)
+        if job["state"] == "failed":
+            st.error("❌ Could not process the report. Use 🔁 Force reprocess to try again.")
+        elif job["state"] == "stored" and (job["result"] or {}).get("status") == "existing":
+            st.info("ℹ️ This report was already processed.")
+
+
+def poll_ingest_status():
+    # Rerun shortly while reports are being processed, so progress updates on its own
+    jobs = [get_job(job_id) for job_id in st.session_state.get("ingest_job_ids", [])]
+    if any(job and job["state"] not in DONE_STATES for job in jobs):
+        time.sleep(JOB_POLL_SECONDS)
+        st.rerun()
 
 
 # Get user data by ID
@@ -98,15 +114,20 @@ def show_profile():
             st.rerun()
     # Upload medical report
     st.subheader("📤 Upload Medical Report")
-    uploaded_file = st.file_uploader("Choose a file (PDF, JPG, PNG)", type=["pdf", "jpg", "png"])
-
-    if uploaded_file is not None:
-        save_pdf(uploaded_file,user_id)
-        st.success(f"✅ Uploaded: {uploaded_file.name}")
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp_file:
-            tmp_file.write(uploaded_file.read())
-            temp_path = tmp_file.name
-        extract_and_store(user_id, path=temp_path)
+    uploaded_files = st.file_uploader("Choose files (PDF, JPG, PNG) — photos of one report's pages can be uploaded together",
+                                      type=["pdf", "jpg", "jpeg", "png"], accept_multiple_files=True)
+
+    if uploaded_files:
+        file_paths = [save_pdf(uploaded_file,user_id) for uploaded_file in uploaded_files]
+        st.success(f"✅ Uploaded: {', '.join(f.name for f in uploaded_files)}")
+        # Each PDF is its own report; all photos together make up one report
+        pdfs = [p for p in file_paths if sniff_file_type(p) == "pdf"]
+        images = [p for p in file_paths if p not in pdfs]
+        uploads = [[p] for p in pdfs] + ([images] if images else [])
+        # Queued by file hash, so reruns with the same files reuse the same jobs
+        force = st.button("🔁 Force reprocess")
+        st.session_state.ingest_job_ids = [enqueue_ingestion(user_id, paths, force=force) for paths in uploads]
+    show_ingest_status()
         
     if st.button("Edit Information"):
         st.session_state.edit_mode = True
@@ -116,9 +137,11 @@ def show_profile():
     reports = get_user_reports(user_id)
     if reports:
         for report_type, report_date, report_data in reports:
-            st.markdown(f"📁 **{os.path.basename(report_data)}** ({report_type}) — uploaded on {report_date.strftime('%Y-%m-%d %H:%M')}")
+            st.markdown(f"📁 **{upload_display_name(report_data)}** ({report_type}) — uploaded on {report_date.strftime('%Y-%m-%d %H:%M')}")
     else:
         st.info("No reports uploaded yet.")
+    poll_ingest_status()
 
+start_workers()
 show_profile()
 
@@ -0,0 +1,284 @@
+import hashlib
+import json
+import threading
+import time
+from config.db_connection import get_connection, get_local_connection
+from utils.llm import generate_cached, stream_cached
+from utils.prompt_budget import assemble_prompt
+from utils.embeddings import get_embeddings
+
+# ---------------------------
+# Personalized advisories
+# ---------------------------
+# Diet plans and future guidance depend only on the user's health profile and
+# their latest report of each type. They are regenerated by an "advisories"
+# background job whenever either changes and stored with a version stamp (a
+# hash of those inputs), so the pages can show them immediately and only
+# generate live when the stored version is stale.
+GUIDELINES_INDEX_DIR = "faiss_index"
+
+
+# ---------------------------
+# Inputs
+# ---------------------------
+
+def get_latest_summaries(user_id):
+    query = """
+    SELECT r1.report_type, r1.report_data
+    FROM reports r1
+    INNER JOIN (
+        SELECT report_type, MAX(report_date) AS max_date
+        FROM reports
+        WHERE user_id = ?
+        GROUP BY report_type
+    ) r2
+    ON r1.report_type = r2.report_type AND r1.report_date = r2.max_date
+    WHERE r1.user_id = ?
+    """
+    conn = get_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(query, (user_id, user_id))
+        rows = cursor.fetchall()
+    finally:
+        conn.close()
+    return {row[0]: row[1] for row in rows}
+
+
+def get_user_health_profile(user_id):
+    query = """
+    SELECT weight, height, blood_group, blood_pressure, heart_rate, chronic_diseases,
+           family_history, allergies, medications, diet, water_intake, sleep, smoking, alcohol
+    FROM user_health_profile
+    WHERE user_id = ?
+    """
+    conn = get_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(query, (user_id,))
+        row = cursor.fetchone()
+    finally:
+        conn.close()
+    if not row:
+        return None
+    keys = ['weight', 'height', 'blood_group', 'blood_pressure', 'heart_rate',
+            'chronic_diseases', 'family_history', 'allergies', 'medications',
+            'diet', 'water_intake', 'sleep', 'smoking', 'alcohol']
+    return dict(zip(keys, row))
+
+
+def advisory_version(health_profile, summaries):
+    """Version stamp of the inputs an advisory was generated from."""
+    payload = json.dumps({"profile": health_profile, "summaries": summaries}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+# ---------------------------
+# Prompts
+# ---------------------------
+_guidelines_retriever = None
+_guidelines_lock = threading.Lock()
+
+
+def _get_guidelines_retriever():
+    """Loads the clinical diet guidelines index (built by utils/rag.py) on first use."""
+    global _guidelines_retriever
+    with _guidelines_lock:
+        if _guidelines_retriever is None:
+            from utils.vector_store import load_store
+            vectorstore = load_store(GUIDELINES_INDEX_DIR, get_embeddings())
+            _guidelines_retriever = vectorstore.as_retriever(search_kwargs={"k": 3})  # top 3 chunks
+        return _guidelines_retriever
+
+
+def get_relevant_guidelines(user_prompt):
+    """Returns the text of the guideline chunks most relevant to the prompt, best first."""
+    docs = _get_guidelines_retriever().invoke(user_prompt)
+    return [doc.page_content for doc in docs]
+
+
+def _summary_items(summaries):
+    return [f"{k} Report Summary:\n{v}" for k, v in summaries.items()]
+
+
+def _profile_items(health_profile):
+    return [f"{k.replace('_', ' ').capitalize()}: {v}" for k, v in health_profile.items()]
+
+
+# Trimmed in reverse priority order when a prompt is over budget: guideline
+# chunks go first (least relevant first, keeping about the best one), then
+# every summary is shortened evenly; the profile is short and kept whole
+def _profile_section(health_profile):
+    return {"name": "health_str", "items": _profile_items(health_profile), "priority": 0, "joiner": "\n"}
+
+
+def _summaries_section(summaries):
+    return {"name": "summary_str", "items": _summary_items(summaries), "priority": 1, "trim": "shrink",
+            "min_tokens": 300}
+
+
+DIET_PROMPT = """You are a medical diet assistant.
+
+Use the following clinical diet guidelines to give recommendations:
+
+=== CLINICAL GUIDELINES ===
+{guidelines}
+
+=== USER MEDICAL REPORT SUMMARIES ===
+{summary_str}
+
+=== USER HEALTH PROFILE ===
+{health_str}
+
+Now, generate a **detailed daily diet plan** for:
+- Breakfast
+- Lunch
+- Snacks
+- Dinner
+
+For each meal, list recommended foods and explain briefly why they are good.
+Also mention **foods to avoid** and **foods to prefer** with reasoning.
+
+Finally, at the very end, provide a **concise summary table** of the meal plan without explanations.
+The table should only include the recommended foods for each meal, structured like this:
+
+| Meal      | Recommended Foods |
+|-----------|------------------|
+| Breakfast | ...              |
+| Lunch     | ...              |
+| Snacks    | ...              |
+| Dinner    | ...              |
+
+Make sure the recommendations are medically sound and personalized based on the above inputs.
+"""
+
+GUIDANCE_PROMPT = """
+You are an expert medical advisor and preventive healthcare assistant.
+
+A user has shared their detailed medical report summaries and personal health profile. Your task is to perform the following:
+
+1. **Risk Prediction**:
+   - Analyze the user's medical reports and health profile to identify potential **future diseases or complications** they might be at risk for.
+   - Give reasoning based on data like age,gender,blood pressure, heart rate, chronic diseases, and report summaries.
+
+2. **Preventive Measures & Lifestyle Recommendations**:
+   - For each risk, suggest **preventive actions**, **foods to avoid**, **dietary changes**, **hydration**, and **stress management techniques**.
+   - Mention daily/weekly **exercise routines** suitable for the person’s current condition (consider age, existing diseases, weight, etc.).
+   - Specify how much sleep they should ideally get and if any habits like smoking/alcohol should be reduced or stopped.
+
+3. **Consequences if not followed**:
+   - Based on the current data, what can happen in the future if the suggested plan is not followed (brief summary).
+
+Use the sections below to extract the necessary information.
+
+=== USER MEDICAL REPORT SUMMARIES ===
+{summary_str}
+
+=== USER HEALTH PROFILE ===
+{health_str}
+
+Generate a complete, actionable and structured health advisory with clear headings. Be medically grounded yet easy to understand for the user.
+"""
+
+
+def generate_diet_prompt(health_profile, summaries):
+    profile = _profile_section(health_profile)
+    summary_section = _summaries_section(summaries)
+    query_for_rag = "\n".join(profile["items"]) + "\n\n" + "\n\n".join(summary_section["items"])
+    guidelines = {"name": "guidelines", "items": get_relevant_guidelines(query_for_rag), "priority": 2,
+                  "min_tokens": 300}
+    return assemble_prompt(DIET_PROMPT, [profile, summary_section, guidelines], label="diet")
+
+
+def generate_guidance_prompt(health_profile, summaries):
+    return assemble_prompt(GUIDANCE_PROMPT, [_profile_section(health_profile), _summaries_section(summaries)],
+                           label="guidance")
+
+
+ADVISORY_PROMPTS = {"diet": generate_diet_prompt, "guidance": generate_guidance_prompt}
+
+
+# ---------------------------
+# Storage
+# ---------------------------
+
+def _connect():
+    conn = get_local_connection("advisories")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS advisories (
+            user_id INTEGER,
+            kind TEXT,
+            version TEXT,
+            content TEXT,
+            created_at REAL,
+            PRIMARY KEY (user_id, kind)
+        )
+    """)
+    return conn
+
+
+def get_advisory(user_id, kind, version):
+    """Returns the stored advisory {"content", "created_at"} if it was generated from this version, else None."""
+    conn = _connect()
+    try:
+        row = conn.execute(
+            "SELECT content, created_at FROM advisories WHERE user_id = ? AND kind = ? AND version = ?",
+            (user_id, kind, version),
+        ).fetchone()
+    finally:
+        conn.close()
+    return {"content": row[0], "created_at": row[1]} if row else None
+
+
+def save_advisory(user_id, kind, version, content):
+    conn = _connect()
+    try:
+        conn.execute(
+            "INSERT OR REPLACE INTO advisories (user_id, kind, version, content, created_at) VALUES (?, ?, ?, ?, ?)",
+            (user_id, kind, version, content, time.time()),
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+
+# ---------------------------
+# Generation
+# ---------------------------
+
+def precompute_advisories(user_id, kinds=None):
+    """Regenerates the user's advisories whose stored version is stale. Returns the kinds regenerated."""
+    health_profile = get_user_health_profile(user_id)
+    summaries = get_latest_summaries(user_id)
+    if not health_profile or not summaries:
+        return []
+    version = advisory_version(health_profile, summaries)
+    regenerated = []
+    for kind in kinds or ADVISORY_PROMPTS:
+        if get_advisory(user_id, kind, version):
+            continue
+        start = time.time()
+        text, _ = generate_cached(ADVISORY_PROMPTS[kind](health_profile, summaries), user_id=user_id)
+        save_advisory(user_id, kind, version, text)
+        regenerated.append(kind)
+        print(f"🥗 Precomputed {kind} advisory for user {user_id} in {time.time() - start:.1f}s")
+    return regenerated
+
+
+def stream_advisory(user_id, kind, health_profile, summaries):
+    """
+    Live fallback for a stale or missing advisory: streams it from the model
+    and stores it under the current version once complete.
+    Returns (chunks, cached_at) like stream_cached().
+    """
+    version = advisory_version(health_profile, summaries)
+    chunks, cached_at = stream_cached(ADVISORY_PROMPTS[kind](health_profile, summaries), user_id=user_id)
+
+    def stored_chunks():
+        parts = []
+        for part in chunks:
+            parts.append(part)
+            yield part
+        save_advisory(user_id, kind, version, "".join(parts))
+
+    return stored_chunks(), cached_at
@@ -1,6 +1,7 @@
 from langchain_community.vectorstores import FAISS
 from dotenv import load_dotenv
-from langchain_huggingface import ChatHuggingFace, HuggingFaceEmbeddings
+from langchain_huggingface import ChatHuggingFace
+from utils.embeddings import get_embeddings
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain.memory import ConversationBufferMemory
 from langchain.schema import Document
@@ -17,4 +18,4 @@ def build_knowldeg_base(summary_str,health_str):
     splitter=RecursiveCharacterTextSplitter(chunk_size=500,chunk_overlap=50)
     chunks=splitter.split_documents(docs)
 
-    embeddings=HuggingFaceEmbeddings(model_name="all-MiniLM-L6-v2")
\ No newline at end of file
+    embeddings=get_embeddings()
\ No newline at end of file
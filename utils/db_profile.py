@@ -1,5 +1,7 @@
 from config.db_connection import get_connection
 from dotenv import load_dotenv
+from utils.llm_cache import invalidate_user
+from utils.jobs import enqueue_advisories
 
 def get_user_health_profile(user_id):
     conn = get_connection()
@@ -48,4 +50,6 @@ def save_user_health_profile(user_id, weight, height, blood_group, blood_pressur
 
     cursor.execute(query, values)
     conn.commit()
-    conn.close()
\ No newline at end of file
+    conn.close()
+    invalidate_user(user_id)
+    enqueue_advisories(user_id)
\ No newline at end of file
@@ -0,0 +1,137 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from langchain_core.embeddings import Embeddings
+
+# ---------------------------
+# Shared embedding service
+# ---------------------------
+# One sentence-transformers model per process, used by every vector store
+# (Streamlit re-executes page scripts, so models created there were reloaded
+# on every rerun). Encode requests go through a single batcher thread that
+# merges concurrent requests, encodes each distinct text once, and hands the
+# vectors back to the callers.
+EMBED_MODEL = os.getenv("EMBED_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "64"))
+# Requests arriving within this window of each other are encoded together
+EMBED_BATCH_WAIT_MS = float(os.getenv("EMBED_BATCH_WAIT_MS", "5"))
+# Upper bound on distinct texts merged into one encode call
+EMBED_MAX_BATCH_TEXTS = int(os.getenv("EMBED_MAX_BATCH_TEXTS", "512"))
+# Torch intra-op threads for encoding; 0 leaves torch's default
+EMBED_THREADS = int(os.getenv("EMBED_THREADS", "0"))
+
+_model = None
+_model_lock = threading.Lock()
+_requests = queue.Queue()
+_batcher_started = False
+_stats_lock = threading.Lock()
+_stats = {"requests": 0, "texts": 0, "encoded": 0, "batches": 0, "encode_seconds": 0.0}
+
+
+def _get_model():
+    global _model
+    with _model_lock:
+        if _model is None:
+            from sentence_transformers import SentenceTransformer
+            if EMBED_THREADS > 0:
+                import torch
+                torch.set_num_threads(EMBED_THREADS)
+            start = time.time()
+            _model = SentenceTransformer(EMBED_MODEL)
+            print(f"✅ Embedding model {EMBED_MODEL} loaded in {time.time() - start:.1f}s")
+        return _model
+
+
+def _next_batch():
+    """Blocks for one request, then gathers whatever else arrives within the batching window."""
+    batch = [_requests.get()]
+    texts = len(batch[0][0])
+    deadline = time.perf_counter() + EMBED_BATCH_WAIT_MS / 1000
+    while texts < EMBED_MAX_BATCH_TEXTS:
+        remaining = deadline - time.perf_counter()
+        try:
+            request = _requests.get(timeout=remaining) if remaining > 0 else _requests.get_nowait()
+        except queue.Empty:
+            break
+        batch.append(request)
+        texts += len(request[0])
+    return batch
+
+
+def _batch_forever():
+    while True:
+        batch = _next_batch()
+        unique = list(dict.fromkeys(text for texts, _ in batch for text in texts))
+        try:
+            start = time.perf_counter()
+            vectors = _get_model().encode(unique, batch_size=EMBED_BATCH_SIZE, show_progress_bar=False)
+            seconds = time.perf_counter() - start
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            continue
+        by_text = {text: vector.tolist() for text, vector in zip(unique, vectors)}
+        for texts, future in batch:
+            future.set_result([by_text[text] for text in texts])
+        with _stats_lock:
+            _stats["requests"] += len(batch)
+            _stats["texts"] += sum(len(texts) for texts, _ in batch)
+            _stats["encoded"] += len(unique)
+            _stats["batches"] += 1
+            _stats["encode_seconds"] += seconds
+
+
+def _start_batcher():
+    global _batcher_started
+    with _model_lock:
+        if _batcher_started:
+            return
+        _batcher_started = True
+    threading.Thread(target=_batch_forever, daemon=True, name="embedding-batcher").start()
+
+
+def embed_texts(texts):
+    """Returns one embedding (list of floats) per text, encoded together with other concurrent requests."""
+    texts = list(texts)
+    if not texts:
+        return []
+    _start_batcher()
+    future = Future()
+    _requests.put((texts, future))
+    return future.result()
+
+
+class SharedEmbeddings(Embeddings):
+    """LangChain embeddings backed by the shared model and batcher."""
+
+    def embed_documents(self, texts):
+        return embed_texts(texts)
+
+    def embed_query(self, text):
+        return embed_texts([text])[0]
+
+
+_embeddings = SharedEmbeddings()
+
+
+def get_embeddings():
+    """The process-wide embeddings object to pass to vector stores."""
+    return _embeddings
+
+
+def warm_up_embeddings():
+    _get_model()
+
+
+def embedding_stats():
+    """Request/batch counts, texts saved by deduplication and encoding throughput in chunks per second."""
+    with _stats_lock:
+        stats = dict(_stats)
+    stats["deduplicated"] = stats["texts"] - stats["encoded"]
+    stats["avg_batch"] = round(stats["encoded"] / stats["batches"], 1) if stats["batches"] else None
+    stats["chunks_per_second"] = (round(stats["encoded"] / stats["encode_seconds"], 1)
+                                  if stats["encode_seconds"] else None)
+    stats["encode_seconds"] = round(stats["encode_seconds"], 3)
+    return stats
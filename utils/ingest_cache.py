@@ -0,0 +1,131 @@
+import hashlib
+import json
+import os
+import re
+import tempfile
+from config.db_connection import get_local_connection
+
+# Ingestion results keyed by the SHA-256 of the uploaded file's bytes, so a
+# re-upload (or a Streamlit rerun with the same file) skips OCR and the LLM.
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# Uploads are saved as uploaded_reports/<user_id>/<sha256 prefix>_<name>. A path
+# only ever holds one content and is written once (temp file + rename), so a job
+# worker reading it can't see a half-written file when the page reruns.
+UPLOAD_DIR = "uploaded_reports"
+_UPLOAD_PREFIX = re.compile(r"^[0-9a-f]{16}_")
+
+
+def save_upload(user_id, name, data):
+    """Stores uploaded bytes for the user and returns their path, skipping the write if they are already there."""
+    sha = hashlib.sha256(data).hexdigest()
+    save_dir = os.path.join(UPLOAD_DIR, str(user_id))
+    os.makedirs(save_dir, exist_ok=True)
+    path = os.path.join(save_dir, f"{sha[:16]}_{os.path.basename(name)}")
+    if os.path.exists(path) and file_sha256(path) == sha:
+        return path
+    fd, tmp = tempfile.mkstemp(dir=save_dir, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+    return path
+
+
+def upload_display_name(path):
+    """The name a file was uploaded under, without the hash prefix save_upload() adds."""
+    return _UPLOAD_PREFIX.sub("", os.path.basename(path))
+
+
+def content_sha256(paths):
+    """Hash of an upload: the file's own hash, or a combined hash for a multi-file report."""
+    if isinstance(paths, (str, os.PathLike)):
+        return file_sha256(paths)
+    if len(paths) == 1:
+        return file_sha256(paths[0])
+    return hashlib.sha256("\n".join(file_sha256(p) for p in paths).encode()).hexdigest()
+
+
+def _connect():
+    conn = get_local_connection("ingest_cache")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS ingested_files (
+            sha256 TEXT PRIMARY KEY,
+            ocr_text TEXT,
+            summary TEXT,
+            report_json TEXT,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS ingested_reports (
+            sha256 TEXT,
+            user_id INTEGER,
+            report_id INTEGER,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (sha256, user_id)
+        )
+    """)
+    return conn
+
+
+def get_cached_result(sha256):
+    """Returns the cached OCR text, summary and extracted report JSON for a file, or None."""
+    conn = _connect()
+    try:
+        row = conn.execute(
+            "SELECT ocr_text, summary, report_json FROM ingested_files WHERE sha256 = ?", (sha256,)
+        ).fetchone()
+    finally:
+        conn.close()
+    if not row:
+        return None
+    return {"ocr_text": row[0], "summary": row[1], "report_data": json.loads(row[2])}
+
+
+def save_result(sha256, ocr_text, summary, report_data):
+    conn = _connect()
+    try:
+        conn.execute(
+            "INSERT OR REPLACE INTO ingested_files (sha256, ocr_text, summary, report_json) VALUES (?, ?, ?, ?)",
+            (sha256, ocr_text, summary, json.dumps(report_data)),
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def get_user_report(sha256, user_id):
+    """Returns the report_id this user already has for the file, or None."""
+    conn = _connect()
+    try:
+        row = conn.execute(
+            "SELECT report_id FROM ingested_reports WHERE sha256 = ? AND user_id = ?", (sha256, user_id)
+        ).fetchone()
+    finally:
+        conn.close()
+    return row[0] if row else None
+
+
+def link_user_report(sha256, user_id, report_id):
+    conn = _connect()
+    try:
+        conn.execute(
+            "INSERT OR REPLACE INTO ingested_reports (sha256, user_id, report_id) VALUES (?, ?, ?)",
+            (sha256, user_id, report_id),
+        )
+        conn.commit()
+    finally:
+        conn.close()
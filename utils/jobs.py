@@ -0,0 +1,422 @@
+import functools
+import json
+import os
+import random
+import sys
+import threading
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from config.db_connection import get_local_connection
+from utils.ingest_cache import content_sha256
+
+# ---------------------------
+# Background job queue
+# ---------------------------
+# Jobs live in local_db/jobs.sqlite3, so they survive browser refreshes and app
+# restarts. A dispatcher thread claims queued jobs and runs them on a pool of
+# JOB_WORKERS processes; pages enqueue a job and poll get_job() for its state.
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_RETRY_BASE_SECONDS = float(os.getenv("JOB_RETRY_BASE_SECONDS", "5"))
+# Workers refresh a running job's updated_at every JOB_HEARTBEAT_SECONDS; a job
+# not heard from for JOB_STALE_SECONDS is assumed to have lost its worker and is requeued
+JOB_HEARTBEAT_SECONDS = float(os.getenv("JOB_HEARTBEAT_SECONDS", "30"))
+JOB_STALE_SECONDS = float(os.getenv("JOB_STALE_SECONDS", "300"))
+JOB_POLL_SECONDS = float(os.getenv("JOB_POLL_SECONDS", "1"))
+# Worker processes load the OCR reader when they start, not on their first report
+OCR_WARMUP = os.getenv("OCR_WARMUP", "true").lower() == "true"
+# Each process (Streamlit and every job worker) logs its OCR, cache, LLM, embedding and
+# vector store counters every STATS_LOG_SECONDS when they changed; 0 turns the log line off
+STATS_LOG_SECONDS = float(os.getenv("STATS_LOG_SECONDS", "300"))
+
+QUEUED, OCR, SUMMARIZING, EXTRACTING, ADVISORIES, STORED, FAILED = (
+    "queued", "ocr", "summarizing", "extracting", "advisories", "stored", "failed")
+RUNNING_STATES = (OCR, SUMMARIZING, EXTRACTING, ADVISORIES)
+DONE_STATES = (STORED, FAILED)
+
+# The state a job of each kind starts in when a worker claims it
+FIRST_STAGE = {"ingest": OCR, "advisories": ADVISORIES}
+
+# Rough share of the work finished when a job enters each state, for progress bars
+STATE_PROGRESS = {QUEUED: 0.0, OCR: 0.1, SUMMARIZING: 0.5, EXTRACTING: 0.75, ADVISORIES: 0.5, STORED: 1.0, FAILED: 1.0}
+
+
+def _connect():
+    conn = get_local_connection("jobs")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS jobs (
+            job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            user_id INTEGER,
+            payload TEXT,
+            dedupe_key TEXT,
+            state TEXT NOT NULL,
+            attempts INTEGER DEFAULT 0,
+            timings TEXT DEFAULT '{}',
+            result TEXT,
+            error TEXT,
+            run_after REAL DEFAULT 0,
+            created_at REAL,
+            updated_at REAL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, run_after)")
+    conn.execute("CREATE INDEX IF NOT EXISTS jobs_dedupe ON jobs (dedupe_key)")
+    return conn
+
+
+def _row_to_job(cursor, row):
+    job = dict(zip([d[0] for d in cursor.description], row))
+    for key in ("payload", "timings", "result"):
+        if job.get(key):
+            job[key] = json.loads(job[key])
+    return job
+
+
+def enqueue(kind, user_id, payload, dedupe_key=None, reuse_done=False, reuse_failed=False):
+    """
+    Adds a job and returns its id. If a job with the same dedupe_key is still
+    queued or running (or finished successfully, with reuse_done, or failed
+    for good, with reuse_failed) its id is returned instead of adding a duplicate.
+    """
+    conn = _connect()
+    try:
+        if dedupe_key:
+            states = ((QUEUED,) + RUNNING_STATES + ((STORED,) if reuse_done else ())
+                      + ((FAILED,) if reuse_failed else ()))
+            row = conn.execute(
+                f"SELECT job_id FROM jobs WHERE dedupe_key = ? AND state IN ({','.join('?' * len(states))}) "
+                "ORDER BY job_id DESC LIMIT 1",
+                (dedupe_key, *states),
+            ).fetchone()
+            if row:
+                return row[0]
+        now = time.time()
+        cursor = conn.execute(
+            "INSERT INTO jobs (kind, user_id, payload, dedupe_key, state, created_at, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (kind, user_id, json.dumps(payload), dedupe_key, QUEUED, now, now),
+        )
+        conn.commit()
+        return cursor.lastrowid
+    finally:
+        conn.close()
+
+
+def enqueue_ingestion(user_id, path, force=False):
+    """Queues OCR + summary + extraction + storage of an uploaded report.
+    path may be a list of files that together make up one report."""
+    dedupe_key = f"ingest:{user_id}:{content_sha256(path)}"
+    if isinstance(path, (list, tuple)):
+        path = [os.path.abspath(p) for p in path]
+    else:
+        path = os.path.abspath(path)
+    payload = {"path": path, "force": force}
+    # A report that failed all its attempts isn't run again on every rerun; force=True is the retry path
+    return enqueue("ingest", user_id, payload, dedupe_key=dedupe_key, reuse_done=not force, reuse_failed=not force)
+
+
+def enqueue_advisories(user_id):
+    """Queues regeneration of the user's diet and guidance advisories after their data changed."""
+    from utils.advisories import get_user_health_profile, get_latest_summaries, advisory_version
+    health_profile = get_user_health_profile(user_id)
+    summaries = get_latest_summaries(user_id)
+    if not health_profile or not summaries:
+        return None
+    # One job per version of the inputs: saving an unchanged profile doesn't queue another run
+    dedupe_key = f"advisories:{user_id}:{advisory_version(health_profile, summaries)}"
+    return enqueue("advisories", user_id, {}, dedupe_key=dedupe_key, reuse_done=True)
+
+
+def get_job(job_id):
+    conn = _connect()
+    try:
+        cursor = conn.execute("SELECT * FROM jobs WHERE job_id = ?", (job_id,))
+        row = cursor.fetchone()
+        return _row_to_job(cursor, row) if row else None
+    finally:
+        conn.close()
+
+
+def _set_state(job_id, state, **fields):
+    conn = _connect()
+    try:
+        now = time.time()
+        timings = json.loads(conn.execute("SELECT timings FROM jobs WHERE job_id = ?", (job_id,)).fetchone()[0])
+        # timings[stage] = seconds spent in that stage, closed when the next one starts
+        started = timings.pop("_stage_started", None)
+        current = timings.pop("_stage", None)
+        if started is not None and current:
+            timings[current] = round(timings.get(current, 0) + now - started, 3)
+        if state in RUNNING_STATES:
+            timings["_stage"], timings["_stage_started"] = state, now
+
+        sets = {"state": state, "timings": json.dumps(timings), "updated_at": now, **fields}
+        conn.execute(
+            f"UPDATE jobs SET {', '.join(f'{k} = ?' for k in sets)} WHERE job_id = ?",
+            (*sets.values(), job_id),
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def _claim_next_job():
+    """Atomically moves the oldest runnable job out of the queue and returns it."""
+    conn = _connect()
+    try:
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        # Requeue jobs whose worker died mid-run (no heartbeat for JOB_STALE_SECONDS)
+        conn.execute(
+            f"UPDATE jobs SET state = ?, updated_at = ? WHERE state IN ({','.join('?' * len(RUNNING_STATES))}) "
+            "AND updated_at < ?",
+            (QUEUED, now, *RUNNING_STATES, now - JOB_STALE_SECONDS),
+        )
+        cursor = conn.execute(
+            "SELECT * FROM jobs WHERE state = ? AND run_after <= ? ORDER BY job_id LIMIT 1", (QUEUED, now)
+        )
+        row = cursor.fetchone()
+        if row is None:
+            conn.commit()
+            return None
+        job = _row_to_job(cursor, row)
+        timings = {k: v for k, v in (job["timings"] or {}).items() if not k.startswith("_")}
+        stage = FIRST_STAGE.get(job["kind"], OCR)
+        timings["_stage"], timings["_stage_started"] = stage, now
+        conn.execute(
+            "UPDATE jobs SET state = ?, attempts = attempts + 1, timings = ?, updated_at = ? WHERE job_id = ?",
+            (stage, json.dumps(timings), now, job["job_id"]),
+        )
+        conn.commit()
+        job["attempts"] += 1
+        job["state"] = stage
+        return job
+    finally:
+        conn.close()
+
+
+# ---------------------------
+# Job handlers (run in worker processes)
+# ---------------------------
+
+def _run_ingest(job, on_stage):
+    from utils.ocr import ingest_report
+    payload = job["payload"]
+    result = ingest_report(job["user_id"], payload["path"], force=payload.get("force", False), on_stage=on_stage)
+    if result["status"] != "existing":
+        enqueue_advisories(job["user_id"])
+    return result
+
+
+def _run_advisories(job, on_stage):
+    from utils.advisories import precompute_advisories
+    return {"regenerated": precompute_advisories(job["user_id"])}
+
+
+JOB_HANDLERS = {"ingest": _run_ingest, "advisories": _run_advisories}
+
+
+def _heartbeat(job, stop):
+    """Keeps this attempt's updated_at fresh while it runs, so a long stage isn't taken for a dead worker."""
+    while not stop.wait(JOB_HEARTBEAT_SECONDS):
+        try:
+            conn = _connect()
+            try:
+                conn.execute(
+                    f"UPDATE jobs SET updated_at = ? WHERE job_id = ? AND attempts = ? "
+                    f"AND state IN ({','.join('?' * len(RUNNING_STATES))})",
+                    (time.time(), job["job_id"], job["attempts"], *RUNNING_STATES),
+                )
+                conn.commit()
+            finally:
+                conn.close()
+        except Exception as e:
+            print(f"⚠️ Job {job['job_id']} heartbeat failed:", str(e))
+
+
+def run_job(job):
+    """Runs one claimed job to completion, recording stage timings and retrying on failure."""
+    job_id = job["job_id"]
+
+    def on_stage(stage):
+        if stage in RUNNING_STATES:
+            _set_state(job_id, stage)
+
+    start = time.time()
+    stop = threading.Event()
+    threading.Thread(target=_heartbeat, args=(job, stop), daemon=True).start()
+    try:
+        result = JOB_HANDLERS[job["kind"]](job, on_stage)
+        _set_state(job_id, STORED, result=json.dumps(result), error=None)
+    except Exception as e:
+        print(f"❌ Job {job_id} failed (attempt {job['attempts']}):", str(e))
+        _retry_or_fail(job, "".join(traceback.format_exception_only(type(e), e)).strip())
+    finally:
+        stop.set()
+    print(f"⏱️ Job {job_id} ({job['kind']}) finished in {time.time() - start:.1f}s")
+
+
+def _retry_or_fail(job, error):
+    """Queues a failed attempt again after a backoff, or marks the job failed once its attempts are used up."""
+    if job["attempts"] < JOB_MAX_ATTEMPTS:
+        backoff = JOB_RETRY_BASE_SECONDS * 2 ** (job["attempts"] - 1) * random.uniform(0.5, 1.5)
+        _set_state(job["job_id"], QUEUED, error=error, run_after=time.time() + backoff)
+    else:
+        _set_state(job["job_id"], FAILED, error=error)
+
+
+# ---------------------------
+# Stats log
+# ---------------------------
+# Stats functions per module. Only modules the process has already imported are
+# reported, so the log line never loads EasyOCR or the embedding model itself.
+STATS_SOURCES = (
+    ("utils.ocr", ("ocr_pool_stats",)),
+    ("utils.ocr_cache", ("page_cache_stats",)),
+    ("utils.llm", ("llm_stats", "llm_queue_stats", "llm_resilience_stats", "llm_latency_histograms")),
+    ("utils.llm_cache", ("llm_cache_stats",)),
+    ("utils.embeddings", ("embedding_stats",)),
+    ("utils.user_kb", ("vectorstore_cache_stats",)),
+    ("utils.tenant_kb", ("tenant_store_stats",)),
+)
+
+_stats_log_lock = threading.Lock()
+_stats_log_started = False
+
+
+def process_stats():
+    """Counters from every loaded module in STATS_SOURCES, keyed by stats function name."""
+    stats = {}
+    for module_name, functions in STATS_SOURCES:
+        module = sys.modules.get(module_name)
+        if module is None:
+            continue
+        for name in functions:
+            try:
+                stats[name] = getattr(module, name)()
+            except Exception as e:
+                stats[name] = f"unavailable: {e}"
+    return stats
+
+
+def _log_stats_forever():
+    last = None
+    while True:
+        time.sleep(STATS_LOG_SECONDS)
+        line = json.dumps(process_stats(), default=str, sort_keys=True)
+        if line != last:
+            print(f"📊 Stats (pid {os.getpid()}): {line}")
+            last = line
+
+
+def start_stats_log():
+    """Starts this process's periodic stats log line once. Safe to call on every rerun."""
+    global _stats_log_started
+    if STATS_LOG_SECONDS <= 0:
+        return
+    with _stats_log_lock:
+        if _stats_log_started:
+            return
+        _stats_log_started = True
+    threading.Thread(target=_log_stats_forever, daemon=True).start()
+
+
+# ---------------------------
+# Dispatcher
+# ---------------------------
+_dispatcher_lock = threading.Lock()
+_dispatcher_started = False
+
+
+def _job_done(job, slots, future):
+    slots.release()
+    # run_job records its own errors; an exception here means the worker process died under it (e.g. out of memory)
+    error = "Worker process died" if future.cancelled() else future.exception()
+    if error is None:
+        return
+    print(f"❌ Job {job['job_id']} lost its worker (attempt {job['attempts']}):", str(error))
+    try:
+        _retry_or_fail(job, str(error) or type(error).__name__)
+    except Exception as e:
+        print("⚠️ Job queue unavailable:", str(e))
+
+
+def _init_worker():
+    start_stats_log()
+    if OCR_WARMUP:
+        from utils.ocr import warm_up_job_worker
+        warm_up_job_worker()
+
+
+def _new_executor(workers):
+    return ProcessPoolExecutor(max_workers=workers, initializer=_init_worker)
+
+
+def _dispatch_forever(workers):
+    executor = _new_executor(workers)
+    slots = threading.Semaphore(workers)
+    while True:
+        slots.acquire()
+        try:
+            job = _claim_next_job()
+        except Exception as e:
+            print("⚠️ Job queue unavailable:", str(e))
+            job = None
+        if job is None:
+            slots.release()
+            time.sleep(JOB_POLL_SECONDS)
+            continue
+        try:
+            future = executor.submit(run_job, job)
+        except Exception as e:
+            # A worker that died breaks the whole pool; start a new one and put the job back untouched
+            print("⚠️ Worker pool unavailable, restarting it:", str(e))
+            if isinstance(e, BrokenProcessPool):
+                executor.shutdown(wait=False, cancel_futures=True)
+                executor = _new_executor(workers)
+            try:
+                _set_state(job["job_id"], QUEUED, attempts=job["attempts"] - 1)
+            except Exception as e:
+                print("⚠️ Job queue unavailable:", str(e))
+            slots.release()
+            time.sleep(JOB_POLL_SECONDS)
+            continue
+        future.add_done_callback(functools.partial(_job_done, job, slots))
+
+
+def start_workers(workers=None):
+    """Starts the background dispatcher once per process. Safe to call on every rerun."""
+    global _dispatcher_started
+    with _dispatcher_lock:
+        if _dispatcher_started:
+            return
+        _dispatcher_started = True
+    start_stats_log()
+    threading.Thread(target=_dispatch_forever, args=(workers or JOB_WORKERS,), daemon=True).start()
+
+
+def job_progress(job):
+    """Returns (fraction done, label) for showing a job in the UI."""
+    state = job["state"]
+    if state == QUEUED and job.get("attempts"):
+        return STATE_PROGRESS[QUEUED], f"Retrying after error (attempt {job['attempts'] + 1})"
+    labels = {
+        QUEUED: "Waiting in queue",
+        OCR: "Reading report text",
+        SUMMARIZING: "Summarizing report",
+        EXTRACTING: "Extracting test parameters",
+        ADVISORIES: "Preparing diet and health guidance",
+        STORED: "Report stored",
+        FAILED: f"Failed: {job.get('error')}",
+    }
+    return STATE_PROGRESS[state], labels[state]
+
+
+if __name__ == "__main__":
+    # Dedicated worker host: python -m utils.jobs
+    print(f"Running job dispatcher with {JOB_WORKERS} worker process(es)")
+    start_stats_log()
+    _dispatch_forever(JOB_WORKERS)
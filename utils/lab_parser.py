@@ -0,0 +1,206 @@
+import os
+import re
+from datetime import datetime
+
+# ---------------------------
+# Deterministic lab report parser
+# ---------------------------
+# Reads "name value unit low - high" rows for the report families we know
+# (CBC, LFT, KFT) straight from the text layer or OCR text. Rows that don't
+# parse cleanly are flagged low-confidence so the caller can ask the LLM.
+
+REPORT_TYPE_MAPPING = {
+    "LIVER FUNCTION TEST": "LFT",
+    "LIVER FUNCTION TEST (LFT)": "LFT",
+    "LFT": "LFT",
+    "COMPLETE BLOOD COUNT": "CBC",
+    "CBC": "CBC",
+    "HEMOGRAM": "CBC",
+    "HAEMOGRAM": "CBC",
+    "KIDNEY FUNCTION TEST": "KFT",
+    "RENAL FUNCTION TEST": "KFT",
+    "KFT": "KFT",
+    # Add more as needed
+}
+
+# canonical parameter name -> (aliases as they appear on reports, expected units)
+LAB_PARAMETERS = {
+    "CBC": {
+        "Hemoglobin": (["hemoglobin", "haemoglobin", "hgb", "hb"], ["g/dl"]),
+        "WBC Count": (["wbc count", "total leucocyte count", "total leukocyte count", "total wbc count",
+                       "white blood cell count", "tlc"], ["/µl", "/ul", "/cumm", "cells/cumm", "10^3/µl", "10^3/ul"]),
+        "RBC Count": (["rbc count", "total rbc count", "red blood cell count"],
+                      ["million/µl", "million/ul", "million/cumm", "mill/cumm", "10^6/µl", "10^6/ul"]),
+        "Platelet Count": (["platelet count", "platelets"], ["/µl", "/ul", "/cumm", "lakh/cumm", "10^3/µl", "10^3/ul"]),
+        "Hematocrit": (["hematocrit", "haematocrit", "packed cell volume", "pcv", "hct"], ["%"]),
+        "MCV": (["mcv", "mean corpuscular volume"], ["fl"]),
+        "MCH": (["mch", "mean corpuscular hemoglobin"], ["pg"]),
+        "MCHC": (["mchc", "mean corpuscular hemoglobin concentration"], ["g/dl", "%"]),
+        "RDW": (["rdw-cv", "rdw"], ["%"]),
+        "Neutrophils": (["neutrophils", "neutrophil"], ["%"]),
+        "Lymphocytes": (["lymphocytes", "lymphocyte"], ["%"]),
+        "Eosinophils": (["eosinophils", "eosinophil"], ["%"]),
+        "Monocytes": (["monocytes", "monocyte"], ["%"]),
+        "Basophils": (["basophils", "basophil"], ["%"]),
+    },
+    "LFT": {
+        "Total Bilirubin": (["total bilirubin", "bilirubin total", "bilirubin, total"], ["mg/dl"]),
+        "Direct Bilirubin": (["direct bilirubin", "bilirubin direct", "bilirubin, direct", "conjugated bilirubin"], ["mg/dl"]),
+        "Indirect Bilirubin": (["indirect bilirubin", "bilirubin indirect", "bilirubin, indirect"], ["mg/dl"]),
+        "SGOT (AST)": (["sgot (ast)", "sgot", "ast", "aspartate aminotransferase"], ["u/l", "iu/l"]),
+        "SGPT (ALT)": (["sgpt (alt)", "sgpt", "alt", "alanine aminotransferase"], ["u/l", "iu/l"]),
+        "Alkaline Phosphatase": (["alkaline phosphatase", "alp"], ["u/l", "iu/l"]),
+        "GGT": (["gamma gt", "ggt", "gamma glutamyl transferase"], ["u/l", "iu/l"]),
+        "Total Protein": (["total protein", "total proteins", "protein total"], ["g/dl"]),
+        "Albumin": (["albumin"], ["g/dl"]),
+        "Globulin": (["globulin"], ["g/dl"]),
+        "A/G Ratio": (["a/g ratio", "albumin/globulin ratio", "a:g ratio"], []),
+    },
+    "KFT": {
+        "Blood Urea": (["blood urea", "urea"], ["mg/dl"]),
+        "Blood Urea Nitrogen": (["blood urea nitrogen", "bun"], ["mg/dl"]),
+        "Creatinine": (["serum creatinine", "creatinine"], ["mg/dl"]),
+        "Uric Acid": (["uric acid", "serum uric acid"], ["mg/dl"]),
+        "Sodium": (["sodium", "na+"], ["mmol/l", "meq/l"]),
+        "Potassium": (["potassium", "k+"], ["mmol/l", "meq/l"]),
+        "Chloride": (["chloride", "cl-"], ["mmol/l", "meq/l"]),
+        "Calcium": (["calcium", "serum calcium"], ["mg/dl"]),
+        "Phosphorus": (["phosphorus", "inorganic phosphorus"], ["mg/dl"]),
+        "eGFR": (["egfr"], ["ml/min/1.73m2", "ml/min/1.73 m2", "ml/min"]),
+    },
+}
+
+# Rows scoring below this are handed to the LLM
+LAB_PARSER_MIN_CONFIDENCE = float(os.getenv("LAB_PARSER_MIN_CONFIDENCE", "0.8"))
+
+_NUMBER = r"(\d[\d,]*(?:\.\d+)?|\.\d+)"
+_UNIT = r"(%|(?:x\s?)?10\^\d+/\S+|[A-Za-zµμ/][^\s\d]*(?:/\S+)?)"
+_FLAG = r"(?:\b(?:H|L|High|Low)\b|\*)?"
+_ROW_TAIL = re.compile(
+    r"\s*(?:\([^)]{1,20}\))?\s*[:\-]?\s*" + _NUMBER + r"\s*" + _FLAG + r"\s*" + _UNIT + r"?\s*" + _FLAG +
+    r"\s*(?:" + _NUMBER + r"\s*(?:-|–|to)\s*" + _NUMBER + r"|(?:<|up\s*to)\s*" + _NUMBER + r")?",
+    re.IGNORECASE,
+)
+
+_DATE_LABEL = re.compile(r"(?:report(?:ed)?\s*(?:date|on)|collected\s*(?:on|date)?|date)\s*[:\-]?\s*", re.IGNORECASE)
+_DATE_PATTERNS = [
+    (re.compile(r"\b(\d{4})-(\d{1,2})-(\d{1,2})\b"), ("y", "m", "d")),
+    (re.compile(r"\b(\d{1,2})[-/.](\d{1,2})[-/.](\d{4})\b"), ("d", "m", "y")),
+    (re.compile(r"\b(\d{1,2})[\s-]([A-Za-z]{3,9})[\s,-]*(\d{4})\b"), ("d", "mon", "y")),
+]
+
+
+def _number(text):
+    return float(text.replace(",", "")) if text else None
+
+
+def _normalize_unit(unit):
+    return unit.lower().replace("μ", "µ").replace("x10", "10").replace("x 10", "10") if unit else ""
+
+
+def detect_report_type(text):
+    """Returns the short report family (CBC/LFT/KFT) named in the text, or None."""
+    upper = text.upper()
+    for name in sorted(REPORT_TYPE_MAPPING, key=len, reverse=True):
+        if re.search(r"(?<![A-Z])" + re.escape(name) + r"(?![A-Z])", upper):
+            return REPORT_TYPE_MAPPING[name]
+    return None
+
+
+def _parse_date(match, order):
+    parts = dict(zip(order, match.groups()))
+    try:
+        if "mon" in parts:
+            month = datetime.strptime(parts["mon"][:3].title(), "%b").month
+        else:
+            month = int(parts["m"])
+        day, year = int(parts["d"]), int(parts["y"])
+        if month > 12 and day <= 12:
+            day, month = month, day
+        return datetime(year, month, day).strftime("%Y-%m-%d")
+    except ValueError:
+        return None
+
+
+def detect_report_date(text):
+    """Returns the report date as YYYY-MM-DD, preferring a labelled date over the first one found."""
+    candidates = [m.end() for m in _DATE_LABEL.finditer(text)] + [0]
+    for start in candidates:
+        window = text[start:start + 40] if start else text
+        for pattern, order in _DATE_PATTERNS:
+            match = pattern.search(window)
+            if match and (not start or match.start() < 5):
+                date = _parse_date(match, order)
+                if date:
+                    return date
+    return None
+
+
+def _parse_row(text, alias_match, expected_units):
+    tail = _ROW_TAIL.match(text, alias_match.end())
+    if not tail:
+        return None
+    value, unit, low, high, upper_only = tail.groups()
+    unit = unit if unit and unit.lower() not in ("to", "h", "l", "high", "low") else None
+    if low is None and upper_only is not None:
+        low, high = "0", upper_only
+
+    confidence = 0.5
+    if low is not None and high is not None:
+        confidence = 1.0 if not expected_units or _normalize_unit(unit) in expected_units else 0.7
+    return {
+        "parameter_value": _number(value),
+        "unit": unit or "",
+        "low_range": _number(low),
+        "high_range": _number(high),
+        "confidence": confidence,
+    }
+
+
+def parse_lab_report(text):
+    """
+    Parses a known lab report without the LLM. Returns
+    {"report_type", "report_date", "parameters"}; each parameter carries a
+    "confidence" between 0 and 1, and report_type is None for unknown formats.
+    """
+    report_type = detect_report_type(text)
+    families = [report_type] if report_type else list(LAB_PARAMETERS)
+
+    parameters = []
+    for family in families:
+        for name, (aliases, units) in LAB_PARAMETERS[family].items():
+            best = None
+            for alias in aliases:
+                pattern = r"(?<![A-Za-z0-9])" + re.escape(alias) + r"(?![A-Za-z0-9])"
+                for match in re.finditer(pattern, text, re.IGNORECASE):
+                    row = _parse_row(text, match, units)
+                    if row and (best is None or row["confidence"] > best["confidence"]):
+                        best = row
+                if best and best["confidence"] == 1.0:
+                    break
+            if best:
+                parameters.append({"parameter_name": name, **best})
+
+        # Without a title, only trust a family if several of its analytes were found
+        if not report_type and sum(p["confidence"] >= LAB_PARSER_MIN_CONFIDENCE for p in parameters) >= 3:
+            report_type = family
+            break
+        if not report_type:
+            parameters = []
+
+    return {
+        "report_type": report_type,
+        "report_date": detect_report_date(text),
+        "parameters": parameters,
+    }
+
+
+def canonical_parameter_name(name, report_type=None):
+    """Maps a parameter name as written on a report to our canonical name, or None if unknown."""
+    families = [report_type] if report_type in LAB_PARAMETERS else list(LAB_PARAMETERS)
+    key = (name or "").strip().lower()
+    for family in families:
+        for canonical, (aliases, _) in LAB_PARAMETERS[family].items():
+            if key == canonical.lower() or key in aliases:
+                return canonical
+    return None
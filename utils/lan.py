@@ -30,3 +30,19 @@ def to_user_language(text: str) -> str:
         return GoogleTranslator(source='en', target=lang).translate(text)
     except Exception:
         return text
+
+def to_user_language_stream(chunks):
+    """Translates streamed LLM output paragraph by paragraph, yielding each one as soon as it is complete."""
+    lang = st.session_state.get('lang', 'en')
+    if lang == 'en':
+        yield from chunks
+        return
+    buffer = ""
+    for chunk in chunks:
+        buffer += chunk
+        # Everything before the last blank line is made of finished paragraphs
+        done, sep, buffer = buffer.rpartition("\n\n")
+        if sep and done.strip():
+            yield to_user_language(done) + "\n\n"
+    if buffer.strip():
+        yield to_user_language(buffer)
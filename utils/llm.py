@@ -0,0 +1,670 @@
+import itertools
+import math
+import os
+import random
+import sqlite3
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import contextmanager
+import psutil
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from huggingface_hub import configure_http_backend
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_huggingface import ChatHuggingFace, HuggingFaceEndpoint
+from dotenv import load_dotenv
+from config.db_connection import get_local_connection
+from utils.llm_cache import response_cache_key, get_response, put_response
+
+load_dotenv()
+
+# ---------------------------
+# Shared LLM clients
+# ---------------------------
+# Every page and util gets its chat model from here. Clients are created on
+# first use and shared by the whole process (Streamlit re-executes page
+# scripts on each rerun, but imported modules stay loaded), keyed by model
+# and generation params. HTTP sessions come from _http_session(), which
+# huggingface_hub calls once per process and thread: requests.Session isn't
+# thread-safe, and a forked worker must not reuse its parent's sockets.
+DEFAULT_MODEL = os.getenv("LLM_MODEL", "mistralai/Mistral-7B-Instruct-v0.3")
+# "huggingface": hosted inference endpoints. "fake": the in-process stand-in in
+# utils/llm_fake.py, for offline load tests and benchmarks
+LLM_BACKEND = os.getenv("LLM_BACKEND", "huggingface")
+LLM_HTTP_POOL_SIZE = int(os.getenv("LLM_HTTP_POOL_SIZE", "16"))
+# Retries of failed connection attempts only; failed requests are retried by _invoke_resilient/_stream_resilient
+LLM_HTTP_CONNECT_RETRIES = int(os.getenv("LLM_HTTP_CONNECT_RETRIES", "2"))
+
+# Rough characters per token for Mistral-style tokenizers on English text;
+# used to size prompts without downloading the tokenizer
+LLM_CHARS_PER_TOKEN = float(os.getenv("LLM_CHARS_PER_TOKEN", "3.5"))
+
+def _http_session():
+    session = requests.Session()
+    retries = Retry(total=LLM_HTTP_CONNECT_RETRIES, connect=LLM_HTTP_CONNECT_RETRIES, read=0, status=0,
+                    backoff_factor=0.5)
+    adapter = HTTPAdapter(pool_connections=LLM_HTTP_POOL_SIZE, pool_maxsize=LLM_HTTP_POOL_SIZE, max_retries=retries)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+# huggingface_hub (used by HuggingFaceEndpoint) asks this factory for a session per process and thread, and caches it
+configure_http_backend(backend_factory=_http_session)
+
+
+def count_tokens(text):
+    """Estimated token count of text for the hosted models."""
+    return math.ceil(len(text) / LLM_CHARS_PER_TOKEN)
+
+
+# ---------------------------
+# Call metrics
+# ---------------------------
+_stats_lock = threading.Lock()
+_stats = {}
+
+
+def _model_stats(model_name):
+    return _stats.setdefault(model_name, {"calls": 0, "errors": 0, "latencies": deque(maxlen=1000),
+                                          "stream_latencies": deque(maxlen=1000), "ttft": deque(maxlen=1000)})
+
+
+def _record_call(model_name, seconds, error=False, streamed=False):
+    # Whole streams run far longer than single calls, so they are kept apart (hedging uses single calls only)
+    with _stats_lock:
+        stats = _model_stats(model_name)
+        stats["calls"] += 1
+        if error:
+            stats["errors"] += 1
+        else:
+            stats["stream_latencies" if streamed else "latencies"].append(seconds)
+
+
+def _record_ttft(model_name, seconds):
+    with _stats_lock:
+        _model_stats(model_name)["ttft"].append(seconds)
+
+
+def _percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+
+def llm_stats():
+    """
+    Per-model call counts, error counts and latencies (seconds) over the last
+    1000 calls, plus full duration and time to first token for streamed calls.
+    """
+    with _stats_lock:
+        snapshot = {name: dict(stats, latencies=list(stats["latencies"]), ttft=list(stats["ttft"]),
+                               stream_latencies=list(stats["stream_latencies"]))
+                    for name, stats in _stats.items()}
+    report = {}
+    for name, stats in snapshot.items():
+        latencies = stats["latencies"]
+        report[name] = {
+            "calls": stats["calls"],
+            "errors": stats["errors"],
+            "avg": round(sum(latencies) / len(latencies), 3) if latencies else None,
+            "p50": round(_percentile(latencies, 0.5), 3) if latencies else None,
+            "p95": round(_percentile(latencies, 0.95), 3) if latencies else None,
+            "stream_p50": round(_percentile(stats["stream_latencies"], 0.5), 3) if stats["stream_latencies"] else None,
+            "stream_p95": round(_percentile(stats["stream_latencies"], 0.95), 3) if stats["stream_latencies"] else None,
+            "ttft_p50": round(_percentile(stats["ttft"], 0.5), 3) if stats["ttft"] else None,
+            "ttft_p95": round(_percentile(stats["ttft"], 0.95), 3) if stats["ttft"] else None,
+        }
+    return report
+
+
+class _MetricsCallback(BaseCallbackHandler):
+    """Times every call made through a registry model, including ones made inside chains."""
+
+    def __init__(self, model_name):
+        self.model_name = model_name
+        self._started = {}
+        self._first_token = set()
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        self._started[run_id] = time.perf_counter()
+
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs):
+        self._started[run_id] = time.perf_counter()
+
+    def on_llm_new_token(self, token, *, run_id, **kwargs):
+        # Only fires for streamed calls; the first token of a run gives time to first token
+        if run_id in self._started and run_id not in self._first_token:
+            self._first_token.add(run_id)
+            _record_ttft(self.model_name, time.perf_counter() - self._started[run_id])
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        streamed = run_id in self._first_token
+        self._first_token.discard(run_id)
+        started = self._started.pop(run_id, None)
+        if started is not None:
+            _record_call(self.model_name, time.perf_counter() - started, streamed=streamed)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._first_token.discard(run_id)
+        started = self._started.pop(run_id, None)
+        _record_call(self.model_name, time.perf_counter() - (started or time.perf_counter()), error=True)
+
+
+# ---------------------------
+# Registry
+# ---------------------------
+_models = {}
+_models_lock = threading.Lock()
+
+
+def _huggingface_model(repo_id, params, callbacks):
+    llm = HuggingFaceEndpoint(repo_id=repo_id, task="text-generation", **{"timeout": int(LLM_TIMEOUT_SECONDS), **params})
+    return ChatHuggingFace(llm=llm, callbacks=callbacks)
+
+
+def _fake_model(repo_id, params, callbacks):
+    from utils.llm_fake import FakeChatModel
+    return FakeChatModel(callbacks=callbacks)
+
+
+LLM_BACKENDS = {"huggingface": _huggingface_model, "fake": _fake_model}
+
+
+def get_chat_model(repo_id=DEFAULT_MODEL, **params):
+    """
+    Returns the process-wide chat model for this repo_id and generation params,
+    creating it on first use with the LLM_BACKEND backend.
+    """
+    key = (repo_id, tuple(sorted(params.items())))
+    with _models_lock:
+        model = _models.get(key)
+        if model is None:
+            model = LLM_BACKENDS[LLM_BACKEND](repo_id, params, [_MetricsCallback(repo_id)])
+            _models[key] = model
+        return model
+
+
+# ---------------------------
+# Admission control and request coalescing
+# ---------------------------
+# At most LLM_MAX_CONCURRENCY model calls run at once, counted across the app
+# and its job worker processes. Within a process, waiting calls are admitted
+# fairly: the user with the fewest running calls goes next, oldest request
+# first, so one user's burst can't starve everyone else. An admitted call then
+# takes one of the shared slots in the local llm_slots DB, polling until one is
+# free; slots held by processes that have died are reclaimed. Past
+# LLM_MAX_QUEUE waiting calls (or LLM_QUEUE_TIMEOUT_SECONDS of waiting), calls
+# fail fast with LLMBusyError instead of piling up. Identical calls (same
+# model, params and prompt) already in flight are merged into one.
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "4"))
+LLM_MAX_QUEUE = int(os.getenv("LLM_MAX_QUEUE", "32"))
+LLM_QUEUE_TIMEOUT_SECONDS = float(os.getenv("LLM_QUEUE_TIMEOUT_SECONDS", "120"))
+LLM_SLOT_POLL_SECONDS = 0.1
+
+
+class LLMUnavailableError(RuntimeError):
+    """Raised when the model can't be reached; the message is fit to show to users."""
+
+
+class LLMBusyError(LLMUnavailableError):
+    """Raised when a model call can't get a slot because too many calls are waiting."""
+
+
+_admission = threading.Condition()
+_running = {}      # user_id -> calls running for that user
+_waiting = []      # (user_id, sequence number) in arrival order
+_ticket_numbers = itertools.count()
+_queue_stats = {"admitted": 0, "rejected": 0, "timed_out": 0, "coalesced": 0, "shared_waits": 0,
+                "queue_times": deque(maxlen=1000)}
+
+
+def _next_ticket():
+    return min(_waiting, key=lambda ticket: (_running.get(ticket[0], 0), ticket[1]))
+
+
+def _slots_connect():
+    conn = get_local_connection("llm_slots")
+    conn.execute("CREATE TABLE IF NOT EXISTS llm_slots (slot INTEGER PRIMARY KEY, pid INTEGER NOT NULL, "
+                 "started REAL NOT NULL, acquired_at REAL NOT NULL)")
+    return conn
+
+
+def _process_alive(pid, started):
+    # The start time tells a reused pid apart from the process that took the slot
+    try:
+        return psutil.Process(pid).create_time() == started
+    except psutil.Error:
+        return False
+
+
+def _take_shared_slot():
+    """Claims a free one of the LLM_MAX_CONCURRENCY shared slots and returns its number, or None if all are held."""
+    conn = _slots_connect()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        held = set()
+        for slot, pid, started in conn.execute("SELECT slot, pid, started FROM llm_slots").fetchall():
+            if _process_alive(pid, started):
+                held.add(slot)
+            else:
+                conn.execute("DELETE FROM llm_slots WHERE slot = ?", (slot,))
+        slot = next((n for n in range(LLM_MAX_CONCURRENCY) if n not in held), None)
+        if slot is not None:
+            me = psutil.Process()
+            conn.execute("INSERT INTO llm_slots (slot, pid, started, acquired_at) VALUES (?, ?, ?, ?)",
+                         (slot, me.pid, me.create_time(), time.time()))
+        conn.commit()
+        return slot
+    finally:
+        conn.close()
+
+
+def _release_shared_slot(slot):
+    conn = _slots_connect()
+    try:
+        conn.execute("DELETE FROM llm_slots WHERE slot = ? AND pid = ?", (slot, os.getpid()))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+@contextmanager
+def _shared_slot(start):
+    """Holds one of the shared slots, waiting until LLM_QUEUE_TIMEOUT_SECONDS after start for one to free up.
+    If the local DB can't be used, only the per-process limit applies."""
+    try:
+        slot = _take_shared_slot()
+        if slot is None:
+            with _admission:
+                _queue_stats["shared_waits"] += 1
+        while slot is None:
+            if time.perf_counter() - start >= LLM_QUEUE_TIMEOUT_SECONDS:
+                with _admission:
+                    _queue_stats["timed_out"] += 1
+                raise LLMBusyError("The assistant is busy right now. Please try again in a minute.")
+            time.sleep(LLM_SLOT_POLL_SECONDS)
+            slot = _take_shared_slot()
+    except sqlite3.Error as e:
+        print("⚠️ Shared LLM slots unavailable:", str(e))
+        slot = None
+    try:
+        yield
+    finally:
+        if slot is not None:
+            try:
+                _release_shared_slot(slot)
+            except sqlite3.Error as e:
+                print("⚠️ Shared LLM slots unavailable:", str(e))
+
+
+@contextmanager
+def _admitted(user_id):
+    """Holds one of the LLM_MAX_CONCURRENCY call slots for the duration of the block."""
+    ticket = (user_id, next(_ticket_numbers))
+    start = time.perf_counter()
+    with _admission:
+        if len(_waiting) >= LLM_MAX_QUEUE:
+            _queue_stats["rejected"] += 1
+            raise LLMBusyError("The assistant is busy right now. Please try again in a minute.")
+        _waiting.append(ticket)
+        while sum(_running.values()) >= LLM_MAX_CONCURRENCY or _next_ticket() != ticket:
+            remaining = start + LLM_QUEUE_TIMEOUT_SECONDS - time.perf_counter()
+            if remaining <= 0:
+                _waiting.remove(ticket)
+                _queue_stats["timed_out"] += 1
+                _admission.notify_all()
+                raise LLMBusyError("The assistant is busy right now. Please try again in a minute.")
+            _admission.wait(remaining)
+        _waiting.remove(ticket)
+        _running[user_id] = _running.get(user_id, 0) + 1
+        _queue_stats["admitted"] += 1
+        # The next waiter may be admissible too
+        _admission.notify_all()
+    try:
+        with _shared_slot(start):
+            with _admission:
+                _queue_stats["queue_times"].append(time.perf_counter() - start)
+            yield
+    finally:
+        with _admission:
+            _running[user_id] -= 1
+            if not _running[user_id]:
+                del _running[user_id]
+            _admission.notify_all()
+
+
+def llm_queue_stats():
+    """Running and waiting calls, admission outcomes and queue wait times (seconds) over the last 1000 calls."""
+    with _admission:
+        queue_times = list(_queue_stats["queue_times"])
+        stats = {k: v for k, v in _queue_stats.items() if k != "queue_times"}
+        stats.update(running=sum(_running.values()), waiting=len(_waiting), max_concurrency=LLM_MAX_CONCURRENCY)
+    stats["queue_p50"] = round(_percentile(queue_times, 0.5), 3) if queue_times else None
+    stats["queue_p95"] = round(_percentile(queue_times, 0.95), 3) if queue_times else None
+    return stats
+
+
+_flights = {}
+_flights_lock = threading.Lock()
+
+
+def _count_coalesced():
+    with _admission:
+        _queue_stats["coalesced"] += 1
+
+
+class _StreamFlight:
+    """One streamed completion, replayed to every caller that asked for it while it was running."""
+
+    def __init__(self):
+        self.parts = []
+        self.done = False
+        self.error = None
+        self.cond = threading.Condition()
+
+    def feed(self, chunks):
+        try:
+            for part in chunks:
+                with self.cond:
+                    self.parts.append(part)
+                    self.cond.notify_all()
+        except Exception as e:
+            self.error = e
+        finally:
+            with self.cond:
+                self.done = True
+                self.cond.notify_all()
+
+    def subscribe(self):
+        seen = 0
+        while True:
+            with self.cond:
+                while seen == len(self.parts) and not self.done:
+                    self.cond.wait()
+                new, done = self.parts[seen:], self.done
+                seen += len(new)
+            yield from new
+            if done:
+                if self.error:
+                    raise self.error
+                return
+
+
+# ---------------------------
+# Deadlines, retries, hedging and circuit breaking
+# ---------------------------
+# Every call gets LLM_TIMEOUT_SECONDS to answer (for streams: to send the
+# first chunk; later reads are bounded by the endpoint's HTTP timeout, and a
+# stream that breaks off after its first chunk fails with LLMUnavailableError).
+# Timeouts, connection errors and 429/5xx responses are retried up to
+# LLM_RETRIES times with jittered exponential backoff. With LLM_HEDGE on, a
+# duplicate request is sent when a non-streamed call runs past the model's
+# recent p95 latency, and the first answer wins. After LLM_BREAKER_FAILURES
+# transient failures in a row a model's circuit opens and calls fail at once
+# with LLMUnavailableError for LLM_BREAKER_COOLDOWN_SECONDS.
+LLM_TIMEOUT_SECONDS = float(os.getenv("LLM_TIMEOUT_SECONDS", "60"))
+LLM_RETRIES = int(os.getenv("LLM_RETRIES", "2"))
+LLM_RETRY_BASE_SECONDS = float(os.getenv("LLM_RETRY_BASE_SECONDS", "1"))
+LLM_HEDGE = os.getenv("LLM_HEDGE", "false").lower() == "true"
+LLM_HEDGE_MIN_SAMPLES = 20
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "5"))
+LLM_BREAKER_COOLDOWN_SECONDS = float(os.getenv("LLM_BREAKER_COOLDOWN_SECONDS", "30"))
+
+_TRANSIENT_STATUS = {408, 429, 500, 502, 503, 504}
+# Calls that blew their deadline keep a thread until the HTTP timeout frees it
+_call_pool = ThreadPoolExecutor(max_workers=32, thread_name_prefix="llm-call")
+_breakers = {}
+_breakers_lock = threading.Lock()
+_resilience_stats = {"timeouts": 0, "retries": 0, "hedges": 0, "hedge_wins": 0, "breaker_opens": 0, "fast_fails": 0}
+
+
+class LLMTimeoutError(TimeoutError):
+    pass
+
+
+def _count(stat):
+    with _breakers_lock:
+        _resilience_stats[stat] += 1
+
+
+def _is_transient(error):
+    if isinstance(error, (TimeoutError, ConnectionError, requests.exceptions.ConnectionError,
+                          requests.exceptions.Timeout, requests.exceptions.ChunkedEncodingError)):
+        return True
+    return getattr(getattr(error, "response", None), "status_code", None) in _TRANSIENT_STATUS
+
+
+def _check_breaker(model_name):
+    with _breakers_lock:
+        breaker = _breakers.get(model_name)
+        if breaker and breaker["open_until"] > time.time():
+            _resilience_stats["fast_fails"] += 1
+            wait_for = breaker["open_until"] - time.time()
+            raise LLMUnavailableError(
+                f"The AI model isn't responding right now. Please try again in about {wait_for:.0f} seconds.")
+
+
+def _breaker_success(model_name):
+    with _breakers_lock:
+        _breakers.pop(model_name, None)
+
+
+def _after_transient_failure(model_name, attempt, error):
+    """Records the failure; raises LLMUnavailableError when out of retries or the circuit opened, else backs off."""
+    with _breakers_lock:
+        breaker = _breakers.setdefault(model_name, {"failures": 0, "open_until": 0})
+        breaker["failures"] += 1
+        opened = breaker["failures"] >= LLM_BREAKER_FAILURES
+        if opened:
+            breaker["open_until"] = time.time() + LLM_BREAKER_COOLDOWN_SECONDS
+            _resilience_stats["breaker_opens"] += 1
+    print(f"⚠️ {model_name} call failed (attempt {attempt + 1}):", str(error))
+    if opened or attempt == LLM_RETRIES:
+        raise LLMUnavailableError("The AI model isn't responding right now. Please try again shortly.") from error
+    _count("retries")
+    time.sleep(LLM_RETRY_BASE_SECONDS * 2 ** attempt * random.uniform(0.5, 1.5))
+
+
+def _hedge_delay(model_name):
+    if not LLM_HEDGE:
+        return None
+    with _stats_lock:
+        latencies = list(_stats.get(model_name, {}).get("latencies", ()))
+    return _percentile(latencies, 0.95) if len(latencies) >= LLM_HEDGE_MIN_SAMPLES else None
+
+
+def _with_deadline(call, model_name, hedge=True):
+    """Runs call() on the call pool, giving up after LLM_TIMEOUT_SECONDS and optionally hedging past p95."""
+    start = time.perf_counter()
+    hedge_at = _hedge_delay(model_name) if hedge else None
+    primary = _call_pool.submit(call)
+    pending, error = {primary}, None
+    while pending:
+        elapsed = time.perf_counter() - start
+        remaining = LLM_TIMEOUT_SECONDS - elapsed
+        if remaining <= 0:
+            break
+        timeout = remaining if hedge_at is None else max(0, min(remaining, hedge_at - elapsed))
+        done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                if future is not primary:
+                    _count("hedge_wins")
+                return future.result()
+            error = future.exception()
+        if hedge_at is not None and time.perf_counter() - start >= hedge_at:
+            hedge_at = None
+            if pending:
+                _count("hedges")
+                pending.add(_call_pool.submit(call))
+    if error is not None and not pending:
+        raise error
+    _count("timeouts")
+    raise LLMTimeoutError(f"{model_name} gave no response within {LLM_TIMEOUT_SECONDS:g}s")
+
+
+def _invoke_resilient(model_name, call):
+    _check_breaker(model_name)
+    for attempt in range(LLM_RETRIES + 1):
+        try:
+            result = _with_deadline(call, model_name)
+        except Exception as e:
+            if not _is_transient(e):
+                raise
+            _after_transient_failure(model_name, attempt, e)
+            continue
+        _breaker_success(model_name)
+        return result
+
+
+def _stream_resilient(model_name, open_stream):
+    _check_breaker(model_name)
+    for attempt in range(LLM_RETRIES + 1):
+        try:
+            chunks = iter(open_stream())
+            first = _with_deadline(lambda: next(chunks, None), model_name, hedge=False)
+        except Exception as e:
+            # Only a stream that hasn't produced anything yet can be retried
+            if not _is_transient(e):
+                raise
+            _after_transient_failure(model_name, attempt, e)
+            continue
+        _breaker_success(model_name)
+        if first is not None:
+            yield first
+            try:
+                yield from chunks
+            except Exception as e:
+                # Part of the answer has been shown, so it can't be retried; fail like any other outage
+                if not _is_transient(e):
+                    raise
+                _after_transient_failure(model_name, LLM_RETRIES, e)
+        return
+
+
+_HISTOGRAM_BUCKETS = (0.5, 1, 2, 5, 10, 20, 30, 60)
+
+
+def _histogram(values):
+    counts = {f"<={b}s": 0 for b in _HISTOGRAM_BUCKETS}
+    counts[f">{_HISTOGRAM_BUCKETS[-1]}s"] = 0
+    for value in values:
+        bucket = next((f"<={b}s" for b in _HISTOGRAM_BUCKETS if value <= b), f">{_HISTOGRAM_BUCKETS[-1]}s")
+        counts[bucket] += 1
+    return counts
+
+
+def llm_latency_histograms():
+    """Per-model histograms of single-call latency, stream duration and time to first token over the last 1000 calls,
+    for tuning timeouts."""
+    with _stats_lock:
+        snapshot = {name: (list(stats["latencies"]), list(stats["stream_latencies"]), list(stats["ttft"]))
+                    for name, stats in _stats.items()}
+    return {name: {"latency": _histogram(latencies), "stream": _histogram(streams), "ttft": _histogram(ttft)}
+            for name, (latencies, streams, ttft) in snapshot.items()}
+
+
+def llm_resilience_stats():
+    """Timeout/retry/hedge/circuit-breaker counters and the models whose circuit is currently open."""
+    with _breakers_lock:
+        stats = dict(_resilience_stats)
+        stats["open_circuits"] = [name for name, b in _breakers.items() if b["open_until"] > time.time()]
+    return stats
+
+
+def generate(prompt, repo_id=DEFAULT_MODEL, user_id=None, **params):
+    """Sends a prompt to the shared model and returns the completion text."""
+    key = ("invoke", response_cache_key(repo_id, params, prompt))
+    with _flights_lock:
+        future = _flights.get(key)
+        leader = future is None
+        if leader:
+            future = _flights[key] = Future()
+    if not leader:
+        _count_coalesced()
+        return future.result()
+
+    try:
+        with _admitted(user_id):
+            model = get_chat_model(repo_id, **params)
+            text = _invoke_resilient(repo_id, lambda: model.invoke(prompt).content)
+        future.set_result(text)
+        return text
+    except Exception as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _flights_lock:
+            _flights.pop(key, None)
+
+
+def stream(prompt, repo_id=DEFAULT_MODEL, user_id=None, **params):
+    """
+    Returns an iterator over the completion text, chunk by chunk as the model
+    produces it. The model is read on a background thread, so a caller that
+    goes away (e.g. a Streamlit rerun) doesn't cut the stream short for
+    others sharing it.
+    """
+    key = ("stream", response_cache_key(repo_id, params, prompt))
+    with _flights_lock:
+        flight = _flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = _flights[key] = _StreamFlight()
+    if not leader:
+        _count_coalesced()
+        return flight.subscribe()
+
+    def chunks():
+        try:
+            with _admitted(user_id):
+                model = get_chat_model(repo_id, **params)
+                for chunk in _stream_resilient(repo_id, lambda: model.stream(prompt)):
+                    if chunk.content:
+                        yield chunk.content
+        finally:
+            with _flights_lock:
+                _flights.pop(key, None)
+
+    threading.Thread(target=flight.feed, args=(chunks(),), daemon=True).start()
+    return flight.subscribe()
+
+
+def generate_cached(prompt, user_id=None, repo_id=DEFAULT_MODEL, **params):
+    """
+    Like generate(), but served from the persistent response cache when the same
+    model, params and prompt were seen before. user_id ties the entry to a user
+    so it is dropped when their data changes.
+    Returns (text, cached_at) where cached_at is None for a fresh completion.
+    """
+    key = response_cache_key(repo_id, params, prompt)
+    hit = get_response(key)
+    if hit:
+        return hit
+    text = generate(prompt, repo_id, user_id=user_id, **params)
+    put_response(key, text, user_id)
+    return text, None
+
+
+def stream_cached(prompt, user_id=None, repo_id=DEFAULT_MODEL, **params):
+    """
+    Streaming counterpart of generate_cached(). Returns (chunks, cached_at): a
+    cache hit yields the stored text at once, a miss streams from the model and
+    caches the text once the completion finishes.
+    """
+    key = response_cache_key(repo_id, params, prompt)
+    hit = get_response(key)
+    if hit:
+        return iter([hit[0]]), hit[1]
+
+    def chunks():
+        parts = []
+        for part in stream(prompt, repo_id, user_id=user_id, **params):
+            parts.append(part)
+            yield part
+        put_response(key, "".join(parts), user_id)
+
+    return chunks(), None
@@ -0,0 +1,123 @@
+import hashlib
+import json
+import os
+import time
+from config.db_connection import get_local_connection
+
+# ---------------------------
+# LLM response cache
+# ---------------------------
+# Generated text keyed by a hash of the model, generation params and the fully
+# rendered prompt, so asking again with unchanged inputs skips the model.
+# Entries expire after LLM_CACHE_TTL_SECONDS and least recently used ones are
+# evicted beyond the cap. Each entry records the user it was generated for;
+# writes to that user's profile or reports drop their entries.
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE", "true").lower() == "true"
+LLM_CACHE_TTL_SECONDS = int(os.getenv("LLM_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "2000"))
+
+
+def _connect():
+    conn = get_local_connection("llm_responses")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS llm_responses (
+            cache_key TEXT PRIMARY KEY,
+            user_id INTEGER,
+            response TEXT,
+            created_at REAL,
+            last_used REAL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS llm_responses_lru ON llm_responses (last_used)")
+    conn.execute("CREATE INDEX IF NOT EXISTS llm_responses_user ON llm_responses (user_id)")
+    conn.execute("CREATE TABLE IF NOT EXISTS llm_response_stats (stat TEXT PRIMARY KEY, value INTEGER)")
+    return conn
+
+
+def response_cache_key(repo_id, params, prompt):
+    digest = hashlib.sha256()
+    digest.update(json.dumps({"repo_id": repo_id, "params": params}, sort_keys=True).encode())
+    digest.update(prompt.encode())
+    return digest.hexdigest()
+
+
+def _count(conn, stat, n=1):
+    conn.execute(
+        "INSERT INTO llm_response_stats (stat, value) VALUES (?, ?) "
+        "ON CONFLICT(stat) DO UPDATE SET value = value + excluded.value",
+        (stat, n),
+    )
+
+
+def get_response(cache_key):
+    """Returns (response, created_at) for a live entry, or None."""
+    if not LLM_CACHE_ENABLED:
+        return None
+    now = time.time()
+    conn = _connect()
+    try:
+        row = conn.execute(
+            "SELECT response, created_at FROM llm_responses WHERE cache_key = ?", (cache_key,)
+        ).fetchone()
+        if row and now - row[1] > LLM_CACHE_TTL_SECONDS:
+            conn.execute("DELETE FROM llm_responses WHERE cache_key = ?", (cache_key,))
+            _count(conn, "expired")
+            row = None
+        if row:
+            conn.execute("UPDATE llm_responses SET last_used = ? WHERE cache_key = ?", (now, cache_key))
+        _count(conn, "hits" if row else "misses")
+        conn.commit()
+    finally:
+        conn.close()
+    return (row[0], row[1]) if row else None
+
+
+def put_response(cache_key, response, user_id=None):
+    if not LLM_CACHE_ENABLED:
+        return
+    now = time.time()
+    conn = _connect()
+    try:
+        conn.execute(
+            "INSERT OR REPLACE INTO llm_responses (cache_key, user_id, response, created_at, last_used) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (cache_key, user_id, response, now, now),
+        )
+        evicted = conn.execute("""
+            DELETE FROM llm_responses WHERE cache_key IN (
+                SELECT cache_key FROM llm_responses ORDER BY last_used DESC LIMIT -1 OFFSET ?
+            )
+        """, (LLM_CACHE_MAX_ENTRIES,)).rowcount
+        if evicted:
+            _count(conn, "evictions", evicted)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def invalidate_user(user_id):
+    """Drops every cached response generated for this user. Call after their profile or reports change."""
+    conn = _connect()
+    try:
+        removed = conn.execute("DELETE FROM llm_responses WHERE user_id = ?", (user_id,)).rowcount
+        if removed:
+            _count(conn, "invalidations", removed)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def llm_cache_stats():
+    """Hit/miss/expiry/eviction counts across all processes plus the current cache size."""
+    conn = _connect()
+    try:
+        entries = conn.execute("SELECT COUNT(*) FROM llm_responses").fetchone()[0]
+        stats = {"hits": 0, "misses": 0, "expired": 0, "evictions": 0, "invalidations": 0}
+        stats.update(conn.execute("SELECT stat, value FROM llm_response_stats").fetchall())
+    finally:
+        conn.close()
+    lookups = stats["hits"] + stats["misses"]
+    stats["hit_rate"] = round(stats["hits"] / lookups, 3) if lookups else None
+    stats["entries"] = entries
+    stats["max_entries"] = LLM_CACHE_MAX_ENTRIES
+    return stats
@@ -0,0 +1,96 @@
+import json
+import os
+import re
+import time
+from datetime import datetime
+from typing import Any, Iterator, List, Optional
+from langchain_core.callbacks import CallbackManagerForLLMRun
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+# ---------------------------
+# Local stand-in model (LLM_BACKEND=fake)
+# ---------------------------
+# Answers deterministically without network access, so ingestion and
+# the advisory pages can be load-tested and our own overhead separated from
+# model latency. Prompts asking for JSON get a schema-valid report (with a
+# summary); anything else gets canned markdown of FAKE_LLM_OUTPUT_TOKENS
+# tokens. Timing mimics a hosted model: FAKE_LLM_LATENCY seconds to the first
+# token, then FAKE_LLM_TOKENS_PER_SECOND.
+FAKE_LLM_LATENCY = float(os.getenv("FAKE_LLM_LATENCY", "0.5"))
+FAKE_LLM_TOKENS_PER_SECOND = float(os.getenv("FAKE_LLM_TOKENS_PER_SECOND", "50"))
+FAKE_LLM_OUTPUT_TOKENS = int(os.getenv("FAKE_LLM_OUTPUT_TOKENS", "300"))
+
+_CANNED_PARAGRAPHS = [
+    "## Summary of Key Findings\nMost values are within their reference ranges. Hemoglobin is slightly "
+    "below range and total cholesterol is mildly raised; no critical results are present.",
+    "## Recommendations\n- Include iron-rich foods such as spinach, lentils and legumes.\n"
+    "- Prefer whole grains, fruit and vegetables over refined carbohydrates.\n"
+    "- Drink 2-3 litres of water a day and keep a regular sleep schedule.",
+    "## Foods to Avoid\nLimit fried food, processed meat, sugary drinks and excess salt. "
+    "Tea or coffee right after meals can reduce iron absorption.",
+    "## Follow-up\nRepeat the blood count in three months and discuss the cholesterol result "
+    "with your doctor at the next routine visit.",
+]
+
+_CANNED_REPORT = {
+    "summary": "Complete blood count with mildly low hemoglobin; other values are within reference ranges.",
+    "report_type": "CBC",
+    "parameters": [
+        {"parameter_name": "Hemoglobin", "parameter_value": 11.8, "unit": "g/dL", "low_range": 13.0, "high_range": 17.0},
+        {"parameter_name": "Total WBC Count", "parameter_value": 7200, "unit": "cells/cumm", "low_range": 4000, "high_range": 11000},
+        {"parameter_name": "Platelet Count", "parameter_value": 250000, "unit": "cells/cumm", "low_range": 150000, "high_range": 410000},
+        {"parameter_name": "RBC Count", "parameter_value": 4.6, "unit": "million/cumm", "low_range": 4.5, "high_range": 5.5},
+    ],
+}
+
+
+def canned_response(prompt, output_tokens=None):
+    """The fake model's reply to a prompt."""
+    if "JSON" in prompt:
+        return json.dumps(dict(_CANNED_REPORT, report_date=datetime.now().strftime("%Y-%m-%d")), indent=2)
+    # Words stand in for tokens; paragraphs repeat until the target length
+    target = output_tokens or FAKE_LLM_OUTPUT_TOKENS
+    paragraphs, words = [], 0
+    while words < target:
+        paragraph = _CANNED_PARAGRAPHS[len(paragraphs) % len(_CANNED_PARAGRAPHS)]
+        paragraphs.append(paragraph)
+        words += len(paragraph.split())
+    return "\n\n".join(paragraphs)
+
+
+def _prompt_text(messages):
+    return "\n".join(m.content if isinstance(m.content, str) else str(m.content) for m in messages)
+
+
+class FakeChatModel(BaseChatModel):
+    """Chat model returning canned_response() with simulated latency and token rate."""
+
+    latency: float = FAKE_LLM_LATENCY
+    tokens_per_second: float = FAKE_LLM_TOKENS_PER_SECOND
+    output_tokens: int = FAKE_LLM_OUTPUT_TOKENS
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat"
+
+    def _tokens(self, messages: List[BaseMessage]) -> List[str]:
+        text = canned_response(_prompt_text(messages), self.output_tokens)
+        return re.findall(r"\S+\s*|\s+", text)
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                  run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> ChatResult:
+        tokens = self._tokens(messages)
+        time.sleep(self.latency + len(tokens) / self.tokens_per_second)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content="".join(tokens)))])
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        time.sleep(self.latency)
+        for token in self._tokens(messages):
+            time.sleep(1 / self.tokens_per_second)
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=token))
+            if run_manager:
+                run_manager.on_llm_new_token(token, chunk=chunk)
+            yield chunk
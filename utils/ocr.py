@@ -1,25 +1,185 @@
 import re
 import easyocr
-from pdf2image import convert_from_path
+from pdf2image import convert_from_path, pdfinfo_from_path
+from pypdf import PdfReader
 import numpy as np
-from PIL import Image
+from PIL import Image, ImageOps
 import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+import psutil
 from config.db_connection import get_connection
+from utils.ocr_cache import page_cache_key, get_page_text, put_page_text
+from utils.lab_parser import parse_lab_report, canonical_parameter_name, LAB_PARSER_MIN_CONFIDENCE
+from utils.ingest_cache import content_sha256, get_cached_result, save_result, get_user_report, link_user_report
 from datetime import datetime
-from langchain.prompts import PromptTemplate
 import json
-from langchain_huggingface import ChatHuggingFace,HuggingFaceEndpoint
+from utils.llm import generate, count_tokens
+from utils.llm_cache import invalidate_user
 from dotenv import load_dotenv
 from langchain.prompts import PromptTemplate
 
 load_dotenv()
 
+EXTRACTION_MODEL = "mistralai/Mistral-7B-Instruct-v0.2"
+EXTRACTION_PARAMS = {"temperature": 0.5, "max_length": 1024}
+
+OCR_LANGUAGES = ['en']
+OCR_POOL_SIZE = int(os.getenv("OCR_POOL_SIZE", "1"))
+OCR_USE_GPU = os.getenv("OCR_USE_GPU", "false").lower() == "true"
+POPPLER_PATH = os.getenv("POPPLER_PATH", r"C:\\Users\\Diya\Downloads\\Release-24.08.0-0\\poppler-24.08.0\\Library\\bin")
+
+# A page's embedded text is used instead of OCR when it has at least this many
+# characters and this share of them look like ordinary report text.
+TEXT_LAYER_MIN_CHARS = int(os.getenv("TEXT_LAYER_MIN_CHARS", "40"))
+TEXT_LAYER_MIN_QUALITY = float(os.getenv("TEXT_LAYER_MIN_QUALITY", "0.85"))
+# A page mostly covered by images (at least TEXT_LAYER_IMAGE_COVERAGE of its
+# area) is a scan. Its text layer is only used when it is dense enough to be
+# the page's own text (a searchable scan), not just a digital header or stamp.
+TEXT_LAYER_IMAGE_COVERAGE = float(os.getenv("TEXT_LAYER_IMAGE_COVERAGE", "0.5"))
+TEXT_LAYER_MIN_CHARS_PER_SQIN = float(os.getenv("TEXT_LAYER_MIN_CHARS_PER_SQIN", "2"))
+
+# Scanned pages are rasterized OCR_PAGE_WINDOW pages at a time and OCR'd by
+# OCR_WORKERS processes (1 = in this process). At most OCR_PAGE_CONCURRENCY
+# windows are in flight, which bounds peak memory regardless of page count.
+OCR_WORKERS = int(os.getenv("OCR_WORKERS", "1"))
+OCR_PAGE_WINDOW = int(os.getenv("OCR_PAGE_WINDOW", "2"))
+OCR_PAGE_CONCURRENCY = int(os.getenv("OCR_PAGE_CONCURRENCY", str(max(OCR_WORKERS, 1) * 2)))
+
+# Image preprocessing between rasterization and OCR. Grayscale and a capped
+# page size cut the pixels EasyOCR has to process; binarization and deskew
+# help noisy or tilted scans. Tune with benchmarks/bench_ocr_preprocess.py.
+OCR_DPI = int(os.getenv("OCR_DPI", "200"))
+OCR_GRAYSCALE = os.getenv("OCR_GRAYSCALE", "true").lower() == "true"
+OCR_MAX_DIM = int(os.getenv("OCR_MAX_DIM", "2400"))
+OCR_BINARIZE = os.getenv("OCR_BINARIZE", "false").lower() == "true"
+OCR_DESKEW = os.getenv("OCR_DESKEW", "false").lower() == "true"
+
+# ---------------------------
+# EasyOCR reader pool
+# ---------------------------
+# Building an easyocr.Reader loads the detection and recognition weights from
+# disk, so readers are created at most OCR_POOL_SIZE times per process and
+# handed out to callers instead of being rebuilt for every report.
+_reader_pool = queue.Queue()
+_reader_pool_lock = threading.Lock()
+_readers_created = 0
+_reader_stats = []
+_warm_up_started = False
+
+
+def _process_rss():
+    return psutil.Process(os.getpid()).memory_info().rss
+
+
+def _load_reader():
+    rss_before = _process_rss()
+    start = time.perf_counter()
+    reader = easyocr.Reader(OCR_LANGUAGES, gpu=OCR_USE_GPU)
+    stats = {
+        "load_seconds": round(time.perf_counter() - start, 3),
+        "rss_delta_mb": round((_process_rss() - rss_before) / 2**20, 1),
+    }
+    with _reader_pool_lock:
+        _reader_stats.append(stats)
+    print(f"🔤 EasyOCR reader loaded in {stats['load_seconds']}s (+{stats['rss_delta_mb']} MB)")
+    return reader
+
+
+def _maybe_load_reader():
+    """Loads a new reader if the pool is still below OCR_POOL_SIZE, else returns None."""
+    global _readers_created
+    with _reader_pool_lock:
+        if _readers_created >= OCR_POOL_SIZE:
+            return None
+        _readers_created += 1
+    try:
+        return _load_reader()
+    except Exception:
+        with _reader_pool_lock:
+            _readers_created -= 1
+        raise
 
-def generate_summary(report_data):
-    llm=HuggingFaceEndpoint(repo_id="mistralai/Mistral-7B-Instruct-v0.3",
-                        task="text-generation")
-    model=ChatHuggingFace(llm=llm)
-    summary_prompt = PromptTemplate.from_template("""
+
+@contextmanager
+def ocr_reader():
+    """Borrows a warm EasyOCR reader from the process-wide pool."""
+    try:
+        reader = _reader_pool.get_nowait()
+    except queue.Empty:
+        reader = _maybe_load_reader() or _reader_pool.get()
+    try:
+        yield reader
+    finally:
+        _reader_pool.put(reader)
+
+
+def warm_up_ocr(background=False):
+    """Loads the reader pool up front so the first upload doesn't pay for it."""
+    global _warm_up_started
+    if background:
+        with _reader_pool_lock:
+            if _warm_up_started:
+                return
+            _warm_up_started = True
+        threading.Thread(target=warm_up_ocr, daemon=True).start()
+        return
+    while True:
+        reader = _maybe_load_reader()
+        if reader is None:
+            break
+        _reader_pool.put(reader)
+
+
+def _init_ocr_worker():
+    # Each worker process OCRs one window at a time, so one reader is enough
+    global OCR_POOL_SIZE
+    OCR_POOL_SIZE = 1
+    warm_up_ocr()
+
+
+def warm_up_job_worker():
+    """
+    Job worker initializer: starts loading what this process will OCR with (its
+    own reader, or the OCR_WORKERS process pool) in the background, so the
+    first report it ingests doesn't pay for it.
+    """
+    if OCR_WORKERS <= 1:
+        warm_up_ocr(background=True)
+        return
+    executor = _get_ocr_executor()
+    for _ in range(OCR_WORKERS):
+        executor.submit(int)
+
+
+def ocr_pool_stats():
+    """Load time and memory cost per reader, for sizing OCR_POOL_SIZE and worker counts."""
+    with _reader_pool_lock:
+        return {
+            "pool_size": OCR_POOL_SIZE,
+            "loaded": _readers_created,
+            "idle": _reader_pool.qsize(),
+            "readers": list(_reader_stats),
+        }
+
+
+# ---------------------------
+# Summaries
+# ---------------------------
+# Reports up to SUMMARY_SINGLE_CALL_TOKENS are summarized in one call. Longer
+# ones are split at page markers (then paragraphs, then lines) into chunks of
+# SUMMARY_CHUNK_TOKENS, summarized SUMMARY_CONCURRENCY at a time, and the
+# partial summaries merged by a final reduce call.
+SUMMARY_SINGLE_CALL_TOKENS = int(os.getenv("SUMMARY_SINGLE_CALL_TOKENS", "6000"))
+SUMMARY_CHUNK_TOKENS = int(os.getenv("SUMMARY_CHUNK_TOKENS", "3000"))
+SUMMARY_CONCURRENCY = int(os.getenv("SUMMARY_CONCURRENCY", "4"))
+SUMMARY_MAX_MAP_ROUNDS = 3
+
+SUMMARY_PROMPT = PromptTemplate.from_template("""
     You are a medical assistant AI.
 
     The following is the raw medical report texts from a user. Summarize the overall findings, trends, or any red flags. Provide a clean and professional medical summary.
@@ -29,56 +189,389 @@ def generate_summary(report_data):
 
     --- Medical Summary ---
     """)
-    summary_chain = summary_prompt | model
-    summary_response = summary_chain.invoke({"report_data": report_data})
-    summary_text = summary_response.content.strip()
 
-    return summary_text
+CHUNK_SUMMARY_PROMPT = PromptTemplate.from_template("""
+    You are a medical assistant AI.
 
+    The following is part {part} of {parts} of a user's medical report. List every test result it contains with its value, unit and reference range, and note anything abnormal. Do not add findings that are not in the text.
 
-def extract_text_from_report(pdf_path):
-    # Convert PDF to list of PIL images
-    pages = convert_from_path(pdf_path,
-                              poppler_path = r"C:\\Users\\Diya\Downloads\\Release-24.08.0-0\\poppler-24.08.0\\Library\\bin")
+    Report part:
+    {text}
 
-    reader = easyocr.Reader(['en'])
-    all_text = []
+    --- Notes ---
+    """)
 
-    for i, page in enumerate(pages):
-        # Convert PIL image to numpy array
-        image_np = np.array(page)
+REDUCE_SUMMARY_PROMPT = PromptTemplate.from_template("""
+    You are a medical assistant AI.
 
-        # Use EasyOCR to extract text
-        result = reader.readtext(image_np, detail=0)
-        page_text = " ".join(result)
+    The following are notes taken from consecutive parts of one user's medical report. Combine them into a single summary of the overall findings, trends, or any red flags. Provide a clean and professional medical summary.
 
-        all_text.append(f"--- Page {i+1} ---\n{page_text}")
+    Notes:
+    {notes}
 
-    return "\n\n".join(all_text)
+    --- Medical Summary ---
+    """)
 
+_PAGE_MARKER = re.compile(r"(?=^--- Page \d+ ---$)", re.M)
 
 
-def report_insertion(user_id,ocr_text,summary):
-    conn=get_connection()
-    cursor=conn.cursor()
-    llm = HuggingFaceEndpoint(repo_id="mistralai/Mistral-7B-Instruct-v0.2",temperature=0.5,
-    max_length=1024,
-    task="text-generation"
-    )
-
-    model=ChatHuggingFace(llm=llm)
-    prompt = PromptTemplate(
-        input_variables=["ocr"],
-        template="""
-You are a medical report data extractor.
+def _split_oversized(piece, max_tokens, separators=("\n\n", "\n")):
+    if count_tokens(piece) <= max_tokens:
+        return [piece]
+    if not separators:
+        size = max(1, len(piece) * max_tokens // count_tokens(piece))
+        return [piece[i:i + size] for i in range(0, len(piece), size)]
+    sep, rest = separators[0], separators[1:]
+    parts = piece.split(sep)
+    return [p for i, part in enumerate(parts)
+            for p in _split_oversized(part + (sep if i < len(parts) - 1 else ""), max_tokens, rest)]
 
-Given this OCR medical report text:
-{ocr}
 
-Extract the following JSON object:
+def split_for_summary(text, max_tokens):
+    """Splits report text into chunks of at most max_tokens, keeping pages together where they fit."""
+    chunks, current = [], ""
+    for page in _PAGE_MARKER.split(text):
+        for piece in _split_oversized(page, max_tokens):
+            if current and count_tokens(current + piece) > max_tokens:
+                chunks.append(current)
+                current = ""
+            current += piece
+    if current.strip():
+        chunks.append(current)
+    return chunks
 
-{{
-  "report_type": "...",
+
+def _summarize_chunks(chunks):
+    def summarize(numbered):
+        i, chunk = numbered
+        return generate(CHUNK_SUMMARY_PROMPT.format(part=i + 1, parts=len(chunks), text=chunk)).strip()
+
+    with ThreadPoolExecutor(max_workers=max(1, min(SUMMARY_CONCURRENCY, len(chunks)))) as pool:
+        return list(pool.map(summarize, enumerate(chunks)))
+
+
+def generate_summary(report_data):
+    start = time.time()
+    text, chunk_count, rounds = report_data, 0, 0
+    # Map: keep condensing until the text fits in one call
+    while count_tokens(text) > SUMMARY_SINGLE_CALL_TOKENS and rounds < SUMMARY_MAX_MAP_ROUNDS:
+        chunks = split_for_summary(text, SUMMARY_CHUNK_TOKENS)
+        chunk_count += len(chunks)
+        text = "\n\n".join(f"Part {i + 1}:\n{notes}" for i, notes in enumerate(_summarize_chunks(chunks)))
+        rounds += 1
+
+    if rounds:
+        summary_text = generate(REDUCE_SUMMARY_PROMPT.format(notes=text)).strip()
+    else:
+        summary_text = generate(SUMMARY_PROMPT.format(report_data=text)).strip()
+    print(f"📝 Summary of ~{count_tokens(report_data)} tokens: {chunk_count} chunk(s) in {rounds} map round(s), "
+          f"{time.time() - start:.1f}s")
+    return summary_text
+
+
+# ---------------------------
+# Text extraction
+# ---------------------------
+
+def _text_layer_is_usable(layer_page):
+    """Whether a page from _read_text_layer() can skip OCR."""
+    text = layer_page["text"].strip()
+    if len(text) < TEXT_LAYER_MIN_CHARS or "(cid:" in text:
+        return False
+    readable = sum(ch.isalnum() or ch.isspace() or ch in ".,:;%/-()+<>=µ*'\"#&[]" for ch in text)
+    if readable / len(text) < TEXT_LAYER_MIN_QUALITY:
+        return False
+    if layer_page["image_coverage"] >= TEXT_LAYER_IMAGE_COVERAGE:
+        return len(text) / layer_page["area_sq_in"] >= TEXT_LAYER_MIN_CHARS_PER_SQIN
+    return True
+
+
+def _empty_layer_page():
+    # Unknown page contents: OCR it
+    return {"text": "", "image_coverage": 1.0, "area_sq_in": 1.0}
+
+
+def _read_layer_page(page):
+    """A page's embedded text, plus the share of its area drawn by images and its area in square inches."""
+    area = float(page.mediabox.width) * float(page.mediabox.height)
+    try:
+        xobjects = page["/Resources"]["/XObject"].get_object()
+    except (KeyError, TypeError):
+        xobjects = {}
+    drawn = []
+
+    def visit(operator, operands, cm, tm):
+        if operator == b"Do" and operands:
+            try:
+                is_image = xobjects[operands[0]].get_object().get("/Subtype") == "/Image"
+            except (KeyError, TypeError, AttributeError):
+                is_image = False
+            if is_image:
+                # An image fills the unit square, so the transformation's determinant is its area on the page
+                drawn.append(abs(cm[0] * cm[3] - cm[1] * cm[2]))
+
+    text = page.extract_text(visitor_operand_before=visit) or ""
+    return {"text": text, "image_coverage": min(1.0, sum(drawn) / area) if area else 0.0,
+            "area_sq_in": max(area / 72 ** 2, 1.0)}
+
+
+def _read_text_layer(pdf_path):
+    """Returns _read_layer_page() for every page, or None if pypdf can't read the file."""
+    try:
+        reader = PdfReader(pdf_path)
+    except Exception as e:
+        print("⚠️ Could not read PDF text layer:", str(e))
+        return None
+
+    pages = []
+    for page in reader.pages:
+        try:
+            pages.append(_read_layer_page(page))
+        except Exception:
+            pages.append(_empty_layer_page())
+    return pages
+
+
+def ocr_settings(**overrides):
+    """Current preprocessing settings as a plain dict (passed on to OCR worker processes)."""
+    settings = {
+        "dpi": OCR_DPI,
+        "grayscale": OCR_GRAYSCALE,
+        "max_dim": OCR_MAX_DIM,
+        "binarize": OCR_BINARIZE,
+        "deskew": OCR_DESKEW,
+    }
+    settings.update(overrides)
+    return settings
+
+
+def _otsu_threshold(gray):
+    hist = np.bincount(gray.ravel(), minlength=256).astype(np.float64)
+    weights = np.cumsum(hist)
+    means = np.cumsum(hist * np.arange(256))
+    total_weight, total_mean = weights[-1], means[-1]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        between = (total_mean * weights - means * total_weight) ** 2 / (weights * (total_weight - weights))
+    # A blank or single-colour page has no split between two classes
+    if np.isnan(between).all():
+        return 128
+    return int(np.nanargmax(between))
+
+
+def _deskew(image, max_angle=5.0, step=0.5):
+    """Rotates the page by the angle (within ±max_angle) that makes text rows line up best."""
+    small = image.convert("L")
+    small.thumbnail((800, 800))
+    ink = np.array(small) < _otsu_threshold(np.array(small))
+    if ink.all() or not ink.any():
+        return image
+    ink_image = Image.fromarray((ink * 255).astype(np.uint8))
+
+    best_angle, best_score = 0.0, -1.0
+    for angle in np.arange(-max_angle, max_angle + step, step):
+        rows = np.array(ink_image.rotate(angle, fillcolor=0)).sum(axis=1)
+        score = float(np.var(rows))
+        if score > best_score:
+            best_angle, best_score = float(angle), score
+
+    if best_angle == 0.0:
+        return image
+    fill = 255 if image.mode == "L" else (255,) * len(image.getbands())
+    return image.rotate(best_angle, resample=Image.BICUBIC, expand=True, fillcolor=fill)
+
+
+def preprocess_image(image, settings=None):
+    """Applies the configured grayscale/downscale/deskew/binarize steps and returns a numpy array for OCR."""
+    settings = settings or ocr_settings()
+    if settings["grayscale"] and image.mode != "L":
+        image = image.convert("L")
+
+    max_dim = settings["max_dim"]
+    if max_dim and max(image.size) > max_dim:
+        scale = max_dim / max(image.size)
+        image = image.resize((round(image.width * scale), round(image.height * scale)), Image.LANCZOS)
+
+    if settings["deskew"]:
+        image = _deskew(image)
+
+    if settings["binarize"]:
+        gray = np.array(image.convert("L"))
+        return np.where(gray > _otsu_threshold(gray), 255, 0).astype(np.uint8)
+
+    return np.array(image)
+
+
+def rasterize_pages(pdf_path, first_page, last_page, settings=None):
+    settings = settings or ocr_settings()
+    return convert_from_path(pdf_path, dpi=settings["dpi"], grayscale=settings["grayscale"],
+                             first_page=first_page, last_page=last_page, poppler_path=POPPLER_PATH)
+
+
+def _ocr_image(image, reader, settings=None):
+    result = reader.readtext(preprocess_image(image, settings), detail=0)
+    return " ".join(result)
+
+
+def _ocr_cached(image, reader, settings):
+    """OCRs one page image, reusing cached text when the same pixels were seen before.
+    Returns (text, source) with source "ocr" or "ocr_cache"."""
+    cache_key = page_cache_key(image, settings, OCR_LANGUAGES)
+    text = get_page_text(cache_key)
+    if text is not None:
+        return text, "ocr_cache"
+    text = _ocr_image(image, reader, settings)
+    put_page_text(cache_key, text)
+    return text, "ocr"
+
+
+def _page_windows(page_numbers):
+    """Groups page numbers into runs of consecutive pages, at most OCR_PAGE_WINDOW long."""
+    windows = []
+    for page_no in page_numbers:
+        if windows and windows[-1][-1] == page_no - 1 and len(windows[-1]) < OCR_PAGE_WINDOW:
+            windows[-1].append(page_no)
+        else:
+            windows.append([page_no])
+    return windows
+
+
+def _ocr_page_window(pdf_path, window, settings):
+    """Rasterizes and OCRs one window of consecutive PDF pages. Returns [(text, source)]."""
+    images = rasterize_pages(pdf_path, window[0], window[-1], settings)
+    with ocr_reader() as reader:
+        return [_ocr_cached(image, reader, settings) for image in images]
+
+
+def _ocr_image_file(image_path, settings):
+    """OCRs an uploaded photo or scan directly, without a PDF round trip. Returns [(text, source)]."""
+    with Image.open(image_path) as image:
+        # Phone photos are often stored sideways with an EXIF orientation tag
+        image = ImageOps.exif_transpose(image)
+        if image.mode not in ("L", "RGB"):
+            image = image.convert("RGB")
+        with ocr_reader() as reader:
+            return [_ocr_cached(image, reader, settings)]
+
+
+_ocr_executor = None
+_ocr_executor_lock = threading.Lock()
+
+
+def _get_ocr_executor():
+    global _ocr_executor
+    with _ocr_executor_lock:
+        if _ocr_executor is None:
+            _ocr_executor = ProcessPoolExecutor(max_workers=OCR_WORKERS, initializer=_init_ocr_worker)
+        return _ocr_executor
+
+
+def _run_ocr_tasks(tasks):
+    """
+    Runs (fn, args, page_numbers) OCR tasks and yields (page_numbers, results) in
+    task order, keeping at most OCR_PAGE_CONCURRENCY tasks in flight.
+    """
+    if OCR_WORKERS <= 1:
+        for fn, args, page_numbers in tasks:
+            yield page_numbers, fn(*args)
+        return
+
+    executor = _get_ocr_executor()
+    pending = deque()
+    for fn, args, page_numbers in tasks:
+        if len(pending) >= OCR_PAGE_CONCURRENCY:
+            numbers, future = pending.popleft()
+            yield numbers, future.result()
+        pending.append((page_numbers, executor.submit(fn, *args)))
+    while pending:
+        numbers, future = pending.popleft()
+        yield numbers, future.result()
+
+
+_FILE_SIGNATURES = [
+    (b"%PDF", "pdf"),
+    (b"\x89PNG\r\n\x1a\n", "png"),
+    (b"\xff\xd8\xff", "jpeg"),
+    (b"II*\x00", "tiff"),
+    (b"MM\x00*", "tiff"),
+    (b"BM", "bmp"),
+]
+IMAGE_TYPES = ("png", "jpeg", "tiff", "bmp", "webp")
+
+
+def sniff_file_type(path):
+    """Detects the upload type from its first bytes, ignoring the file name."""
+    with open(path, "rb") as f:
+        head = f.read(16)
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "webp"
+    for signature, kind in _FILE_SIGNATURES:
+        if head.startswith(signature):
+            return kind
+    return None
+
+
+def extract_pages(paths):
+    """
+    Extracts the text of each page of an upload. paths is a PDF or image path,
+    or a list of them (e.g. several phone photos of one report), numbered as
+    consecutive pages. PDF pages with a usable embedded text layer are read
+    directly; scanned PDF pages and images are OCR'd.
+    Returns a list of {"page", "source", "text"} where source is "text_layer",
+    "ocr" or "ocr_cache".
+    """
+    if isinstance(paths, (str, os.PathLike)):
+        paths = [paths]
+
+    settings = ocr_settings()
+    pages, tasks = [], []
+    for path in paths:
+        kind = sniff_file_type(path)
+        offset = len(pages)
+        if kind == "pdf":
+            layer = _read_text_layer(path)
+            if layer is None:
+                layer = [_empty_layer_page() for _ in range(pdfinfo_from_path(path, poppler_path=POPPLER_PATH)["Pages"])]
+            for i, layer_page in enumerate(layer):
+                if _text_layer_is_usable(layer_page):
+                    pages.append({"page": offset + i + 1, "source": "text_layer", "text": layer_page["text"].strip()})
+                else:
+                    pages.append({"page": offset + i + 1, "source": "ocr", "text": None})
+            to_ocr = [i + 1 for i in range(len(layer)) if pages[offset + i]["source"] == "ocr"]
+            for window in _page_windows(to_ocr):
+                tasks.append((_ocr_page_window, (path, window, settings), [offset + n for n in window]))
+        elif kind in IMAGE_TYPES:
+            pages.append({"page": offset + 1, "source": "ocr", "text": None})
+            tasks.append((_ocr_image_file, (path, settings), [offset + 1]))
+        else:
+            raise ValueError(f"Unsupported report file type: {os.path.basename(path)}")
+
+    for page_numbers, results in _run_ocr_tasks(tasks):
+        for page_no, (text, source) in zip(page_numbers, results):
+            pages[page_no - 1].update(text=text, source=source)
+
+    return pages
+
+
+def format_pages(pages):
+    return "\n\n".join(f"--- Page {p['page']} ---\n{p['text']}" for p in pages)
+
+
+def extract_text_from_report(paths):
+    pages = extract_pages(paths)
+    counts = {source: sum(p["source"] == source for p in pages) for source in ("text_layer", "ocr_cache", "ocr")}
+    print(f"📄 {len(pages)} page(s): {counts['text_layer']} from text layer, "
+          f"{counts['ocr_cache']} from OCR cache, {counts['ocr']} via OCR")
+    return format_pages(pages)
+
+
+
+# "single": one LLM call returns the summary and the parameters together
+# "two_call": separate summary and extraction calls, kept for comparison
+INGEST_LLM_MODE = os.getenv("INGEST_LLM_MODE", "single")
+# How many times the model is asked to repair JSON that fails validation
+LLM_JSON_RETRIES = int(os.getenv("LLM_JSON_RETRIES", "1"))
+
+_REPORT_JSON_FIELDS = """  "report_type": "...",
   "report_date": "YYYY-MM-DD",
   "parameters": [
     {{
@@ -89,64 +582,423 @@ Extract the following JSON object:
       "high_range": float
     }},
     ...
-  ]
+  ]"""
+
+EXTRACTION_PROMPT = PromptTemplate(
+    input_variables=["ocr"],
+    template="""
+You are a medical report data extractor.
+
+Given this OCR medical report text:
+{ocr}
+
+Extract the following JSON object:
+
+{{
+""" + _REPORT_JSON_FIELDS + """
 }}
 Only return valid JSON. Do not add comments or explanations.
 """
-    )
+)
+
+SUMMARY_AND_EXTRACTION_PROMPT = PromptTemplate(
+    input_variables=["ocr"],
+    template="""
+You are a medical assistant AI and medical report data extractor.
+
+Given this OCR medical report text:
+{ocr}
+
+Return one JSON object with:
+- "summary": a clean and professional medical summary of the overall findings, trends, or any red flags
+- the report type, date and every test parameter
+
+{{
+  "summary": "...",
+""" + _REPORT_JSON_FIELDS + """
+}}
+Only return valid JSON. Do not add comments or explanations.
+"""
+)
+
+JSON_REPAIR_PROMPT = PromptTemplate(
+    input_variables=["errors", "reply"],
+    template="""
+The JSON below does not match the required format.
+
+Problems:
+{errors}
+
+JSON to fix:
+{reply}
+
+Return only the corrected JSON object, with numbers as plain numbers and dates as YYYY-MM-DD.
+"""
+)
+
+
+def _parse_json_output(text):
+    """Pulls the JSON object out of a model reply, tolerating code fences, surrounding prose and trailing commas."""
+    start, end = text.find("{"), text.rfind("}")
+    if start == -1 or end <= start:
+        raise ValueError("no JSON object found")
+    candidate = text[start:end + 1]
     try:
-        # 3. Call LLM
-        formatted_input = prompt.format(ocr=ocr_text)
-        result = model.invoke(formatted_input)
-
-        # 4. Clean and parse JSON
-        text_output = result.content
-        json_data = json.loads(text_output)
-
-        report_type = json_data['report_type']
-        report_date = json_data['report_date']
-        full_text = ocr_text
-        # 5. Insert into reports table
-        cursor.execute("""
-            INSERT INTO reports (user_id, report_type, report_date, report_data)
-            OUTPUT INSERTED.report_id
-            VALUES (?, ?, ?, ?)
-        """, (user_id, report_type, report_date, summary))
-        report_id = cursor.fetchone()[0]
-
-        # 6. Insert each parameter
-        for param in json_data['parameters']:
-            cursor.execute("""
-                INSERT INTO report_parameters (
-                    report_id, parameter_name, paramter_value, unit, low_range, high_range
-                ) VALUES (?, ?, ?, ?, ?, ?)
-            """, (
-                report_id,
-                param['parameter_name'],
-                param['parameter_value'],
-                param['unit'],
-                param['low_range'],
-                param['high_range']
-            ))
+        return json.loads(candidate)
+    except json.JSONDecodeError:
+        return json.loads(re.sub(r",\s*([}\]])", r"\1", candidate))
+
+
+def _to_number(value):
+    if value is None or value == "":
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    match = re.search(r"-?\d[\d,]*(?:\.\d+)?", str(value))
+    if not match:
+        raise ValueError(f"not a number: {value!r}")
+    return float(match.group().replace(",", ""))
+
+
+def validate_report_json(data, require_summary=False):
+    """
+    Checks extracted report JSON and normalizes numbers, units and the date.
+    Returns (clean_data, errors). clean_data is None when the structure itself
+    is unusable; otherwise bad parameter rows are dropped and listed in errors.
+    """
+    if not isinstance(data, dict):
+        return None, ["the top level must be a JSON object"]
+
+    errors, fatal = [], False
+    clean = {"report_date": None, "parameters": []}
+    if require_summary:
+        summary = data.get("summary")
+        if isinstance(summary, str) and summary.strip():
+            clean["summary"] = summary.strip()
+        else:
+            errors.append('"summary" must be a non-empty string')
+            fatal = True
+
+    report_type = data.get("report_type")
+    if isinstance(report_type, str) and report_type.strip():
+        clean["report_type"] = report_type.strip()
+    else:
+        errors.append('"report_type" must be a non-empty string')
+        fatal = True
+
+    if data.get("report_date"):
+        try:
+            clean["report_date"] = datetime.strptime(str(data["report_date"])[:10], "%Y-%m-%d").strftime("%Y-%m-%d")
+        except ValueError:
+            errors.append('"report_date" must be a YYYY-MM-DD date')
+
+    parameters = data.get("parameters")
+    if not isinstance(parameters, list):
+        errors.append('"parameters" must be a list')
+        return None, errors
+    for i, param in enumerate(parameters):
+        if not isinstance(param, dict) or not str(param.get("parameter_name") or "").strip():
+            errors.append(f"parameters[{i}] needs a parameter_name")
+            continue
+        try:
+            value = _to_number(param.get("parameter_value"))
+            low, high = _to_number(param.get("low_range")), _to_number(param.get("high_range"))
+        except ValueError as e:
+            errors.append(f"parameters[{i}] ({param['parameter_name']}): {e}")
+            continue
+        if value is None:
+            errors.append(f"parameters[{i}] ({param['parameter_name']}) has no parameter_value")
+            continue
+        clean["parameters"].append({
+            "parameter_name": str(param["parameter_name"]).strip(),
+            "parameter_value": value,
+            "unit": str(param.get("unit") or ""),
+            "low_range": low,
+            "high_range": high,
+        })
+
+    return (None if fatal else clean), errors
+
+
+def _generate_report_json(prompt, require_summary=False):
+    """
+    Calls the extraction model and validates its JSON, asking it to repair
+    invalid output. When repairs run out, the usable reply with the fewest
+    dropped rows is returned, even if a later repair made things worse.
+    """
+    reply = generate(prompt, repo_id=EXTRACTION_MODEL, **EXTRACTION_PARAMS)
+    best = None  # (data, errors) of the best usable reply so far
+    for attempt in range(LLM_JSON_RETRIES + 1):
+        try:
+            data, errors = validate_report_json(_parse_json_output(reply), require_summary)
+        except ValueError as e:
+            data, errors = None, [f"invalid JSON: {e}"]
+        if not errors:
+            return data
+        if data is not None and (best is None or len(errors) < len(best[1])):
+            best = data, errors
+        if attempt == LLM_JSON_RETRIES:
+            break
+        repair = JSON_REPAIR_PROMPT.format(errors="\n".join(f"- {e}" for e in errors), reply=reply)
+        reply = generate(repair, repo_id=EXTRACTION_MODEL, **EXTRACTION_PARAMS)
+
+    if best is None:
+        raise ValueError("Model returned invalid report JSON: " + "; ".join(errors))
+    data, errors = best
+    print("⚠️ Dropped invalid parameter rows:", "; ".join(errors))
+    return data
+
+
+def _extract_report_data_llm(ocr_text):
+    """
+    Asks the LLM for the report type, date and parameters as JSON. Text longer
+    than SUMMARY_SINGLE_CALL_TOKENS is split like a summary and extracted part
+    by part, SUMMARY_CONCURRENCY at a time, and the parts' results combined.
+    """
+    if count_tokens(ocr_text) <= SUMMARY_SINGLE_CALL_TOKENS:
+        return _generate_report_json(EXTRACTION_PROMPT.format(ocr=ocr_text))
+
+    chunks = split_for_summary(ocr_text, SUMMARY_CHUNK_TOKENS)
+
+    def extract(chunk):
+        try:
+            return _generate_report_json(EXTRACTION_PROMPT.format(ocr=chunk))
+        except ValueError as e:
+            print("⚠️ Skipped a report part with invalid extraction output:", str(e))
+            return None
+
+    with ThreadPoolExecutor(max_workers=max(1, min(SUMMARY_CONCURRENCY, len(chunks)))) as pool:
+        parts = [data for data in pool.map(extract, chunks) if data is not None]
+    if not parts:
+        raise ValueError(f"Model returned invalid report JSON for all {len(chunks)} parts of the report")
+    print(f"🧪 Extracted {len(parts)} of {len(chunks)} report part(s)")
+
+    # The first part naming a type, date or parameter wins; later pages often repeat headers
+    combined = {"report_type": next((d["report_type"] for d in parts if d.get("report_type")), None),
+                "report_date": next((d["report_date"] for d in parts if d.get("report_date")), None),
+                "parameters": []}
+    seen = set()
+    for data in parts:
+        for param in data["parameters"]:
+            if param["parameter_name"] not in seen:
+                seen.add(param["parameter_name"])
+                combined["parameters"].append(param)
+    return combined
+
+
+def _needs_llm(parsed):
+    rows = parsed["parameters"]
+    confident = [p for p in rows if p["confidence"] >= LAB_PARSER_MIN_CONFIDENCE]
+    return parsed["report_type"] is None or not confident or len(confident) < len(rows)
+
+
+def _merge_extraction(parsed, llm_data):
+    """Combines rule-parsed rows with LLM rows (if any) into the report_data stored for a report."""
+    rows = parsed["parameters"]
+    confident = [p for p in rows if p["confidence"] >= LAB_PARSER_MIN_CONFIDENCE]
+
+    report_type = parsed["report_type"]
+    report_date = parsed["report_date"]
+    parameters = [dict(p) for p in confident]
+    llm_rows = 0
+    if llm_data is not None:
+        report_type = report_type or llm_data["report_type"]
+        report_date = report_date or llm_data["report_date"]
+        have = {p["parameter_name"] for p in confident}
+        for param in llm_data["parameters"]:
+            name = canonical_parameter_name(param["parameter_name"], report_type) or param["parameter_name"]
+            if name not in have:
+                parameters.append({**param, "parameter_name": name})
+                have.add(name)
+                llm_rows += 1
+        # Keep a low-confidence rule row if the LLM didn't return that parameter at all
+        parameters += [dict(p) for p in rows if p["parameter_name"] not in have]
+
+    for param in parameters:
+        param.pop("confidence", None)
+    metrics = {"rule_rows": len(parameters) - llm_rows, "llm_rows": llm_rows, "llm_called": llm_data is not None}
+    print(f"🧪 {report_type} parameters: {metrics['rule_rows']} by rules, {llm_rows} by LLM")
+    return {
+        "report_type": report_type,
+        # The upload date is a better fallback than an extra LLM call just for the date
+        "report_date": report_date or datetime.now().strftime("%Y-%m-%d"),
+        "parameters": parameters,
+        "extraction": metrics,
+    }
+
+
+def extract_report_data(ocr_text):
+    """
+    Extracts the report type, date and parameters. Known report families are
+    parsed by rules; the LLM is only called for unknown formats or when some
+    rows couldn't be parsed confidently. report_data["extraction"] records how
+    many rows came from each path.
+    """
+    parsed = parse_lab_report(ocr_text)
+    return _merge_extraction(parsed, _extract_report_data_llm(ocr_text) if _needs_llm(parsed) else None)
+
+
+def summarize_and_extract(ocr_text):
+    """
+    Produces the summary and report data with a single LLM call, instead of
+    generate_summary + extract_report_data sending the text twice.
+    Returns (summary, report_data).
+    """
+    parsed = parse_lab_report(ocr_text)
+    if not _needs_llm(parsed):
+        # Rules found every parameter, so only the prose summary needs the model
+        return generate_summary(ocr_text), _merge_extraction(parsed, None)
+    if count_tokens(ocr_text) > SUMMARY_SINGLE_CALL_TOKENS:
+        # Too long for one combined prompt; the summary goes through map-reduce and extraction part by part
+        return generate_summary(ocr_text), _merge_extraction(parsed, _extract_report_data_llm(ocr_text))
+    data = _generate_report_json(SUMMARY_AND_EXTRACTION_PROMPT.format(ocr=ocr_text), require_summary=True)
+    return data["summary"], _merge_extraction(parsed, data)
+
+
+# How store_report writes a report:
+#   "openjson"    - report row and all parameters in one batch (1 round trip)
+#   "executemany" - report row, then parameters via fast_executemany (2 round trips)
+#   "loop"        - one INSERT per parameter (1 + N round trips)
+REPORT_WRITE_MODE = os.getenv("REPORT_WRITE_MODE", "openjson")
+
+_PARAM_COLUMNS = ("parameter_name", "parameter_value", "unit", "low_range", "high_range")
+
+_INSERT_REPORT_OPENJSON = """
+    DECLARE @ids TABLE (report_id INT);
+    INSERT INTO reports (user_id, report_type, report_date, report_data)
+    OUTPUT INSERTED.report_id INTO @ids
+    VALUES (?, ?, ?, ?);
+    INSERT INTO report_parameters (report_id, parameter_name, paramter_value, unit, low_range, high_range)
+    SELECT (SELECT report_id FROM @ids), p.parameter_name, p.parameter_value, p.unit, p.low_range, p.high_range
+    FROM OPENJSON(?) WITH (
+        parameter_name NVARCHAR(255) '$.parameter_name',
+        parameter_value FLOAT '$.parameter_value',
+        unit NVARCHAR(100) '$.unit',
+        low_range FLOAT '$.low_range',
+        high_range FLOAT '$.high_range'
+    ) AS p;
+    SELECT report_id FROM @ids;
+"""
 
-        conn.commit()
-        print("✅ Report and parameters inserted successfully.")
 
-    except Exception as e:
-        print("❌ Error processing report:", str(e))
+def _write_report(cursor, user_id, report_data, summary, replace_report_id=None, mode=None):
+    """Writes the report and its parameters on an open cursor and returns the report_id."""
+    mode = mode or REPORT_WRITE_MODE
+    report_row = (user_id, report_data['report_type'], report_data['report_date'], summary)
+    delete_sql = """
+        DELETE FROM report_parameters WHERE report_id = ?;
+        DELETE FROM reports WHERE report_id = ? AND user_id = ?;
+    """
+    delete_args = (replace_report_id, replace_report_id, user_id) if replace_report_id is not None else ()
+
+    if mode == "openjson":
+        params_json = json.dumps([{k: p.get(k) for k in _PARAM_COLUMNS} for p in report_data['parameters']])
+        cursor.execute("SET NOCOUNT ON;" + (delete_sql if delete_args else "") + _INSERT_REPORT_OPENJSON,
+                       (*delete_args, *report_row, params_json))
+        return cursor.fetchone()[0]
+
+    if delete_args:
+        cursor.execute(delete_sql, delete_args)
+    cursor.execute("""
+        INSERT INTO reports (user_id, report_type, report_date, report_data)
+        OUTPUT INSERTED.report_id
+        VALUES (?, ?, ?, ?)
+    """, report_row)
+    report_id = cursor.fetchone()[0]
+
+    rows = [(report_id, *(p[k] for k in _PARAM_COLUMNS)) for p in report_data['parameters']]
+    insert_param = """
+        INSERT INTO report_parameters (
+            report_id, parameter_name, paramter_value, unit, low_range, high_range
+        ) VALUES (?, ?, ?, ?, ?, ?)
+    """
+    if mode == "executemany":
+        if rows:
+            cursor.fast_executemany = True
+            cursor.executemany(insert_param, rows)
+    else:
+        for row in rows:
+            cursor.execute(insert_param, row)
+    return report_id
+
+
+def store_report(user_id, report_data, summary, replace_report_id=None):
+    """Inserts the report row and its parameters, returning the new report_id.
+    If replace_report_id is given, that report is deleted in the same transaction."""
+    conn=get_connection()
+    cursor=conn.cursor()
+    try:
+        report_id = _write_report(cursor, user_id, report_data, summary, replace_report_id)
+        conn.commit()
+        invalidate_user(user_id)
+        return report_id
+    except Exception:
         conn.rollback()
+        raise
     finally:
         cursor.close()
         conn.close()
 
 
-
-# Example usage
-def extract_and_store(user_id,path):
-    pdf_path=path
-    text=extract_text_from_report(pdf_path)
-    summary=generate_summary(text)
-    report_insertion(user_id,text,summary)
-
+def report_insertion(user_id,ocr_text,summary):
+    try:
+        # The LLM call finishes before a DB connection is opened
+        report_data = extract_report_data(ocr_text)
+        store_report(user_id, report_data, summary)
+        print("✅ Report and parameters inserted successfully.")
+    except Exception as e:
+        print("❌ Error processing report:", str(e))
 
 
+def ingest_report(user_id, path, force=False, on_stage=None):
+    """
+    Runs OCR, summary and parameter extraction for an uploaded report and stores it.
+    path may be a list of files (e.g. photos of each page) making up one report.
+    Results are cached by the file's SHA-256: re-uploading a file the user already
+    has is a no-op, and a file seen for another user skips OCR and the LLM.
+    force=True reprocesses from scratch and replaces the user's existing report.
+    on_stage(name) is called as each stage starts ("ocr", "summarizing",
+    "extracting") and with "stored" at the end.
+    Returns {"report_id", "status", "extraction"} with status "existing", "cached"
+    or "processed" and extraction holding the rule/LLM row counts.
+    """
+    on_stage = on_stage or (lambda stage: None)
+    sha256 = content_sha256(path)
+    existing_id = get_user_report(sha256, user_id)
+    if existing_id is not None and not force:
+        print("♻️ Report already ingested, skipping.")
+        on_stage("stored")
+        return {"report_id": existing_id, "status": "existing"}
+
+    cached = None if force else get_cached_result(sha256)
+    if cached:
+        text, summary, report_data = cached["ocr_text"], cached["summary"], cached["report_data"]
+        status = "cached"
+    else:
+        on_stage("ocr")
+        text = extract_text_from_report(path)
+        on_stage("summarizing")
+        if INGEST_LLM_MODE == "single":
+            summary, report_data = summarize_and_extract(text)
+        else:
+            summary = generate_summary(text)
+            on_stage("extracting")
+            report_data = extract_report_data(text)
+        report_data["extraction"]["mode"] = INGEST_LLM_MODE
+        save_result(sha256, text, summary, report_data)
+        status = "processed"
+
+    report_id = store_report(user_id, report_data, summary, replace_report_id=existing_id)
+    link_user_report(sha256, user_id, report_id)
+    on_stage("stored")
+    print("✅ Report and parameters inserted successfully.")
+    return {"report_id": report_id, "status": status, "extraction": report_data.get("extraction")}
+
+
+def extract_and_store(user_id, path, force=False):
+    """Synchronous ingestion; returns ingest_report's result, or None if processing failed."""
+    try:
+        return ingest_report(user_id, path, force=force)
+    except Exception as e:
+        print("❌ Error processing report:", str(e))
+        return None
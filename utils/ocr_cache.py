@@ -0,0 +1,98 @@
+import hashlib
+import json
+import os
+import time
+from config.db_connection import get_local_connection
+
+# ---------------------------
+# Page-level OCR cache
+# ---------------------------
+# OCR output per rasterized page, keyed by a hash of the page pixels plus the
+# OCR settings. Shared letterhead/terms pages and re-uploads with one changed
+# page skip EasyOCR. Least recently used entries are evicted beyond the cap.
+OCR_PAGE_CACHE_ENABLED = os.getenv("OCR_PAGE_CACHE", "true").lower() == "true"
+OCR_PAGE_CACHE_MAX_ENTRIES = int(os.getenv("OCR_PAGE_CACHE_MAX_ENTRIES", "5000"))
+
+
+def _connect():
+    conn = get_local_connection("ocr_pages")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS ocr_pages (
+            cache_key TEXT PRIMARY KEY,
+            text TEXT,
+            last_used REAL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS ocr_pages_lru ON ocr_pages (last_used)")
+    # Counters are kept here rather than in memory so hits in OCR worker processes are counted too
+    conn.execute("CREATE TABLE IF NOT EXISTS ocr_page_stats (stat TEXT PRIMARY KEY, value INTEGER)")
+    return conn
+
+
+def page_cache_key(image, settings, languages):
+    digest = hashlib.sha256()
+    digest.update(f"{image.mode}:{image.size}".encode())
+    digest.update(image.tobytes())
+    digest.update(json.dumps({"settings": settings, "languages": languages}, sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+def _count(conn, stat, n=1):
+    conn.execute(
+        "INSERT INTO ocr_page_stats (stat, value) VALUES (?, ?) "
+        "ON CONFLICT(stat) DO UPDATE SET value = value + excluded.value",
+        (stat, n),
+    )
+
+
+def get_page_text(cache_key):
+    """Returns the cached OCR text for a page, or None."""
+    if not OCR_PAGE_CACHE_ENABLED:
+        return None
+    conn = _connect()
+    try:
+        row = conn.execute("SELECT text FROM ocr_pages WHERE cache_key = ?", (cache_key,)).fetchone()
+        if row:
+            conn.execute("UPDATE ocr_pages SET last_used = ? WHERE cache_key = ?", (time.time(), cache_key))
+        _count(conn, "hits" if row else "misses")
+        conn.commit()
+    finally:
+        conn.close()
+    return row[0] if row else None
+
+
+def put_page_text(cache_key, text):
+    if not OCR_PAGE_CACHE_ENABLED:
+        return
+    conn = _connect()
+    try:
+        conn.execute(
+            "INSERT OR REPLACE INTO ocr_pages (cache_key, text, last_used) VALUES (?, ?, ?)",
+            (cache_key, text, time.time()),
+        )
+        evicted = conn.execute("""
+            DELETE FROM ocr_pages WHERE cache_key IN (
+                SELECT cache_key FROM ocr_pages ORDER BY last_used DESC LIMIT -1 OFFSET ?
+            )
+        """, (OCR_PAGE_CACHE_MAX_ENTRIES,)).rowcount
+        if evicted:
+            _count(conn, "evictions", evicted)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def page_cache_stats():
+    """Hit/miss/eviction counts across all processes plus the current cache size."""
+    conn = _connect()
+    try:
+        entries = conn.execute("SELECT COUNT(*) FROM ocr_pages").fetchone()[0]
+        stats = {"hits": 0, "misses": 0, "evictions": 0}
+        stats.update(conn.execute("SELECT stat, value FROM ocr_page_stats").fetchall())
+    finally:
+        conn.close()
+    lookups = stats["hits"] + stats["misses"]
+    stats["hit_rate"] = round(stats["hits"] / lookups, 3) if lookups else None
+    stats["entries"] = entries
+    stats["max_entries"] = OCR_PAGE_CACHE_MAX_ENTRIES
+    return stats
@@ -0,0 +1,93 @@
+import os
+from utils.llm import count_tokens, LLM_CHARS_PER_TOKEN
+
+# ---------------------------
+# Prompt token budget
+# ---------------------------
+# Prompts built from user data (profile, report summaries, retrieved guideline
+# chunks) are assembled here so they can't grow without limit as report history
+# builds up. Each section is a list of items with a priority; when the prompt is
+# over budget, the lowest-priority sections are trimmed first, either by
+# dropping trailing items ("drop", for ranked chunks) or by shortening every
+# item evenly ("shrink", for summaries that should all stay represented).
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "4000"))
+
+
+def truncate_to_tokens(text, max_tokens):
+    """Cuts text to about max_tokens, preferring to end on a line or sentence boundary."""
+    if count_tokens(text) <= max_tokens:
+        return text
+    if max_tokens <= 0:
+        return ""
+    cut = text[:int(max_tokens * LLM_CHARS_PER_TOKEN) - 2]
+    boundary = max(cut.rfind("\n"), cut.rfind(". "))
+    if boundary > len(cut) * 0.8:
+        cut = cut[:boundary + 1]
+    return cut.rstrip() + " …"
+
+
+def _section_text(section):
+    return section.get("joiner", "\n\n").join(section["items"])
+
+
+def _drop_items(items, target, joiner):
+    kept = []
+    for item in items:
+        if count_tokens(joiner.join(kept + [item])) > target:
+            if not kept:
+                kept.append(truncate_to_tokens(item, target))
+            break
+        kept.append(item)
+    return kept
+
+
+def _shrink_items(items, target, joiner):
+    # Water-filling: short items stay whole, the rest share what's left equally
+    available = target - count_tokens(joiner) * (len(items) - 1)
+    cap, remaining = None, available
+    for k, size in enumerate(sorted(count_tokens(item) for item in items)):
+        share = remaining / (len(items) - k)
+        if size > share:
+            cap = int(share)
+            break
+        remaining -= size
+    if cap is None:
+        return list(items)
+    return [truncate_to_tokens(item, cap) for item in items]
+
+
+def assemble_prompt(template, sections, budget=None, label="prompt"):
+    """
+    Fills template (str.format placeholders named after the sections) with the
+    sections, trimmed to fit the token budget. Each section is a dict:
+        name      placeholder name
+        items     list of text pieces
+        priority  lower numbers are kept longest
+        trim      "drop" (remove trailing items) or "shrink" (shorten all items)
+        joiner    separator between items (default a blank line)
+        min_tokens  never trim the section below this
+    Logs the token count of every section before and after trimming.
+    """
+    budget = budget or PROMPT_TOKEN_BUDGET
+    fixed = count_tokens(template.format(**{s["name"]: "" for s in sections}))
+    before = {s["name"]: count_tokens(_section_text(s)) for s in sections}
+    over = fixed + sum(before.values()) - budget
+
+    sections = [dict(s, items=[i for i in s["items"] if i and i.strip()]) for s in sections]
+    for section in sorted(sections, key=lambda s: s["priority"], reverse=True):
+        if over <= 0:
+            break
+        current = count_tokens(_section_text(section))
+        target = max(section.get("min_tokens", 0), current - over)
+        if target >= current:
+            continue
+        trim = _drop_items if section.get("trim", "drop") == "drop" else _shrink_items
+        section["items"] = trim(section["items"], target, section.get("joiner", "\n\n"))
+        over -= current - count_tokens(_section_text(section))
+
+    prompt = template.format(**{s["name"]: _section_text(s) for s in sections})
+    after = {s["name"]: count_tokens(_section_text(s)) for s in sections}
+    detail = ", ".join(f"{name} {before[name]}" + (f"→{after[name]}" if after[name] != before[name] else "")
+                       for name in before)
+    print(f"🧮 {label} prompt: {count_tokens(prompt)} tokens (budget {budget}; {detail})")
+    return prompt
@@ -1,7 +1,8 @@
 from langchain_community.document_loaders import PyPDFLoader
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain_community.vectorstores import FAISS
-from langchain_huggingface import HuggingFaceEmbeddings
+from utils.embeddings import get_embeddings
+from utils.vector_store import save_store
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -18,10 +19,10 @@ text_splitter = RecursiveCharacterTextSplitter(
 chunks = text_splitter.split_documents(docs)
 
 # Initialize embeddings
-embeddings = HuggingFaceEmbeddings(model_name="all-MiniLM-L6-v2")
+embeddings = get_embeddings()
 
 # Create FAISS vector store from chunks
 vectorstore = FAISS.from_documents(chunks, embeddings)
 
-# Save FAISS index locally
-vectorstore.save_local("faiss_index")
+# Save FAISS index locally (read memory-mapped by utils/advisories.py)
+save_store(vectorstore, "faiss_index")
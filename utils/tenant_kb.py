@@ -0,0 +1,384 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import faiss
+import numpy as np
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+from utils.embeddings import embed_texts
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+# ---------------------------
+# Multi-tenant knowledge-base store (USER_KB_STORE=tenant)
+# ---------------------------
+# All users' chunks live in TENANT_SHARDS FAISS files instead of one
+# directory per user. A user always maps to the same shard (user_id modulo
+# the shard count). Vector ids are user_id << 32 | seq, so a user's vectors
+# are the id range [user_id << 32, (user_id + 1) << 32). Chunk text, metadata
+# and the per-user manifests are kept in a SQLite sidecar (docs.sqlite3)
+# keyed by those ids.
+# A search gathers only the user's own vectors from the shard (a few dozen
+# at most) and ranks them exactly. Its cost therefore depends on the size of
+# that user's KB, not on how many tenants share the shard.
+# Every app process keeps its own copy of the shards it has read. A shard is
+# read again when its file changes on disk, and reads and writes hold a file
+# lock per shard so another process's write is never seen half done.
+TENANT_INDEX_DIR = Path(os.getenv("TENANT_INDEX_DIR", "faiss_tenants"))
+TENANT_SHARDS = int(os.getenv("TENANT_SHARDS", "64"))
+
+_shards: Dict[int, Tuple[faiss.Index, Optional[Tuple[int, int]]]] = {}  # shard -> (index, file stamp)
+_shard_locks = [threading.Lock() for _ in range(TENANT_SHARDS)]
+_dirty = set()
+_stats_lock = threading.Lock()
+_stats = {"searches": 0, "search_seconds": 0.0, "shard_loads": 0, "shard_load_seconds": 0.0, "shard_saves": 0}
+
+
+def vector_id_range(user_id: int) -> Tuple[int, int]:
+    """First and last vector id a user's chunks can have."""
+    if not 0 <= user_id < 2 ** 31:
+        raise ValueError(f"user_id {user_id} is outside the range the vector ids can hold")
+    return user_id << 32, (user_id << 32) | 0xFFFFFFFF
+
+
+def shard_of(user_id: int) -> int:
+    return user_id % TENANT_SHARDS
+
+
+def _shard_path(shard: int) -> Path:
+    return TENANT_INDEX_DIR / f"shard_{shard:03d}.faiss"
+
+
+def _connect():
+    TENANT_INDEX_DIR.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(TENANT_INDEX_DIR / "docs.sqlite3", timeout=30, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS chunks (
+            vector_id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            chunk_id TEXT NOT NULL,
+            text TEXT NOT NULL,
+            metadata TEXT NOT NULL,
+            UNIQUE (user_id, chunk_id)
+        )
+    """)
+    conn.execute("CREATE TABLE IF NOT EXISTS manifests (user_id INTEGER PRIMARY KEY, manifest TEXT NOT NULL)")
+    return conn
+
+
+def _file_stamp(path: Path) -> Optional[Tuple[int, int]]:
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+@contextmanager
+def _locked(shard: int, exclusive: bool = True):
+    """Holds the shard's thread lock and its file lock, which other processes take too. Readers share the
+    file lock (exclusive=False); on Windows it is always exclusive."""
+    with _shard_locks[shard]:
+        TENANT_INDEX_DIR.mkdir(parents=True, exist_ok=True)
+        with open(TENANT_INDEX_DIR / f"shard_{shard:03d}.lock", "a+b") as f:
+            if fcntl:
+                fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            else:
+                f.seek(0)
+                while True:
+                    try:
+                        msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                        break
+                    except OSError:  # LK_LOCK gives up after 10 seconds
+                        pass
+            try:
+                yield
+            finally:
+                if fcntl:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+                else:
+                    f.seek(0)
+                    msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def _get_shard(shard: int, dim: Optional[int] = None) -> Optional[faiss.Index]:
+    """The shard's index, read from disk on first use and again whenever another process has saved it.
+    Created empty if dim is given and it does not exist yet. Callers hold the shard lock."""
+    path = _shard_path(shard)
+    stamp = _file_stamp(path)
+    cached = _shards.get(shard)
+    # Unsaved changes (persist=False) are kept; bulk loads are the only writer while they run
+    if cached is not None and (cached[1] == stamp or shard in _dirty):
+        return cached[0]
+    if stamp is not None:
+        start = time.perf_counter()
+        index = faiss.read_index(str(path))
+        with _stats_lock:
+            _stats["shard_loads"] += 1
+            _stats["shard_load_seconds"] += time.perf_counter() - start
+    elif dim is not None:
+        index = faiss.IndexIDMap2(faiss.IndexFlatL2(dim))
+    else:
+        _shards.pop(shard, None)
+        return None
+    _shards[shard] = (index, stamp)
+    return index
+
+
+def _save_shard(shard: int) -> None:
+    """Writes the shard atomically. Callers hold the shard lock."""
+    path = _shard_path(shard)
+    tmp = path.with_suffix(".tmp")
+    index = _shards[shard][0]
+    faiss.write_index(index, str(tmp))
+    tmp.replace(path)
+    _shards[shard] = (index, _file_stamp(path))
+    _dirty.discard(shard)
+    with _stats_lock:
+        _stats["shard_saves"] += 1
+
+
+def save_shards() -> None:
+    """Writes every shard changed with persist=False (bulk loads and migrations)."""
+    for shard in sorted(_dirty):
+        with _locked(shard):
+            if shard in _dirty:
+                _save_shard(shard)
+
+
+# ---------------------------
+# Writes
+# ---------------------------
+
+def add_chunks(user_id: int, chunks: Dict[str, Tuple[str, Dict]], vectors=None, persist: bool = True) -> int:
+    """
+    Adds {chunk_id: (text, metadata)} for the user, embedding the texts unless
+    vectors (in the same order as chunks) are given. Chunk ids the user
+    already has are skipped.
+    Returns the number of chunks added.
+    """
+    lo, hi = vector_id_range(user_id)
+    shard = shard_of(user_id)
+    conn = _connect()
+    try:
+        with _locked(shard):
+            existing = {row[0] for row in conn.execute(
+                "SELECT chunk_id FROM chunks WHERE user_id = ?", (user_id,))}
+            chunk_ids = [c for c in chunks if c not in existing]
+            if not chunk_ids:
+                return 0
+            if vectors is None:
+                vectors = np.asarray(embed_texts([chunks[c][0] for c in chunk_ids]), dtype="float32")
+            else:
+                positions = {c: i for i, c in enumerate(chunks)}
+                vectors = np.asarray(vectors, dtype="float32")[[positions[c] for c in chunk_ids]]
+
+            last = conn.execute("SELECT MAX(vector_id) FROM chunks WHERE vector_id BETWEEN ? AND ?",
+                                (lo, hi)).fetchone()[0]
+            first = (last + 1) if last is not None else lo
+            if first + len(chunk_ids) - 1 > hi:
+                raise ValueError(f"user {user_id} has run out of vector ids")
+            ids = np.arange(first, first + len(chunk_ids), dtype="int64")
+
+            conn.executemany(
+                "INSERT INTO chunks (vector_id, user_id, chunk_id, text, metadata) VALUES (?, ?, ?, ?, ?)",
+                [(int(vid), user_id, c, chunks[c][0], json.dumps(chunks[c][1]))
+                 for vid, c in zip(ids, chunk_ids)],
+            )
+            _get_shard(shard, dim=vectors.shape[1]).add_with_ids(vectors, ids)
+            _dirty.add(shard)
+            if persist:
+                _save_shard(shard)
+            conn.commit()
+    finally:
+        conn.close()
+    return len(chunk_ids)
+
+
+def delete_chunks(user_id: int, chunk_ids: List[str], persist: bool = True) -> int:
+    """Removes the user's chunks with these ids. Returns the number removed."""
+    shard = shard_of(user_id)
+    conn = _connect()
+    try:
+        with _locked(shard):
+            vector_ids = []
+            for i in range(0, len(chunk_ids), 500):
+                batch = chunk_ids[i:i + 500]
+                vector_ids += [row[0] for row in conn.execute(
+                    f"SELECT vector_id FROM chunks WHERE user_id = ? AND chunk_id IN ({','.join('?' * len(batch))})",
+                    [user_id, *batch])]
+            if not vector_ids:
+                return 0
+            conn.executemany("DELETE FROM chunks WHERE vector_id = ?", [(vid,) for vid in vector_ids])
+            index = _get_shard(shard)
+            if index is not None:
+                index.remove_ids(np.asarray(vector_ids, dtype="int64"))
+                _dirty.add(shard)
+                if persist:
+                    _save_shard(shard)
+            conn.commit()
+    finally:
+        conn.close()
+    return len(vector_ids)
+
+
+def delete_user(user_id: int, persist: bool = True) -> int:
+    """Removes all of the user's chunks and their manifest."""
+    conn = _connect()
+    try:
+        chunk_ids = [row[0] for row in conn.execute("SELECT chunk_id FROM chunks WHERE user_id = ?", (user_id,))]
+        conn.execute("DELETE FROM manifests WHERE user_id = ?", (user_id,))
+        conn.commit()
+    finally:
+        conn.close()
+    return delete_chunks(user_id, chunk_ids, persist=persist)
+
+
+def user_chunk_count(user_id: int) -> int:
+    lo, hi = vector_id_range(user_id)
+    conn = _connect()
+    try:
+        return conn.execute("SELECT COUNT(*) FROM chunks WHERE vector_id BETWEEN ? AND ?", (lo, hi)).fetchone()[0]
+    finally:
+        conn.close()
+
+
+def user_chunk_ids(user_id: int) -> List[str]:
+    conn = _connect()
+    try:
+        return [row[0] for row in conn.execute("SELECT chunk_id FROM chunks WHERE user_id = ?", (user_id,))]
+    finally:
+        conn.close()
+
+
+def user_chunks(user_id: int) -> List[Tuple[str, Dict]]:
+    """The user's (text, metadata) chunks in the order they were added."""
+    lo, hi = vector_id_range(user_id)
+    conn = _connect()
+    try:
+        return [(text, json.loads(metadata)) for text, metadata in conn.execute(
+            "SELECT text, metadata FROM chunks WHERE vector_id BETWEEN ? AND ? ORDER BY vector_id", (lo, hi))]
+    finally:
+        conn.close()
+
+
+def get_manifest(user_id: int) -> Optional[Dict]:
+    conn = _connect()
+    try:
+        row = conn.execute("SELECT manifest FROM manifests WHERE user_id = ?", (user_id,)).fetchone()
+    finally:
+        conn.close()
+    return json.loads(row[0]) if row else None
+
+
+def save_manifest(user_id: int, manifest: Optional[Dict]) -> None:
+    """Stores the user's KB manifest (see utils/user_kb.py); None removes it."""
+    conn = _connect()
+    try:
+        if manifest is None:
+            conn.execute("DELETE FROM manifests WHERE user_id = ?", (user_id,))
+        else:
+            conn.execute("INSERT OR REPLACE INTO manifests (user_id, manifest) VALUES (?, ?)",
+                         (user_id, json.dumps(manifest)))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+# ---------------------------
+# Search
+# ---------------------------
+
+def search_by_vector(user_id: int, vector, k: int = 4) -> List[Tuple[Document, float]]:
+    """The user's k nearest chunks to the vector with their L2 distances, nearest first."""
+    start = time.perf_counter()
+    lo, hi = vector_id_range(user_id)
+    shard = shard_of(user_id)
+    conn = _connect()
+    try:
+        # The ids, the vectors and the rows are all read under the lock, so a concurrent delete can't remove
+        # any of them in between
+        with _locked(shard, exclusive=False):
+            ids = np.fromiter((row[0] for row in conn.execute(
+                "SELECT vector_id FROM chunks WHERE vector_id BETWEEN ? AND ?", (lo, hi))), dtype="int64")
+            if not len(ids):
+                return []
+            index = _get_shard(shard)
+            if index is None:
+                return []
+            vectors = index.reconstruct_batch(ids)
+            distances = ((vectors - np.asarray(vector, dtype="float32")) ** 2).sum(axis=1)
+            top = np.argsort(distances)[:k]
+            top_ids = [int(ids[i]) for i in top]
+            rows = dict((row[0], row[1:]) for row in conn.execute(
+                f"SELECT vector_id, text, metadata FROM chunks WHERE vector_id IN ({','.join('?' * len(top_ids))})",
+                top_ids))
+    finally:
+        conn.close()
+    results = [(Document(page_content=rows[vid][0], metadata=json.loads(rows[vid][1])), float(distances[i]))
+               for vid, i in zip(top_ids, top)]
+    with _stats_lock:
+        _stats["searches"] += 1
+        _stats["search_seconds"] += time.perf_counter() - start
+    return results
+
+
+def search(user_id: int, query: str, k: int = 4) -> List[Document]:
+    return [doc for doc, _ in search_by_vector(user_id, embed_texts([query])[0], k)]
+
+
+def search_batch(queries: List[Tuple[int, str]], k: int = 4) -> List[List[Document]]:
+    """Answers several (user_id, query) pairs, embedding all the queries in one call."""
+    vectors = embed_texts([query for _, query in queries])
+    return [[doc for doc, _ in search_by_vector(user_id, vector, k)]
+            for (user_id, _), vector in zip(queries, vectors)]
+
+
+class TenantRetriever(BaseRetriever):
+    """LangChain retriever over one user's chunks in the tenant store."""
+
+    user_id: int
+    k: int = 4
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        return search(self.user_id, query, self.k)
+
+
+class TenantUserStore:
+    """A user's slice of the tenant store, standing in for a per-user FAISS vector store."""
+
+    def __init__(self, user_id: int):
+        self.user_id = user_id
+
+    def as_retriever(self, search_kwargs: Optional[Dict] = None) -> TenantRetriever:
+        return TenantRetriever(user_id=self.user_id, k=(search_kwargs or {}).get("k", 4))
+
+
+def tenant_store_stats():
+    """Loaded shards, vectors and their bytes in memory, shard load times and search latency."""
+    with _stats_lock:
+        stats = dict(_stats)
+    vectors = resident = 0
+    for shard, (index, _) in list(_shards.items()):
+        with _shard_locks[shard]:
+            vectors += index.ntotal
+            # float32 vectors plus the id map and its reverse map
+            resident += index.ntotal * (index.d * 4 + 8 * 3)
+    stats.update({"shards_loaded": len(_shards), "vectors": vectors, "resident_bytes": resident})
+    stats["avg_search_ms"] = round(stats["search_seconds"] / stats["searches"] * 1000, 3) if stats["searches"] else None
+    stats["search_seconds"] = round(stats["search_seconds"], 3)
+    stats["shard_load_seconds"] = round(stats["shard_load_seconds"], 3)
+    return stats
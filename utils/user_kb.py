@@ -0,0 +1,517 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from langchain_community.vectorstores import FAISS
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+from config.db_connection import get_connection
+from utils import tenant_kb
+from utils.advisories import get_user_health_profile
+from utils.embeddings import get_embeddings
+from utils.vector_store import has_store, has_legacy_store, load_store, save_store, remove_store, store_stamp
+
+# ---------------------------
+# Per-user knowledge base
+# ---------------------------
+# One FAISS index per user in faiss_indexes/user_<id>/, built from sources:
+# the health profile, each latest report summary, and free text the user
+# added. Chunks are identified by a hash of their source and content, so a
+# sync only embeds chunks that are new, deletes the vectors of chunks that
+# changed or whose source is gone, and leaves everything else alone.
+# manifest.json next to the index records every source, the DB rows it was
+# built from and its chunk ids.
+# With USER_KB_STORE=tenant the chunks and manifests live in the shared,
+# sharded store of utils/tenant_kb.py instead; existing per-user directories
+# are moved there with `python -m utils.user_kb migrate`.
+USER_KB_STORE = os.getenv("USER_KB_STORE", "per_user")  # "per_user" or "tenant"
+BASE_INDEX_DIR = Path("faiss_indexes")  # each user will have faiss_indexes/user_<id>/
+BASE_INDEX_DIR.mkdir(parents=True, exist_ok=True)
+MANIFEST_FILE = "manifest.json"
+
+EMBEDDINGS = get_embeddings()
+SPLITTER = RecursiveCharacterTextSplitter(chunk_size=750, chunk_overlap=120)
+
+# Sources rebuilt from the database on every sync; anything else is user-added text
+DB_SOURCE_KINDS = ("profile", "reports")
+
+# Loaded vector stores kept in memory, least recently used evicted first
+USER_KB_CACHE_MAX_ENTRIES = int(os.getenv("USER_KB_CACHE_MAX_ENTRIES", "64"))
+USER_KB_CACHE_MAX_MB = float(os.getenv("USER_KB_CACHE_MAX_MB", "512"))
+
+_user_locks: Dict[int, threading.Lock] = {}
+_user_locks_guard = threading.Lock()
+
+
+def _user_lock(user_id: int) -> threading.Lock:
+    with _user_locks_guard:
+        return _user_locks.setdefault(user_id, threading.Lock())
+
+
+# ---------------------------
+# Sources
+# ---------------------------
+
+def get_latest_reports(user_id: int) -> List[Dict]:
+    """The latest report of each type: report_id, report_type, report_date and the summary."""
+    query = """
+    SELECT r1.report_id, r1.report_type, r1.report_date, r1.report_data
+    FROM reports r1
+    INNER JOIN (
+        SELECT report_type, MAX(report_date) AS max_date
+        FROM reports
+        WHERE user_id = ?
+        GROUP BY report_type
+    ) r2
+    ON r1.report_type = r2.report_type AND r1.report_date = r2.max_date
+    WHERE r1.user_id = ?
+    """
+    conn = get_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(query, (user_id, user_id))
+        rows = cursor.fetchall()
+    finally:
+        conn.close()
+    return [{"report_id": row[0], "report_type": row[1], "report_date": str(row[2]), "summary": row[3]}
+            for row in rows]
+
+
+def _profile_to_text(profile: Dict[str, str]) -> str:
+    return "\n".join([f"{k.replace('_',' ').title()}: {v}" for k, v in profile.items() if v is not None])
+
+
+def build_user_sources(user_id: int) -> Dict[str, Dict]:
+    """The DB-backed sources of the user's KB, keyed by source id."""
+    sources = {}
+    profile = get_user_health_profile(user_id)
+    if profile:
+        sources["profile"] = {
+            "kind": "profile",
+            "rows": [{"table": "user_health_profile", "user_id": user_id}],
+            "text": _profile_to_text(profile),
+        }
+    for report in get_latest_reports(user_id):
+        if report["summary"]:
+            sources[f"report:{report['report_id']}"] = {
+                "kind": "reports",
+                "rows": [{"table": "reports", "report_id": report["report_id"]}],
+                "text": f"{report['report_type']} Report Summary ({report['report_date']}):\n{report['summary']}",
+            }
+    return sources
+
+
+def _chunk_id(user_id: int, source_id: str, text: str) -> str:
+    return hashlib.sha256(f"{user_id}\n{source_id}\n{text}".encode()).hexdigest()
+
+
+def _chunk_source(user_id: int, source_id: str, source: Dict):
+    """Splits a source into {chunk_id: (text, metadata)}."""
+    chunks = {}
+    for text in SPLITTER.split_text(source["text"]):
+        chunks[_chunk_id(user_id, source_id, text)] = (
+            text, {"user_id": user_id, "type": source["kind"], "source": source_id, "rows": source["rows"]})
+    return chunks
+
+
+# ---------------------------
+# FAISS per-user helpers
+# ---------------------------
+
+def _user_index_dir(user_id: int) -> Path:
+    return BASE_INDEX_DIR / f"user_{user_id}"
+
+
+def _read_user_vectorstore(user_id: int, writable: bool = True) -> Optional[FAISS]:
+    if USER_KB_STORE == "tenant":
+        return tenant_kb.TenantUserStore(user_id) if tenant_kb.user_chunk_count(user_id) else None
+    return _read_index_dir(user_id, writable)
+
+
+def _read_index_dir(user_id: int, writable: bool = True) -> Optional[FAISS]:
+    """The user's index from disk; read-only stores are memory-mapped (see utils/vector_store.py)."""
+    udir = _user_index_dir(user_id)
+    if not has_store(udir) and not _needs_conversion(udir):
+        return None
+    try:
+        return load_store(udir, EMBEDDINGS, writable=writable)
+    except Exception as e:
+        print(f"⚠️ Could not read {udir}: {e}")
+        return None
+
+
+def _needs_conversion(udir: Path) -> bool:
+    """An index in an older on-disk format, which load_store converts on first read."""
+    return has_legacy_store(udir) or (not has_store(udir) and (udir / "index.faiss").exists())
+
+
+def load_manifest(user_id: int) -> Optional[Dict]:
+    if USER_KB_STORE == "tenant":
+        return tenant_kb.get_manifest(user_id)
+    path = _user_index_dir(user_id) / MANIFEST_FILE
+    if not path.exists():
+        return None
+    return json.loads(path.read_text())
+
+
+def _save_manifest(user_id: int, manifest: Dict) -> None:
+    if USER_KB_STORE == "tenant":
+        tenant_kb.save_manifest(user_id, manifest)
+        return
+    path = _user_index_dir(user_id) / MANIFEST_FILE
+    tmp = path.with_suffix(".tmp")
+    tmp.write_text(json.dumps(manifest, indent=2))
+    tmp.replace(path)
+
+
+# ---------------------------
+# Vector store cache
+# ---------------------------
+# Streamlit reruns the page on every interaction, and each rerun used to
+# read the user's index from disk again. Loaded stores are shared across
+# sessions here, keyed by user and stamped with the index file's mtime, so a
+# write from another process is picked up on the next lookup. Stores in the
+# cache are never modified: writers load their own copy, and
+# save_user_vectorstore swaps the saved store in. Sizes are estimated from
+# the index files.
+_vs_cache: "OrderedDict[int, tuple]" = OrderedDict()
+_vs_cache_lock = threading.Lock()
+_vs_cache_stats = {"hits": 0, "loads": 0, "evictions": 0, "invalidations": 0}
+
+
+def _index_stamp(user_id: int):
+    """(mtime_ns, bytes) of the user's index, or None if there is no index."""
+    return store_stamp(_user_index_dir(user_id))
+
+
+def _cache_put(user_id: int, vs: FAISS, stamp) -> None:
+    with _vs_cache_lock:
+        _vs_cache[user_id] = (vs, stamp)
+        _vs_cache.move_to_end(user_id)
+        max_bytes = USER_KB_CACHE_MAX_MB * 1024 * 1024
+        # Always keep the entry just added, even if it alone is over the limit
+        while len(_vs_cache) > 1 and (len(_vs_cache) > USER_KB_CACHE_MAX_ENTRIES
+                                      or sum(entry[1][1] for entry in _vs_cache.values()) > max_bytes):
+            _vs_cache.popitem(last=False)
+            _vs_cache_stats["evictions"] += 1
+
+
+def invalidate_user_vectorstore(user_id: int) -> None:
+    with _vs_cache_lock:
+        if _vs_cache.pop(user_id, None) is not None:
+            _vs_cache_stats["invalidations"] += 1
+
+
+def load_user_vectorstore(user_id: int) -> Optional[FAISS]:
+    """The user's vector store, from the in-memory cache when the index on disk has not changed."""
+    if USER_KB_STORE == "tenant":
+        # Shards stay loaded in utils/tenant_kb.py; there is nothing to cache per user
+        return _read_user_vectorstore(user_id)
+    if _needs_conversion(_user_index_dir(user_id)):
+        with _user_lock(user_id):
+            _read_index_dir(user_id)
+    stamp = _index_stamp(user_id)
+    if stamp is None:
+        invalidate_user_vectorstore(user_id)
+        return None
+    with _vs_cache_lock:
+        entry = _vs_cache.get(user_id)
+        if entry and entry[1] == stamp:
+            _vs_cache.move_to_end(user_id)
+            _vs_cache_stats["hits"] += 1
+            return entry[0]
+    vs = _read_user_vectorstore(user_id, writable=False)
+    if vs is None:
+        invalidate_user_vectorstore(user_id)
+        return None
+    with _vs_cache_lock:
+        _vs_cache_stats["loads"] += 1
+    _cache_put(user_id, vs, stamp)
+    return vs
+
+
+def save_user_vectorstore(user_id: int, vectorstore: FAISS) -> None:
+    udir = _user_index_dir(user_id)
+    udir.mkdir(parents=True, exist_ok=True)
+    save_store(vectorstore, udir)
+    _cache_put(user_id, vectorstore, _index_stamp(user_id))
+
+
+def vectorstore_cache_stats():
+    """Cache hits, disk loads, evictions, invalidations, resident stores and their estimated bytes."""
+    with _vs_cache_lock:
+        stats = dict(_vs_cache_stats)
+        stats["entries"] = len(_vs_cache)
+        stats["resident_bytes"] = sum(entry[1][1] for entry in _vs_cache.values())
+    lookups = stats["hits"] + stats["loads"]
+    stats["hit_rate"] = round(stats["hits"] / lookups, 3) if lookups else None
+    return stats
+
+
+# ---------------------------
+# Sync / Upsert / Delete
+# ---------------------------
+
+def _legacy_notes(vs: FAISS) -> Dict[str, Dict]:
+    """User-added text from an index built before manifests, kept as note sources when it is migrated."""
+    notes = {}
+    for doc in vs.docstore._dict.values():
+        kind = (doc.metadata or {}).get("type", "note")
+        if kind not in DB_SOURCE_KINDS:
+            notes[_note_source_id(kind, doc.page_content)] = {"kind": kind, "rows": [], "text": doc.page_content}
+    return notes
+
+
+def _join_overlapping(text: str, part: str) -> str:
+    # Consecutive chunks of a source share up to chunk_overlap characters
+    for size in range(min(len(text), len(part)), 0, -1):
+        if text.endswith(part[:size]):
+            return text + part[size:]
+    return text + "\n" + part
+
+
+def _tenant_notes(user_id: int) -> Dict[str, Dict]:
+    """
+    User-added text in the tenant store, for a user whose manifest is missing
+    (e.g. after a crash between add_chunks and save_manifest). Each note is
+    put back together from its stored chunks.
+    """
+    parts = {}
+    for text, metadata in tenant_kb.user_chunks(user_id):
+        kind = metadata.get("type", "note")
+        if kind not in DB_SOURCE_KINDS:
+            parts.setdefault((metadata.get("source"), kind), []).append(text)
+    notes = {}
+    for (_, kind), texts in parts.items():
+        text = texts[0]
+        for part in texts[1:]:
+            text = _join_overlapping(text, part)
+        notes[_note_source_id(kind, text)] = {"kind": kind, "rows": [], "text": text}
+    return notes
+
+
+def _apply_changes(user_id: int, vs: Optional[FAISS], manifest: Dict, remove: List[str], add: Dict) -> Optional[FAISS]:
+    """Deletes and embeds chunks, then saves the index and manifest. Only the added chunks are embedded."""
+    if USER_KB_STORE == "tenant":
+        if remove:
+            tenant_kb.delete_chunks(user_id, remove)
+        if add:
+            tenant_kb.add_chunks(user_id, add)
+        if not tenant_kb.user_chunk_count(user_id):
+            tenant_kb.save_manifest(user_id, None)
+            return None
+        tenant_kb.save_manifest(user_id, manifest)
+        return tenant_kb.TenantUserStore(user_id)
+    if remove and vs is not None:
+        # Only ids really in the index: vs.delete() raises on any it does not know
+        present = set(vs.index_to_docstore_id.values())
+        remove = [c for c in remove if c in present]
+        if remove:
+            vs.delete(remove)
+    if add:
+        ids = list(add)
+        texts = [add[i][0] for i in ids]
+        metadatas = [add[i][1] for i in ids]
+        if vs is None:
+            vs = FAISS.from_texts(texts, EMBEDDINGS, metadatas=metadatas, ids=ids)
+        else:
+            vs.add_texts(texts, metadatas=metadatas, ids=ids)
+    if vs is not None and not vs.index_to_docstore_id:
+        vs = None
+    if vs is None:
+        remove_store(_user_index_dir(user_id))
+        (_user_index_dir(user_id) / MANIFEST_FILE).unlink(missing_ok=True)
+        invalidate_user_vectorstore(user_id)
+        return None
+    save_user_vectorstore(user_id, vs)
+    _save_manifest(user_id, manifest)
+    return vs
+
+
+def rebuild_user_kb(user_id: int) -> Optional[FAISS]:
+    """
+    Brings the user's index in line with the DB (profile + latest summaries),
+    embedding only new or changed chunks. Returns the vector store, or None if
+    the KB is empty.
+    """
+    vs, _ = sync_user_kb(user_id)
+    return vs
+
+
+def sync_user_kb(user_id: int):
+    """Like rebuild_user_kb, also returning {"added", "deleted", "unchanged"} chunk counts."""
+    with _user_lock(user_id):
+        return _sync(user_id)
+
+
+def _stored_chunk_ids(user_id: int, vs) -> set:
+    """Chunk ids actually in the user's index, which is what a sync diffs against (not the manifest's record)."""
+    if vs is None:
+        return set()
+    if USER_KB_STORE == "tenant":
+        return set(tenant_kb.user_chunk_ids(user_id))
+    return set(vs.index_to_docstore_id.values())
+
+
+def _sync(user_id: int):
+    vs = _read_user_vectorstore(user_id)
+    manifest = load_manifest(user_id)
+    if manifest is None:
+        # Indexes from before manifests have random ids, and a tenant user's manifest may have been lost; their
+        # chunks are replaced, keeping added text
+        if vs is None:
+            notes = {}
+        elif USER_KB_STORE == "tenant":
+            notes = _tenant_notes(user_id)
+        else:
+            notes = _legacy_notes(vs)
+        manifest = {"sources": {source_id: dict(source, chunks=[]) for source_id, source in notes.items()}}
+
+    # DB sources are rebuilt from the DB; notes are only recorded in the manifest and re-chunked from its text
+    notes = {sid: e for sid, e in manifest["sources"].items() if e["kind"] not in DB_SOURCE_KINDS}
+    manifest["sources"] = {}
+    wanted = {}
+    for source_id, source in {**build_user_sources(user_id), **notes}.items():
+        chunks = _chunk_source(user_id, source_id, source)
+        wanted.update(chunks)
+        manifest["sources"][source_id] = {"kind": source["kind"], "rows": source["rows"], "text": source["text"],
+                                          "chunks": list(chunks)}
+
+    # An unreadable or missing index has no stored chunks, so everything is embedded again
+    stored = _stored_chunk_ids(user_id, vs)
+    remove = [c for c in stored if c not in wanted]
+    add = {c: chunk for c, chunk in wanted.items() if c not in stored}
+    vs = _apply_changes(user_id, vs, manifest, remove, add)
+    counts = {"added": len(add), "deleted": len(remove), "unchanged": len(stored & wanted.keys())}
+    print(f"🧠 KB sync for user {user_id}: {counts}")
+    return vs, counts
+
+
+def _note_source_id(kind: str, text: str) -> str:
+    return f"{kind}:{hashlib.sha256(text.strip().encode()).hexdigest()[:16]}"
+
+
+def upsert_free_text(user_id: int, texts: List[str], kind: str = "note") -> Optional[FAISS]:
+    """Adds arbitrary extra texts for the user (e.g., new report OCR text). Text already in the KB is skipped."""
+    with _user_lock(user_id):
+        vs = _read_user_vectorstore(user_id)
+        manifest = load_manifest(user_id)
+        if manifest is None or vs is None:
+            # Migrate an old index, rebuild an unreadable one, or build from the DB first,
+            # so the new text joins a manifest and an index that hold everything else
+            vs, _ = _sync(user_id)
+            manifest = load_manifest(user_id) or {"sources": {}}
+        stored = _stored_chunk_ids(user_id, vs)
+        add = {}
+        for text in texts:
+            if not text or not text.strip():
+                continue
+            source_id = _note_source_id(kind, text)
+            source = {"kind": kind, "rows": [], "text": text}
+            chunks = _chunk_source(user_id, source_id, source)
+            manifest["sources"][source_id] = dict(source, chunks=list(chunks))
+            add.update({c: chunk for c, chunk in chunks.items() if c not in stored})
+        if not add:
+            return vs
+        return _apply_changes(user_id, vs, manifest, [], add)
+
+
+def delete_source(user_id: int, source_id: str) -> Optional[FAISS]:
+    """Removes one source (e.g. a note the user added) and its vectors from the KB."""
+    with _user_lock(user_id):
+        vs = _read_user_vectorstore(user_id)
+        manifest = load_manifest(user_id)
+        if not manifest or source_id not in manifest["sources"]:
+            return vs
+        entry = manifest["sources"].pop(source_id)
+        if vs is None:
+            # The index is unreadable: record the removal, then rebuild it from the remaining sources
+            _save_manifest(user_id, manifest)
+            vs, _ = _sync(user_id)
+            return vs
+        return _apply_changes(user_id, vs, manifest, entry["chunks"], {})
+
+
+def get_user_retriever(user_id: int):
+    vs = load_user_vectorstore(user_id)
+    if vs is None:
+        # try to build from DB if nothing exists yet
+        vs = rebuild_user_kb(user_id)
+    if vs is None:
+        return None
+    return vs.as_retriever(search_kwargs={"k": 4})
+
+
+# ---------------------------
+# Migration to the tenant store
+# ---------------------------
+
+def migrate_to_tenant_store(remove_old: bool = False) -> Dict[str, int]:
+    """
+    Copies every faiss_indexes/user_<id>/ index into the tenant store, reusing
+    the stored vectors (nothing is re-embedded). Indexes from before manifests
+    get one built from their chunks; the next sync replaces their profile and
+    report chunks. Safe to re-run: a user's tenant data is replaced each time.
+    """
+    totals = {"users": 0, "chunks": 0, "skipped": 0}
+    migrated = []
+    for udir in sorted(BASE_INDEX_DIR.glob("user_*")):
+        try:
+            user_id = int(udir.name[len("user_"):])
+        except ValueError:
+            continue
+        vs = _read_index_dir(user_id, writable=False)
+        if vs is None:
+            print(f"⚠️ Skipping {udir}: no readable index")
+            totals["skipped"] += 1
+            continue
+        manifest_path = udir / MANIFEST_FILE
+        legacy = not manifest_path.exists()
+        manifest = {"sources": {}} if legacy else json.loads(manifest_path.read_text())
+
+        all_vectors = vs.index.reconstruct_n(0, vs.index.ntotal)
+        chunks, vectors = {}, []
+        for position in range(vs.index.ntotal):
+            chunk_id = vs.index_to_docstore_id[position]
+            doc = vs.docstore.search(chunk_id)
+            metadata = doc.metadata or {}
+            if legacy:
+                kind = metadata.get("type", "note")
+                source_id = _note_source_id(kind, doc.page_content)
+                chunk_id = _chunk_id(user_id, source_id, doc.page_content)
+                metadata = {"user_id": user_id, "type": kind, "source": source_id, "rows": []}
+                manifest["sources"].setdefault(source_id, {"kind": kind, "rows": [], "text": doc.page_content,
+                                                           "chunks": [chunk_id]})
+            if chunk_id not in chunks:
+                chunks[chunk_id] = (doc.page_content, metadata)
+                vectors.append(all_vectors[position])
+
+        tenant_kb.delete_user(user_id, persist=False)
+        if chunks:
+            tenant_kb.add_chunks(user_id, chunks, vectors=vectors, persist=False)
+        tenant_kb.save_manifest(user_id, manifest)
+        migrated.append(udir)
+        totals["users"] += 1
+        totals["chunks"] += len(chunks)
+    tenant_kb.save_shards()
+    if remove_old:
+        for udir in migrated:
+            shutil.rmtree(udir)
+    print(f"📦 Migrated {totals['users']} user index(es), {totals['chunks']} chunks, to {tenant_kb.TENANT_INDEX_DIR}"
+          f" ({totals['skipped']} skipped)")
+    return totals
+
+
+if __name__ == "__main__":
+    # python -m utils.user_kb migrate [--remove-old], then run with USER_KB_STORE=tenant
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", choices=["migrate"])
+    parser.add_argument("--remove-old", action="store_true", help="delete faiss_indexes/user_* after migrating")
+    args = parser.parse_args()
+    migrate_to_tenant_store(remove_old=args.remove_old)
@@ -0,0 +1,256 @@
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+from collections.abc import Mapping
+from pathlib import Path
+from typing import List, Optional, Union
+
+import faiss
+from langchain_community.docstore.base import Docstore
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores import FAISS
+from langchain_core.documents import Document
+
+# ---------------------------
+# Pickle-free vector store format
+# ---------------------------
+# A store is a generation directory holding index.faiss (the FAISS index as
+# written by faiss) and docs.sqlite3, with one row per vector position: its
+# docstore id, text and metadata as JSON. Nothing is pickled, so loading
+# can't execute code from the files.
+# Each save writes a new generation (g000001, g000002, ...) and then swaps
+# the CURRENT file that names it, so a reader always gets an index and a
+# docs file from the same save. The previous generation is kept for readers
+# that are still opening it; older ones are deleted.
+# Readers open the index memory-mapped and look up rows only for the hits a
+# search returns. Opening a store is therefore a couple of file opens
+# whatever its size, and the OS page cache shares the vectors between
+# processes. Writers (load_store(..., writable=True)) read everything into
+# memory so the LangChain store can add and delete.
+INDEX_FILE = "index.faiss"
+DOCS_FILE = "docs.sqlite3"
+CURRENT_FILE = "CURRENT"
+LEGACY_DOCSTORE_FILE = "index.pkl"
+
+_convert_lock = threading.Lock()
+
+
+def _connect(path: Path) -> sqlite3.Connection:
+    return sqlite3.connect(path, timeout=30, check_same_thread=False)
+
+
+class SQLiteDocstore(Docstore):
+    """Read-only docstore over docs.sqlite3, queried per lookup."""
+
+    def __init__(self, path: Path):
+        self._conn = _connect(path)
+        self._lock = threading.Lock()
+
+    def search(self, search: str) -> Union[str, Document]:
+        with self._lock:
+            row = self._conn.execute("SELECT text, metadata FROM docs WHERE doc_id = ?", (search,)).fetchone()
+        if row is None:
+            return f"ID {search} not found."
+        return Document(page_content=row[0], metadata=json.loads(row[1]))
+
+    def position_to_id(self, position: int) -> str:
+        with self._lock:
+            row = self._conn.execute("SELECT doc_id FROM docs WHERE position = ?", (position,)).fetchone()
+        if row is None:
+            raise KeyError(position)
+        return row[0]
+
+    def count(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM docs").fetchone()[0]
+
+
+class _PositionMap(Mapping):
+    """index_to_docstore_id for a read-only store, looked up in the docstore instead of held in memory."""
+
+    def __init__(self, docstore: SQLiteDocstore):
+        self._docstore = docstore
+
+    def __getitem__(self, position):
+        return self._docstore.position_to_id(int(position))
+
+    def __len__(self):
+        return self._docstore.count()
+
+    def __iter__(self):
+        return iter(range(len(self)))
+
+
+def _current_generation(folder: Path) -> Optional[Path]:
+    try:
+        name = (folder / CURRENT_FILE).read_text().strip()
+    except FileNotFoundError:
+        return None
+    return folder / name
+
+
+def _generations(folder: Path) -> List[Path]:
+    return sorted(p for p in folder.glob("g[0-9]*") if p.is_dir())
+
+
+def has_store(folder) -> bool:
+    return _current_generation(Path(folder)) is not None
+
+
+def has_legacy_store(folder) -> bool:
+    """True for an index saved by FAISS.save_local (pickled docstore) that has not been converted."""
+    folder = Path(folder)
+    return (folder / LEGACY_DOCSTORE_FILE).exists() and not has_store(folder)
+
+
+def store_stamp(folder):
+    """(mtime_ns of CURRENT, bytes of the current generation), changing with every save; None if there is no store."""
+    folder = Path(folder)
+    try:
+        current = os.stat(folder / CURRENT_FILE)
+        generation = _current_generation(folder)
+        size = sum(os.stat(generation / name).st_size for name in (INDEX_FILE, DOCS_FILE))
+    except FileNotFoundError:
+        return None
+    return current.st_mtime_ns, size
+
+
+def _write_docs(vectorstore: FAISS, path: Path) -> None:
+    conn = _connect(path)
+    try:
+        conn.execute("CREATE TABLE docs (position INTEGER PRIMARY KEY, doc_id TEXT UNIQUE NOT NULL, "
+                     "text TEXT NOT NULL, metadata TEXT NOT NULL)")
+        rows = []
+        for position, doc_id in vectorstore.index_to_docstore_id.items():
+            doc = vectorstore.docstore.search(doc_id)
+            rows.append((int(position), doc_id, doc.page_content, json.dumps(doc.metadata or {})))
+        conn.executemany("INSERT INTO docs (position, doc_id, text, metadata) VALUES (?, ?, ?, ?)", rows)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def save_store(vectorstore: FAISS, folder) -> None:
+    """Writes a LangChain FAISS store as a new generation and makes it current."""
+    folder = Path(folder)
+    folder.mkdir(parents=True, exist_ok=True)
+    staging = Path(tempfile.mkdtemp(prefix=".staging-", dir=folder))
+    try:
+        _write_docs(vectorstore, staging / DOCS_FILE)
+        faiss.write_index(vectorstore.index, str(staging / INDEX_FILE))
+        # Another process may take the same number; renaming onto an existing generation fails, so try the next
+        number = max((int(p.name[1:]) for p in _generations(folder)), default=0) + 1
+        while True:
+            generation = folder / f"g{number:06d}"
+            try:
+                staging.rename(generation)
+                break
+            except OSError:
+                if not generation.exists():
+                    raise
+                number += 1
+    except BaseException:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+    previous = _current_generation(folder)
+    _point_to(folder, generation)
+
+    keep = {generation.name, previous.name if previous else None}
+    for old in _generations(folder):
+        if old.name not in keep:
+            shutil.rmtree(old, ignore_errors=True)
+
+
+def _point_to(folder: Path, generation: Path) -> None:
+    pointer = folder / (CURRENT_FILE + ".tmp")
+    pointer.write_text(generation.name)
+    pointer.replace(folder / CURRENT_FILE)
+
+
+def _adopt_flat_store(folder: Path) -> None:
+    """Moves index.faiss + docs.sqlite3 written straight into the folder (the first version of this format)
+    into a generation."""
+    with _convert_lock:
+        if has_store(folder) or not all((folder / name).exists() for name in (INDEX_FILE, DOCS_FILE)):
+            return
+        generation = folder / "g000001"
+        generation.mkdir(exist_ok=True)
+        for name in (DOCS_FILE, INDEX_FILE):
+            (folder / name).replace(generation / name)
+        _point_to(folder, generation)
+
+
+def load_store(folder, embeddings, writable: bool = False) -> FAISS:
+    """
+    Opens a store saved by save_store(): memory-mapped and read on demand, or
+    fully in memory if writable. An index left by FAISS.save_local is
+    converted on first use.
+    """
+    folder = Path(folder)
+    if has_legacy_store(folder):
+        convert_legacy_store(folder)
+    elif not has_store(folder):
+        _adopt_flat_store(folder)
+    generation = _current_generation(folder)
+    if generation is None:
+        raise FileNotFoundError(f"No vector store in {folder}")
+    if not writable:
+        index = faiss.read_index(str(generation / INDEX_FILE), faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY)
+        docstore = SQLiteDocstore(generation / DOCS_FILE)
+        return FAISS(embeddings, index, docstore, _PositionMap(docstore))
+
+    index = faiss.read_index(str(generation / INDEX_FILE))
+    conn = _connect(generation / DOCS_FILE)
+    try:
+        rows = conn.execute("SELECT position, doc_id, text, metadata FROM docs ORDER BY position").fetchall()
+    finally:
+        conn.close()
+    docstore = InMemoryDocstore({doc_id: Document(page_content=text, metadata=json.loads(metadata))
+                                 for _, doc_id, text, metadata in rows})
+    return FAISS(embeddings, index, docstore, {position: doc_id for position, doc_id, _, _ in rows})
+
+
+def remove_store(folder) -> None:
+    """Deletes the store's generations. An unconverted index.pkl is left alone."""
+    folder = Path(folder)
+    (folder / CURRENT_FILE).unlink(missing_ok=True)
+    for generation in _generations(folder):
+        shutil.rmtree(generation, ignore_errors=True)
+
+
+# ---------------------------
+# Conversion from FAISS.save_local
+# ---------------------------
+
+def convert_legacy_store(folder) -> bool:
+    """
+    Rewrites an index.faiss + index.pkl directory in this format and deletes
+    both files. This is the one place a pickled docstore is still read (the
+    app only ever finds ones it wrote itself). Returns False if there was
+    nothing to convert.
+    """
+    folder = Path(folder)
+    with _convert_lock:
+        if not has_legacy_store(folder):
+            return False
+        from utils.embeddings import get_embeddings
+        vectorstore = FAISS.load_local(str(folder), embeddings=get_embeddings(),
+                                       allow_dangerous_deserialization=True)
+        save_store(vectorstore, folder)
+        for name in (LEGACY_DOCSTORE_FILE, INDEX_FILE):
+            (folder / name).unlink(missing_ok=True)
+    print(f"✅ Converted {folder} ({vectorstore.index.ntotal} vectors)")
+    return True
+
+
+if __name__ == "__main__":
+    # python -m utils.vector_store convert [folder ...]; defaults to the guidelines and per-user indexes
+    if sys.argv[1:2] != ["convert"]:
+        sys.exit("usage: python -m utils.vector_store convert [folder ...]")
+    folders = sys.argv[2:] or ["faiss_index", *sorted(str(p) for p in Path("faiss_indexes").glob("user_*"))]
+    converted = sum(convert_legacy_store(folder) for folder in folders if os.path.isdir(folder))
+    print(f"Converted {converted} of {len(folders)} index folder(s)")